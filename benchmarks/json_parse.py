@@ -0,0 +1,80 @@
+# МИКРОБЕНЧМАРК РАЗБОРА ОТВЕТА /forecast
+# Сравнивает полный разбор стандартным json (всё дерево остаётся в памяти)
+# и разбор в ForecastSlot через decode_json (orjson/msgspec, если установлены).
+#
+# Запуск из корня проекта: python benchmarks/json_parse.py
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from weather import JSON_BACKEND, parse_forecast_payload
+
+SLOTS = 40
+REPEAT = 200
+
+
+def build_payload():
+    """Синтетический ответ /forecast той же формы, что отдаёт OpenWeather."""
+    start = 1_760_000_000
+    items = []
+    for i in range(SLOTS):
+        items.append({
+            "dt": start + i * 10800,
+            "main": {
+                "temp": 10.5 + i % 7, "feels_like": 9.1, "temp_min": 9.8, "temp_max": 11.2,
+                "pressure": 1013, "sea_level": 1013, "grnd_level": 995, "humidity": 71, "temp_kf": 0.4
+            },
+            "weather": [{"id": 500, "main": "Rain", "description": "небольшой дождь", "icon": "10d"}],
+            "clouds": {"all": 75},
+            "wind": {"speed": 4.2, "deg": 230, "gust": 7.9},
+            "visibility": 10000,
+            "pop": 0.43,
+            "rain": {"3h": 0.6},
+            "sys": {"pod": "d"},
+            "dt_txt": "2025-10-09 12:00:00",
+        })
+    return json.dumps({
+        "cod": "200", "message": 0, "cnt": SLOTS, "list": items,
+        "city": {
+            "id": 524901, "name": "Москва", "coord": {"lat": 55.7522, "lon": 37.6156}, "country": "RU",
+            "population": 1000000, "timezone": 10800, "sunrise": 1759981000, "sunset": 1760021000
+        },
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def full_tree(payload):
+    return json.loads(payload)["list"]
+
+
+def slim_records(payload):
+    return parse_forecast_payload(payload)
+
+
+def retained_bytes(parse, payload):
+    """Сколько памяти остаётся занято результатом разбора одного ответа."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = parse(payload)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del result
+    return size
+
+
+def main():
+    payload = build_payload()
+    print(f"Ответ: {len(payload)} байт, {SLOTS} слотов, парсер: {JSON_BACKEND}")
+    print(f"{'вариант':<22}{'мкс/ответ':>12}{'байт в памяти':>16}")
+    for name, parse in (("json, полное дерево", full_tree), ("ForecastSlot", slim_records)):
+        seconds = min(timeit.repeat(lambda: parse(payload), number=REPEAT, repeat=5)) / REPEAT
+        print(f"{name:<22}{seconds * 1e6:>12.1f}{retained_bytes(parse, payload):>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,11 @@ import json
 import logging
 import os
 import re
+import threading
 import time
 from collections import Counter
 from datetime import datetime, timezone
+from functools import wraps
 from logging.handlers import RotatingFileHandler
 from zoneinfo import ZoneInfo
 
@@ -15,10 +17,10 @@ from dotenv import load_dotenv
 from telebot import types
 
 from texts import TEXTS
-from weather import get_weather, resolve_city_from_coords, fetch_today_forecast, fetch_tomorrow_forecast
+from weather import get_weather, resolve_city_from_coords, fetch_today_forecast, fetch_tomorrow_forecast, is_service_unavailable
 from logic import (
     # users / storage
-    get_user, save_user, update_user, update_user_city, update_user_unit,
+    get_user, save_user, update_user, update_user_city, get_user_coords, update_user_unit,
 
     # texts / i18n
     get_text, get_translation_dict, get_user_lang,
@@ -38,6 +40,7 @@ from logic import (
 
     # json-store helpers
     get_data_field, update_data_field,
+    is_daily_forecast_unchanged, remember_daily_forecast, is_message_not_modified_error,
 
     # misc
     safe_execute, log_action,
@@ -99,6 +102,13 @@ bot_logger.addHandler(file_handler)
 bot_logger.addHandler(console_handler)
 bot_logger.addHandler(error_handler)
 
+weather_logger = logging.getLogger("weather")  # Запросы к OpenWeather (weather.py) — в лог бота
+weather_logger.setLevel(logging.DEBUG)
+weather_logger.propagate = False
+weather_logger.handlers.clear()
+for handler in (file_handler, console_handler, error_handler):
+    weather_logger.addHandler(handler)
+
 bot_logger.debug("🔍 DEBUG-логгер для бота инициализирован.")
 bot_logger.info("✅ Логирование для бота настроено!")
 
@@ -108,6 +118,100 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 bot = telebot.TeleBot(BOT_TOKEN)
 
 
+#МАРШРУТИЗАЦИЯ CALLBACK-ЗАПРОСОВ
+CALLBACK_EXACT_ROUTES = {}
+CALLBACK_PREFIX_ROUTES = {}
+CALLBACK_STATS_LOG_EVERY = 200
+
+callback_route_stats = {}
+_callback_stats_lock = threading.Lock()
+_callback_calls_total = 0
+
+
+def callback_route(*exact, prefix=None):
+    """
+    Регистрирует обработчик callback_data в таблице маршрутов.
+    exact — точные значения callback_data, prefix — префикс, обязательно оканчивающийся на "_".
+    """
+    def decorator(func):
+        for data in exact:
+            if data in CALLBACK_EXACT_ROUTES:
+                bot_logger.warning(f"Маршрут callback '{data}' уже занят, {func.__name__} пропущен.")
+                continue
+            CALLBACK_EXACT_ROUTES[data] = func
+        if prefix:
+            if not prefix.endswith("_"):
+                raise ValueError(f"Префикс callback должен оканчиваться на '_': {prefix}")
+            if prefix in CALLBACK_PREFIX_ROUTES:
+                bot_logger.warning(f"Префикс callback '{prefix}' уже занят, {func.__name__} пропущен.")
+            else:
+                CALLBACK_PREFIX_ROUTES[prefix] = func
+        return func
+    return decorator
+
+
+def resolve_callback_route(data):
+    """
+    Возвращает (имя маршрута, обработчик) для callback_data.
+    Сначала точное совпадение, затем самый длинный префикс по границам "_".
+    """
+    handler = CALLBACK_EXACT_ROUTES.get(data)
+    if handler:
+        return data, handler
+
+    end = data.rfind("_")
+    while end != -1:
+        prefix = data[:end + 1]
+        handler = CALLBACK_PREFIX_ROUTES.get(prefix)
+        if handler:
+            return f"{prefix}*", handler
+        end = data.rfind("_", 0, end)
+    return None, None
+
+
+def record_callback_timing(route, elapsed):
+    """Копит количество вызовов и время обработки по каждому маршруту."""
+    global _callback_calls_total
+    elapsed_ms = elapsed * 1000
+    with _callback_stats_lock:
+        stats = callback_route_stats.setdefault(route, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        _callback_calls_total += 1
+        should_log = _callback_calls_total % CALLBACK_STATS_LOG_EVERY == 0
+        snapshot = dict(callback_route_stats) if should_log else None
+
+    bot_logger.debug(f"Callback {route} обработан за {elapsed_ms:.1f} мс.")
+    if snapshot:
+        summary = ", ".join(
+            f"{name}: {st['calls']} шт., ср. {st['total_ms'] / st['calls']:.1f} мс, макс. {st['max_ms']:.1f} мс"
+            for name, st in sorted(snapshot.items(), key=lambda item: -item[1]["total_ms"])
+        )
+        bot_logger.info(f"▸ Статистика callback-маршрутов: {summary}")
+
+
+def get_callback_route_stats():
+    """Возвращает копию счётчиков маршрутизатора callback-запросов."""
+    with _callback_stats_lock:
+        return {route: dict(stats) for route, stats in callback_route_stats.items()}
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    """Единая точка входа для всех callback-запросов: один разбор callback_data и прямой вызов обработчика."""
+    route, handler = resolve_callback_route(call.data or "")
+    if not handler:
+        bot_logger.debug(f"Нет обработчика для callback_data: {call.data}")
+        return
+
+    started = time.perf_counter()
+    try:
+        handler(call)
+    finally:
+        record_callback_timing(route, time.perf_counter() - started)
+
+
 #ФУНКЦИИ
 @safe_execute
 @bot.message_handler(func=lambda m: getattr(m, "pinned_message", None) is not None)
@@ -118,10 +222,6 @@ def _delete_pin_service_message(message):
         # В группах/каналах может не быть прав, либо Telegram не даст удалить сервиску
         bot_logger.debug(f"Не удалось удалить системное сообщение о закреплении: {e}")
 
-@bot.callback_query_handler(
-    func=lambda call: call.data.startswith("citypick_")
-    and (get_data_field("citypick_flow", call.message.chat.id) not in ("reg", "chg"))
-)
 def legacy_citypick_guard(call):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id, "Меню устарело. Откройте /start или Настройки → Изменить город.")
@@ -131,6 +231,28 @@ def legacy_citypick_guard(call):
         pass
 
 
+def require_citypick_flow(func):
+    """
+    Пропускает citypick_-callback только при активном сценарии выбора города (reg/chg).
+    citypick_flow читается из хранилища один раз и передаётся в обработчик.
+    """
+    @wraps(func)
+    def wrapper(call):
+        flow = get_data_field("citypick_flow", call.message.chat.id)
+        if flow not in ("reg", "chg"):
+            legacy_citypick_guard(call)
+            return
+        return func(call, flow)
+    return wrapper
+
+
+@callback_route(prefix="citypick_")
+@require_citypick_flow
+def citypick_unhandled(call, flow):
+    """Кнопки выбора города без отдельного маршрута (например, citypick_geo)."""
+    bot.answer_callback_query(call.id)
+
+
 def track_bot_message(message):
     """Запоминает последнее отправленное сообщение от бота."""
     update_data_field("last_bot_message", message.chat.id, message.message_id)
@@ -214,8 +336,9 @@ def build_city_kb(lang: str, country_code: str, flow: str = "reg") -> types.Inli
 
     return kb
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("citypick_country_"))
-def citypick_country(call):
+@callback_route(prefix="citypick_country_")
+@require_citypick_flow
+def citypick_country(call, flow):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
     user = require_registered_user(user_id, chat_id, "ru")
@@ -225,7 +348,6 @@ def citypick_country(call):
     lang = get_user_lang(user)
 
     country_code = call.data.replace("citypick_country_", "").strip().upper()
-    flow = get_data_field("citypick_flow", chat_id) or "chg"
     kb = build_city_kb(lang, country_code, flow=flow)
 
     bot.edit_message_text(
@@ -238,8 +360,9 @@ def citypick_country(call):
 
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("citypick_city_"))
-def citypick_city(call):
+@callback_route(prefix="citypick_city_")
+@require_citypick_flow
+def citypick_city(call, flow):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
     user = require_registered_user(user_id, chat_id, "ru")
@@ -264,8 +387,6 @@ def citypick_city(call):
 
     update_user_city(user_id, city_name, call.from_user.username)
 
-    flow = get_data_field("citypick_flow", chat_id) or ("reg" if not user.preferred_city else "chg")
-
     # ✅ при смене города: "эхо" города -> сразу удалить
     if flow == "chg":
         try:
@@ -298,8 +419,9 @@ def citypick_city(call):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "citypick_back")
-def citypick_back(call):
+@callback_route("citypick_back")
+@require_citypick_flow
+def citypick_back(call, flow):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
     user = require_registered_user(user_id, chat_id, "ru")
@@ -308,7 +430,6 @@ def citypick_back(call):
         return
     lang = get_user_lang(user)
 
-    flow = get_data_field("citypick_flow", chat_id) or "chg"
     kb = build_country_kb(lang, flow=flow)
     bot.edit_message_text(
         chat_id=chat_id,
@@ -328,8 +449,9 @@ def require_registered_user(user_id: int, chat_id: int, lang_fallback: str = "ru
         return None
     return user
 
-@bot.callback_query_handler(func=lambda call: call.data == "citypick_manual")
-def citypick_manual(call):
+@callback_route("citypick_manual")
+@require_citypick_flow
+def citypick_manual(call, flow):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
     user = require_registered_user(user_id, chat_id, "ru")
@@ -350,18 +472,20 @@ def handle_all_messages(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     
+    if message.date < bot_start_time:
+        return
+
     user = require_registered_user(user_id, chat_id, "ru")
     if not user:
         return
-    lang = get_user_lang(user)
-    current_menu_actions = get_menu_actions(lang)
 
-    if message.date < bot_start_time:
-        return
-    if message.text in current_menu_actions:
-        current_menu_actions[message.text](message)
+    action = MENU_ACTIONS_INDEX.get(message.text)
+    if action:
+        action(message)
         return
 
+    lang = get_user_lang(user)
+
     bot_logger.info(f"▸ Пользователь {user_id} отправил неизвестное сообщение: {message.text}")
     bot.send_message(chat_id, get_text("unknown_command", lang))
     send_main_menu(chat_id)
@@ -389,6 +513,7 @@ def process_city_manual_input(message):
         return
 
     updated = update_user_city(user_id, city, message.from_user.username)
+    city = getattr(get_user(user_id), "preferred_city", None) or city  # Каноническое название города
 
     flow = get_data_field("citypick_flow", chat_id) or ("reg" if not user or not user.preferred_city else "chg")
     if flow == "reg":
@@ -501,7 +626,7 @@ def safe_delete(chat_id, message_id):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data in ["forecast_today", "forecast_tomorrow", "forecast_week"])
+@callback_route("forecast_today", "forecast_tomorrow", "forecast_week")
 def forecast_handler(call):
     chat_id = call.message.chat.id
     user = get_user(call.from_user.id)
@@ -526,26 +651,28 @@ def forecast_handler(call):
     summary_raw_data = None # Данные для текстового описания (дождь в 14:00 и т.д.)
 
     if call.data == "forecast_today":
-        # Данные
-        day_data = get_today_forecast(user.preferred_city, user)
+        # Данные (один запрос на сводку дня и текстовое описание)
+        summary_raw_data = fetch_today_forecast(user.preferred_city, lang=lang, allow_stale=True, coords=get_user_coords(user))
+        day_data = get_today_forecast(user.preferred_city, user, raw_data=summary_raw_data)
         if day_data: forecast_data = [day_data]
         
         # Тексты
         title_text = get_text("daily_forecast_title", lang)
-        summary_raw_data = fetch_today_forecast(user.preferred_city, lang=lang)
 
     elif call.data == "forecast_tomorrow":
         # Данные
-        day_data = get_tomorrow_forecast(user.preferred_city, user) # Убедись, что эта функция импортирована
+        summary_raw_data = fetch_tomorrow_forecast(user.preferred_city, lang=lang, allow_stale=True, coords=get_user_coords(user))
+        day_data = get_tomorrow_forecast(user.preferred_city, user, raw_data=summary_raw_data)
         if day_data: forecast_data = [day_data]
         
         # Тексты
         title_text = get_text("tomorrow_forecast_title", lang) or "Прогноз на завтра"
-        summary_raw_data = fetch_tomorrow_forecast(user.preferred_city, lang=lang)
 
     else: # forecast_week
         # Данные
-        forecast_data = get_weekly_forecast_data(user.preferred_city, user) # Используем get_weekly_forecast_data из logic
+        forecast_data = get_weekly_forecast_data(
+            user.preferred_city, user, raw_data=fetch_today_forecast(user.preferred_city, lang=lang, allow_stale=True, coords=get_user_coords(user))
+        ) # Используем get_weekly_forecast_data из logic
         
         # Тексты
         title_text = get_text("weekly_forecast_title", lang) or "Прогноз на неделю"
@@ -553,7 +680,10 @@ def forecast_handler(call):
 
     # 2. Проверка на пустоту
     if not forecast_data or any(d is None for d in forecast_data):
-        bot.send_message(chat_id, "⚠ Не удалось получить прогноз погоды.")
+        if is_service_unavailable("forecast"):
+            bot.send_message(chat_id, get_text("weather_service_unavailable", lang))
+        else:
+            bot.send_message(chat_id, "⚠ Не удалось получить прогноз погоды.")
         return
 
     # 3. Генерация текста сообщения
@@ -603,7 +733,7 @@ def forecast_handler(call):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_settings")
+@callback_route("back_to_settings")
 def back_to_settings_callback(call):
     """Обработчик возврата в меню настроек"""
     chat_id = call.message.chat.id
@@ -624,11 +754,6 @@ def back_to_settings_callback(call):
 
 
 @safe_execute
-@bot.message_handler(func=lambda message: message.text in [
-    get_text("menu_settings", "ru"),
-    get_text("menu_settings", "en"),
-    get_text("menu_settings", "kk")
-])
 def settings_menu_handler(message):
     """Открывает меню настроек и сохраняет ID сообщения, которым оно было вызвано."""
     chat_id = message.chat.id
@@ -640,7 +765,7 @@ def settings_menu_handler(message):
     send_settings_menu(chat_id)
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_main")
+@callback_route("back_to_main")
 def back_to_main_callback(call):
     """Возврат в главное меню: чистим меню-сообщение и команды, которые открывали настройки/подменю."""
     chat_id = call.message.chat.id
@@ -714,7 +839,7 @@ def handle_weather_command(message):
         bot.reply_to(message, get_text("city_not_set", lang))
         return
 
-    weather_data = get_weather(user.preferred_city, lang=lang)
+    weather_data = get_weather(user.preferred_city, lang=lang, allow_stale=True, coords=get_user_coords(user))
     
     if weather_data:
         title = get_text("current_weather_title", lang) or "Текущая погода"
@@ -736,12 +861,14 @@ def handle_weather_command(message):
         # 3. Отправляем меню заново вниз
         send_main_menu(chat_id)
         
+    elif is_service_unavailable("weather"):
+        bot.reply_to(message, get_text("weather_service_unavailable", lang))
     else:
         bot.reply_to(message, get_text("error_getting_weather", lang))
 
 
 @safe_execute
-@bot.message_handler(regexp=r"^(\/changecity|🏙 Изменить город|🏙 Change city|🏙 Қаланы өзгерту)$")
+@bot.message_handler(commands=['changecity'])
 def cmd_changecity(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
@@ -759,7 +886,7 @@ def cmd_changecity(message):
     start_city_picker(chat_id, lang, flow="chg")
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_changecity")
+@callback_route("cancel_changecity")
 def cancel_changecity_callback(call):
     """Отмена изменения города и возврат в настройки"""
     chat_id = call.message.chat.id
@@ -779,11 +906,6 @@ def cancel_changecity_callback(call):
 
 
 @safe_execute
-@bot.message_handler(func=lambda message: message.text in [
-    get_text("notifications_menu_btn", "ru"),
-    get_text("notifications_menu_btn", "en"),
-    get_text("notifications_menu_btn", "kk")
-])
 def notification_settings(message):
     chat_id = message.chat.id
     user = get_user(message.from_user.id)
@@ -818,7 +940,7 @@ def notification_settings(message):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data.startswith("toggle_notification_"))
+@callback_route(prefix="toggle_notification_")
 def toggle_notification(call):
     """Изменяет состояние уведомлений пользователя"""
     chat_id = call.message.chat.id
@@ -883,7 +1005,7 @@ def stop_notifications(message):
 
 
 @safe_execute
-@bot.message_handler(regexp=r"^(\📅 Прогноз погоды|/weatherforecast)$")
+@bot.message_handler(commands=['weatherforecast'])
 def forecast_menu_handler(message):
     chat_id = message.chat.id
     user = get_user(message.from_user.id)
@@ -913,7 +1035,7 @@ def forecast_menu_handler(message):
 
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_from_forecast_menu")
+@callback_route("back_from_forecast_menu")
 def back_from_forecast_menu(call):
     """Закрывает меню прогноза и возвращает в главное меню"""
     chat_id = call.message.chat.id
@@ -926,7 +1048,7 @@ def back_from_forecast_menu(call):
     bot_logger.debug(f"Последняя команда перед удалением: {last_command_data}")
     if last_command_data:
         last_command = last_command_data.get("command")
-        if last_command in ["📅 Прогноз погоды", "/weatherforecast"]:
+        if last_command == "/weatherforecast" or MENU_ACTIONS_INDEX.get(last_command) is forecast_menu_handler:
             try:
                 bot.delete_message(chat_id, last_command_data["message_id"])
                 update_data_field("last_user_command", chat_id, None)
@@ -954,16 +1076,14 @@ def refresh_daily_forecast(user_id):
 
     lang = get_user_lang(user)
     
-    raw_forecast = get_today_forecast(user.preferred_city, user)
+    forecast_list = fetch_today_forecast(user.preferred_city, lang=lang, coords=get_user_coords(user))
+    raw_forecast = get_today_forecast(user.preferred_city, user, raw_data=forecast_list)
     if not raw_forecast:
         bot_logger.warning(f"▸ `get_today_forecast` не вернула данные для {user.preferred_city}!")
         return
 
     title = get_text("daily_forecast_title", lang)
-    summary = get_weather_summary_description(
-        fetch_today_forecast(user.preferred_city, lang=lang),
-        user
-    )
+    summary = get_weather_summary_description(forecast_list, user)
 
     forecast_message = format_forecast(
         raw_forecast,
@@ -975,7 +1095,7 @@ def refresh_daily_forecast(user_id):
 
     try:
         sent_message = bot.send_message(user_id, forecast_message, parse_mode="HTML")
-        update_data_field("last_daily_forecast", user_id, sent_message.message_id)
+        remember_daily_forecast(user_id, forecast_message, sent_message.message_id)
         bot_logger.info(f"▸ Новый прогноз отправлен пользователю {user_id}.")
         
         try:
@@ -1012,17 +1132,15 @@ def update_existing_forecast(user_id):
 
     lang = get_user_lang(user)
 
-    raw_forecast = get_today_forecast(user.preferred_city, user)
+    forecast_list = fetch_today_forecast(user.preferred_city, lang=lang, coords=get_user_coords(user))
+    raw_forecast = get_today_forecast(user.preferred_city, user, raw_data=forecast_list)
     if not raw_forecast:
         bot_logger.warning(f"▸ `get_today_forecast` не вернула данные для {user.preferred_city}!")
         return
 
     title = get_text("daily_forecast_title", lang)
 
-    summary = get_weather_summary_description(
-        fetch_today_forecast(user.preferred_city, lang=lang),
-        user
-    )
+    summary = get_weather_summary_description(forecast_list, user)
 
     # ✅ ВАЖНО: format_forecast требует title_text
     forecast_message = format_forecast(
@@ -1033,6 +1151,10 @@ def update_existing_forecast(user_id):
         is_daily_forecast=True
     )
 
+    if is_daily_forecast_unchanged(user_id, forecast_message):
+        bot_logger.debug(f"▸ Прогноз для {user_id} не изменился, редактирование пропущено.")
+        return
+
     try:
         bot.edit_message_text(
             chat_id=user_id,
@@ -1040,9 +1162,13 @@ def update_existing_forecast(user_id):
             text=forecast_message,
             parse_mode="HTML"
         )
+        remember_daily_forecast(user_id, forecast_message)
         bot_logger.info(f"▸ Прогноз обновлён (edit) для пользователя {user_id}.")
         return
     except Exception as edit_error:
+        if is_message_not_modified_error(edit_error):
+            remember_daily_forecast(user_id, forecast_message)
+            return
         # Если Telegram не дал редактировать (сообщение удалено/не найдено/и т.п.) —
         # тогда вынужденно пересоздаём и закрепляем заново.
         bot_logger.warning(f"▸ Не удалось отредактировать прогноз для {user_id}: {edit_error}")
@@ -1098,7 +1224,7 @@ def format_settings(param, reply_to=None):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data == "return_to_format_settings")
+@callback_route("return_to_format_settings")
 def return_to_format_settings(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1144,14 +1270,14 @@ def return_to_format_settings(call):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data == "format_settings")
+@callback_route("format_settings")
 def format_settings_callback(call):
     """Обработчик кнопки 'Сохранить', возвращает в меню формата данных"""
     format_settings(call.message)
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data.startswith("toggle_weather_param_"))
+@callback_route(prefix="toggle_weather_param_")
 def toggle_weather_param(call):
     """Обработчик изменения отображаемых данных в прогнозе"""
     chat_id = call.message.chat.id
@@ -1185,11 +1311,6 @@ def toggle_weather_param(call):
 
 
 @safe_execute
-@bot.message_handler(func=lambda message: message.text in [
-    get_text("menu_language", "ru"),
-    get_text("menu_language", "en"),
-    get_text("menu_language", "kk")
-])
 def language_settings(message):
     chat_id = message.chat.id
     user = get_user(message.from_user.id)
@@ -1218,7 +1339,7 @@ def language_settings(message):
         bot_logger.error(f"▸ Ошибка в language_settings: {e}")
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data.startswith("set_lang_"))
+@callback_route(prefix="set_lang_")
 def set_language_callback(call):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
@@ -1346,6 +1467,7 @@ def process_new_city(message, show_menu=False):
         return
 
     updated = update_user_city(user_id, city, message.from_user.username)
+    city = getattr(get_user(user_id), "preferred_city", None) or city  # Каноническое название города
     if updated:
         bot_logger.info(f"Пользователь {user_id} успешно сменил город на {city}.")
         success_text = get_text("changecity_success_update", get_user_lang(get_user(user_id))).format(city=city)
@@ -1416,8 +1538,10 @@ def process_new_city_registration(message):
         bot.register_next_step_handler(msg, process_new_city_registration)
 
     # --- Обработка ввода ---
+    coords = None
     if message.location:
-        city = resolve_city_from_coords(message.location.latitude, message.location.longitude)
+        coords = (message.location.latitude, message.location.longitude)
+        city = resolve_city_from_coords(message.location.latitude, message.location.longitude, allow_stale=True)
         if not city:
             error_reply("error_city_not_found_coords")
             return
@@ -1437,7 +1561,8 @@ def process_new_city_registration(message):
         return
 
     # --- УСПЕХ ---
-    update_user_city(user_id, city, message.from_user.username)
+    update_user_city(user_id, city, message.from_user.username, coords=coords)
+    city = getattr(get_user(user_id), "preferred_city", None) or city  # Каноническое название города
     
     if flow == "chg":
         success_text = get_text("citypick_success_chg", lang).format(city=city)
@@ -1459,7 +1584,8 @@ def process_new_city_registration(message):
     send_main_menu(chat_id)
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data in ("open_settings", "back_to_settings"))
+# "back_to_settings" обслуживает back_to_settings_callback (зарегистрирован раньше)
+@callback_route("open_settings")
 def open_settings_callback(call):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id)
@@ -1478,7 +1604,7 @@ def open_settings_callback(call):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data in ["change_temp_unit", "change_pressure_unit", "change_wind_speed_unit"])
+@callback_route("change_temp_unit", "change_pressure_unit", "change_wind_speed_unit")
 def change_unit_menu(call):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
@@ -1523,7 +1649,7 @@ def change_unit_menu(call):
 
 
 @safe_execute
-@bot.callback_query_handler(func=lambda call: call.data.startswith("set_"))
+@callback_route(prefix="set_")
 def set_unit(call):
     """Изменяет единицы измерения и обновляет inline-клавиатуру."""
     user_id = call.from_user.id
@@ -1625,11 +1751,30 @@ def get_menu_actions(lang="ru"):
         get_text("menu_change_city", lang): cmd_changecity,
         get_text("menu_notifications", lang): notification_settings,
         get_text("menu_back", lang): settings_back_to_main_menu,
-        get_text("menu_units", lang): lambda msg: format_settings(msg),
+        get_text("menu_units", lang): format_settings,
         get_text("menu_weather_data", lang): weather_data_settings,
         get_text("menu_language", lang): language_settings,
     }
 
+
+def build_menu_actions_index():
+    """
+    Собирает при старте единый индекс "текст кнопки -> действие" по всем языкам,
+    чтобы handle_all_messages делал один поиск в словаре вместо перебора фильтров.
+    """
+    index = {}
+    for lang in TEXTS:
+        for label, action in get_menu_actions(lang).items():
+            if label in index and index[label] is not action:
+                bot_logger.warning(f"Кнопка меню '{label}' ({lang}) уже привязана к другому действию.")
+                continue
+            index[label] = action
+    bot_logger.debug(f"Индекс меню построен: {len(index)} подписей кнопок.")
+    return index
+
+
+MENU_ACTIONS_INDEX = build_menu_actions_index()
+
 if __name__ == '__main__':
     bot_logger.info("Бот запущен.")
     clear_old_updates()
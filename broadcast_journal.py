@@ -0,0 +1,67 @@
+# ЖУРНАЛ РАССЫЛОК (таблица broadcast_journal).
+# Во время рассылки статусы отправки пишутся пачками по JOURNAL_FLUSH_SIZE. Если таймер упал или
+# был передеплоен посреди рассылки, при следующем запуске пользователи со статусом "sent" в своём
+# слоте пропускаются — рассылка продолжается с места остановки без повторных сообщений.
+# Когда пользователю назначен следующий слот, его записи больше не нужны и удаляются (compact_slot).
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from models import BroadcastJournal
+
+SENT = "sent"
+FAILED = "failed"
+
+JOURNAL_FLUSH_SIZE = 20  # Столько статусов копится в памяти — это и есть окно возможных дублей
+JOURNAL_RETENTION = timedelta(days=1)  # Записи старше этого удаляются в любом случае
+
+
+def sent_in_slot(db, job, slots):
+    """slots — {user_id: слот}. Возвращает user_id, которым их слот уже отправлен."""
+    if not slots:
+        return set()
+    rows = (
+        db.query(BroadcastJournal.user_id, BroadcastJournal.slot)
+        .filter(
+            BroadcastJournal.job == job,
+            BroadcastJournal.status == SENT,
+            BroadcastJournal.user_id.in_(list(slots))
+        )
+        .all()
+    )
+    return {user_id for user_id, slot in rows if slots.get(user_id) == slot}
+
+
+def record_statuses(db, job, entries):
+    """
+    Записывает пачку статусов [(user_id, слот, статус)] одним DELETE и одним INSERT
+    (повторная попытка в том же слоте перезаписывает прежний статус). Коммит — за вызывающим.
+    """
+    if not entries:
+        return
+    db.query(BroadcastJournal).filter(
+        BroadcastJournal.job == job,
+        BroadcastJournal.user_id.in_([user_id for user_id, _, _ in entries])
+    ).delete(synchronize_session=False)
+    updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    db.execute(insert(BroadcastJournal), [
+        {"job": job, "slot": slot, "user_id": user_id, "status": status, "updated_at": updated_at}
+        for user_id, slot, status in entries
+    ])
+
+
+def compact_slot(db, job, user_ids):
+    """Удаляет записи пользователей, которым уже назначен следующий слот."""
+    if not user_ids:
+        return
+    db.query(BroadcastJournal).filter(
+        BroadcastJournal.job == job,
+        BroadcastJournal.user_id.in_(list(user_ids))
+    ).delete(synchronize_session=False)
+
+
+def compact_expired(db, now=None):
+    """Удаляет записи старше JOURNAL_RETENTION (пользователи удалены, шард сменил владельца и т. п.)."""
+    cutoff = (now or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(tzinfo=None) - JOURNAL_RETENTION
+    return db.query(BroadcastJournal).filter(BroadcastJournal.updated_at < cutoff).delete(synchronize_session=False)
@@ -1,19 +1,28 @@
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, Session, load_only
+from sqlalchemy import create_engine, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
 from sqlalchemy.pool import QueuePool
 from telebot import types
-from weather import fetch_today_forecast, fetch_weekly_forecast, fetch_tomorrow_forecast, get_city_timezone
-from models import User, LocalVars
-from datetime import date, timedelta, datetime, timezone
+from weather import (
+    fetch_today_forecast, fetch_weekly_forecast, fetch_tomorrow_forecast, get_city_timezone, parse_forecast_columns,
+    get_weather, coord_key, canonical_coords,
+    DaySummary
+)
+from models import User, LocalVars, Location
+from datetime import date, time as dt_time, timedelta, datetime, timezone
 from zoneinfo import ZoneInfo
 from texts import TEXTS, get_api_lang_code 
-from collections import Counter
+from collections import Counter, OrderedDict
+from dataclasses import replace
+from operator import attrgetter
 from datetime import datetime
 
+import numpy as np
 import os
 import logging
 import importlib
+import hashlib
 import json
 import threading
 
@@ -50,6 +59,8 @@ def update_user(user_id: int, **kwargs):
         if hasattr(user, key):
             logging.debug(f"Обновление поля {key} для пользователя {user_id}: {value}")
             setattr(user, key, value)
+    if DAILY_FORECAST_FIELDS.intersection(kwargs):
+        schedule_daily_forecast(user)
     try:
         db.commit()
         logging.debug(f"Обновление пользователя {user_id} успешно завершено с параметрами {kwargs}.")  # Логирование успешного обновления
@@ -75,6 +86,7 @@ def initialize_json_from_db():
         "last_format_settings_menu": {},
         "last_bot_message": {},
         "last_daily_forecast": {},
+        "last_daily_forecast_hash": {},
         "last_weather_update": {},
         "stop_event": False
     }
@@ -87,6 +99,7 @@ def initialize_json_from_db():
         data["last_format_settings_menu"][uid] = vars_row.last_format_settings_menu
         data["last_bot_message"][uid] = vars_row.last_bot_message
         data["last_daily_forecast"][uid] = vars_row.last_daily_forecast
+        data["last_daily_forecast_hash"][uid] = vars_row.last_daily_forecast_hash
         data["last_weather_update"][uid] = vars_row.last_weather_update
 
     save_data(data)
@@ -107,6 +120,7 @@ def sync_json_to_db(user_id):
     local_vars.last_format_settings_menu = data.get("last_format_settings_menu", {}).get(str(user_id))
     local_vars.last_bot_message = data.get("last_bot_message", {}).get(str(user_id))
     local_vars.last_daily_forecast = data.get("last_daily_forecast", {}).get(str(user_id))
+    local_vars.last_daily_forecast_hash = data.get("last_daily_forecast_hash", {}).get(str(user_id))
     local_vars.last_weather_update = data.get("last_weather_update", {}).get(str(user_id))
 
     db.add(local_vars)
@@ -148,6 +162,7 @@ def save_user(user_id, username=None, preferred_city=None):
             preferred_city=preferred_city,
             timezone=timezone
         )
+        schedule_daily_forecast(user)
         db.add(user)
         db.commit()
         logging.debug(f"Пользователь с ID {user_id} ({username}) добавлен с unique_id {new_unique_id}.")
@@ -155,6 +170,7 @@ def save_user(user_id, username=None, preferred_city=None):
         if preferred_city:
             user.preferred_city = preferred_city
             user.timezone = get_city_timezone(preferred_city) or user.timezone 
+            schedule_daily_forecast(user)
         if username:
             user.username = username
         db.commit()
@@ -162,6 +178,33 @@ def save_user(user_id, username=None, preferred_city=None):
     db.close()
 
 
+#ОЧЕРЕДЬ УТРЕННИХ ПРОГНОЗОВ
+# У каждого пользователя хранится момент следующей рассылки (UTC), таймер берёт только наступившие
+DAILY_FORECAST_TIME = dt_time(6, 0)
+DAILY_FORECAST_DEFAULT_TZ = "Asia/Almaty"  # Пользователям без часового пояса утро считается, как и раньше, по Алматы
+DAILY_FORECAST_FIELDS = {"notifications_settings", "timezone", "preferred_city"}
+
+def next_daily_forecast_at(user, now=None):
+    """
+    Ближайшие DAILY_FORECAST_TIME по местному времени пользователя (naive UTC, как хранится в БД)
+    или None, если утренняя рассылка ему не нужна.
+    """
+    settings = decode_notification_settings(user.notifications_settings)
+    if not user.preferred_city or not settings.get("forecast_notifications", False):
+        return None
+
+    tz = get_user_timezone(user) if user.timezone else ZoneInfo(DAILY_FORECAST_DEFAULT_TZ)
+    local_now = (now or datetime.now(timezone.utc)).astimezone(tz)
+    fire_at = datetime.combine(local_now.date(), DAILY_FORECAST_TIME, tzinfo=tz)
+    if fire_at <= local_now:
+        fire_at = datetime.combine(local_now.date() + timedelta(days=1), DAILY_FORECAST_TIME, tzinfo=tz)
+    return fire_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+def schedule_daily_forecast(user, now=None):
+    """Пересчитывает next_forecast_at — при смене часового пояса, города, настроек и после отправки."""
+    user.next_forecast_at = next_daily_forecast_at(user, now)
+
+
 #ДЕКОДЕРЫ БД
 def decode_tracked_params(tracked_params):
     """Декодирует JSON-строку или возвращает словарь, иначе — значение по умолчанию."""
@@ -227,7 +270,9 @@ def save_data(data):
 
 #ОБЩЕЕ ХРАНИЛИЩЕ СЛОВАРЕЙ
 DATA_FILE = "data_store.json"
-_lock = threading.Lock()
+# Реентерабельный: чтение-изменение-запись держит его целиком, а load_data/save_data берут его внутри.
+# Задачи таймера идут в параллельных потоках и пишут одни и те же словари.
+_lock = threading.RLock()
 if not os.path.exists(DATA_FILE):
     initialize_json_from_db()
     if not os.path.exists(DATA_FILE): 
@@ -238,6 +283,7 @@ if not os.path.exists(DATA_FILE):
                 "last_bot_message": {},
                 "last_user_command": {},
                 "last_daily_forecast": {},
+                "last_daily_forecast_hash": {},
                 "last_format_settings_menu": {},
                 "last_weather_update": {},
                 "stop_event": False
@@ -252,33 +298,69 @@ def get_data(key):
 
 def set_data(key, value, user_id=None):
     """Устанавливает значение и сохраняет для указанного пользователя."""
-    data = load_data()
-    if user_id is not None:
-        if key not in data:
-            data[key] = {}
-        data[key][str(user_id)] = value
-    else:
-        data[key] = value
-    save_data(data)
+    with _lock:
+        data = load_data()
+        if user_id is not None:
+            if key not in data:
+                data[key] = {}
+            data[key][str(user_id)] = value
+        else:
+            data[key] = value
+        save_data(data)
     if user_id is not None:
         sync_json_to_db(user_id)
 
 def update_data_field(dict_key, sub_key, value):
     """Обновляет поле внутри словаря и синхронизирует с БД"""
-    data = load_data()
-    if dict_key not in data:
-        data[dict_key] = {}
-    data[dict_key][str(sub_key)] = value
-    save_data(data)
+    with _lock:
+        data = load_data()
+        if dict_key not in data:
+            data[dict_key] = {}
+        data[dict_key][str(sub_key)] = value
+        save_data(data)
     sync_json_to_db(int(sub_key))  
 
 
+def update_data_fields(sub_key, values):
+    """Обновляет сразу несколько полей пользователя за одну запись файла и одну синхронизацию с БД."""
+    with _lock:
+        data = load_data()
+        for dict_key, value in values.items():
+            data.setdefault(dict_key, {})[str(sub_key)] = value
+        save_data(data)
+    sync_json_to_db(int(sub_key))
+
+
 def get_data_field(dict_key, sub_key):
     """Получает значение конкретного поля из словаря в хранилище."""
     data = load_data()
     return data.get(dict_key, {}).get(str(sub_key))
 
 
+#ХЕШ ЗАКРЕПЛЁННОГО ПРОГНОЗА
+def forecast_message_hash(text):
+    """Хеш отрендеренного текста прогноза — по нему видно, изменилось ли содержимое."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def is_daily_forecast_unchanged(user_id, text):
+    """True, если закреплённый прогноз уже показывает ровно этот текст."""
+    return get_data_field("last_daily_forecast_hash", user_id) == forecast_message_hash(text)
+
+
+def remember_daily_forecast(user_id, text, message_id=None):
+    """Запоминает хеш показанного прогноза (и ID сообщения, если оно новое)."""
+    values = {"last_daily_forecast_hash": forecast_message_hash(text)}
+    if message_id is not None:
+        values["last_daily_forecast"] = message_id
+    update_data_fields(user_id, values)
+
+
+def is_message_not_modified_error(error):
+    """Telegram отвечает так, когда текст при редактировании не изменился."""
+    return "message is not modified" in str(error)
+
+
 def is_stop_event_set():
     """Проверяет, установлен ли stop_event."""
     return get_data("stop_event")
@@ -304,6 +386,52 @@ def get_all_users(filter_notifications=True):
 
     return users
 
+
+# Колонки, которых достаточно рассылкам: профиль, титулы и прочее не загружаются
+BROADCAST_COLUMNS = (
+    User.id, User.user_id, User.preferred_city, User.latitude, User.longitude, User.location_id,
+    User.next_forecast_at, User.notifications_settings, User.timezone, User.tracked_weather_params,
+    User.temp_unit, User.pressure_unit, User.wind_speed_unit, User.language
+)
+USER_BATCH_SIZE = 1000
+
+def iter_user_batches(*criteria, batch_size=USER_BATCH_SIZE):
+    """
+    Перебирает пользователей пачками по первичному ключу (id > последнего в пачке), загружая
+    только BROADCAST_COLUMNS. Каждая пачка читается короткой сессией: в памяти не больше
+    batch_size строк, а между пачками можно сколько угодно ходить в сеть — открытый
+    серверный курсор на время рассылки MySQL оборвал бы по net_write_timeout.
+    Объекты отсоединены от сессии; изменения сохраняются отдельно (save_daily_schedule).
+    """
+    last_id = 0
+    while True:
+        with SessionLocal() as db:
+            batch = (
+                db.query(User)
+                .options(load_only(*BROADCAST_COLUMNS))
+                .filter(User.id > last_id, *criteria)
+                .order_by(User.id)
+                .limit(batch_size)
+                .all()
+            )
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+
+def iter_users(*criteria, batch_size=USER_BATCH_SIZE):
+    """Потоковый перебор пользователей по одному (см. iter_user_batches)."""
+    for batch in iter_user_batches(*criteria, batch_size=batch_size):
+        yield from batch
+
+def save_daily_schedule(db, users):
+    """Сохраняет next_forecast_at отсоединённых пользователей одним UPDATE по первичному ключу."""
+    rows = [{"id": user.id, "next_forecast_at": user.next_forecast_at} for user in users]
+    if rows:
+        db.execute(update(User), rows)
+
 #ИЗМЕНЕНИЕ ЕДИНИЦ ИЗМЕРЕНИЯ
 def update_user_unit(user_id, unit_type, new_value):
     logging.debug(f"update_user_unit вызван с user_id={user_id}, unit_type={unit_type}, new_value={new_value}")
@@ -338,48 +466,149 @@ def toggle_user_notifications(user_id, new_status):
         return settings["forecast_notifications"]
 
 #ОБНОВЛЕНИЕ ГОРОДА ПОЛЬЗОВАТЕЛЯ
-def update_user_city(user_id, city, username=None):
-    """Обновляет город и часовой пояс пользователя в БД."""
+def get_user_coords(user):
+    """Координаты города пользователя (lat, lon) или None, если они ещё не определены."""
+    latitude = getattr(user, "latitude", None)
+    longitude = getattr(user, "longitude", None)
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude
+
+def resolve_location(db, city, coords=None):
+    """
+    Находит или создаёт каноническое местоположение (Location) для города.
+    Совпадение ищется по id города в OpenWeather, затем по округлённым координатам,
+    поэтому "Almaty", "Алматы" и "almaty" сводятся к одной записи.
+    """
+    reading = get_weather(city, lang="ru", coords=coords)
+    if not reading:
+        return None
+
+    location = find_location(db, reading.city_id, coord_key(reading.lat, reading.lon))
+    if location is None:
+        latitude, longitude = canonical_coords(reading.lat, reading.lon)
+        location = Location(
+            owm_city_id=reading.city_id,
+            coord_key=coord_key(reading.lat, reading.lon),
+            latitude=latitude,
+            longitude=longitude,
+            name=reading.city_name
+        )
+        # Тот же город мог одновременно создать другой пользователь (или бэкфилл) — тогда
+        # вставка нарушит уникальность id OpenWeather/координат: откатываем только её и берём готовую запись
+        try:
+            with db.begin_nested():
+                db.add(location)
+                db.flush()
+        except IntegrityError:
+            location = find_location(db, reading.city_id, coord_key(reading.lat, reading.lon))
+            logging.info(f"Местоположение {reading.city_name} уже создано параллельно, id={location and location.id}.")
+        else:
+            logging.info(f"Новое местоположение {location.name} ({location.coord_key}), id={location.id}.")
+    return location
+
+def find_location(db, owm_city_id, key):
+    """Существующее местоположение по id города в OpenWeather или по ключу координат."""
+    location = None
+    if owm_city_id:
+        location = db.query(Location).filter(Location.owm_city_id == owm_city_id).first()
+    if location is None:
+        location = db.query(Location).filter(Location.coord_key == key).first()
+    return location
+
+def update_user_city(user_id, city, username=None, coords=None):
+    """
+    Обновляет город, его каноническое местоположение и часовой пояс пользователя в БД.
+    coords — точные координаты (геолокация); иначе город геокодируется по названию.
+    Введённое название служит только ключом поиска: сохраняется и показывается
+    каноническое Location.name, а если город не найден — введённое как есть.
+    """
+    city = " ".join(city.split())
     with SessionLocal() as db:  # Используем контекстный менеджер для автоматического закрытия сессии
         user = db.query(User).filter(User.user_id == user_id).first()
+        # Геолокация в том же городе всё равно уточняет координаты и местоположение
+        if user and user.preferred_city == city and coords is None:
+            return False
+        location = resolve_location(db, city, coords)
+        if user and location and user.location_id == location.id and coords is None:
+            return False  # Тот же город, написанный иначе
+        display_city = location.name if location else city
         if user:
-            if user.preferred_city == city:
-                return False
-            user.preferred_city = city
+            user.preferred_city = display_city
             user.timezone = get_city_timezone(city) or "UTC"
         else:
             user = User(
                 user_id=user_id,
                 username=username,
-                preferred_city=city,
+                preferred_city=display_city,
                 timezone=get_city_timezone(city) or "UTC"
             )
             db.add(user)
+        if location:
+            user.location_id = location.id
+            user.latitude, user.longitude = location.latitude, location.longitude
+        else:
+            user.location_id = None
+            user.latitude, user.longitude = coords or (None, None)
+        schedule_daily_forecast(user)
         db.commit()
-        logging.info(f"Пользователь {user_id}: город обновлён на {city}, часовой пояс — {user.timezone}.")
+        logging.info(f"Пользователь {user_id}: город обновлён на {display_city}, часовой пояс — {user.timezone}.")
         return True
 
 #КОНВЕРТАЦИЯ ЕДИНИЦ ИЗМЕРЕНИЯ
+# Таблицы строятся один раз; формулы работают и с числами, и с массивами NumPy
+TEMPERATURE_CONVERSIONS = {
+    "C": lambda value: value,
+    "F": lambda value: value * 9/5 + 32,
+    "K": lambda value: value + 273.15,
+    "ICE": lambda value: -value / 18,
+}
+PRESSURE_FACTORS = {"mmHg": 0.75006, "mbar": 1, "hPa": 1, "inHg": 0.02953}
+WIND_SPEED_FACTORS = {"m/s": 1, "km/h": 3.6, "mph": 2.23694}
+# Поля прогноза, которые зависят от единиц пользователя, и тип их единиц
+FORECAST_UNIT_FIELDS = {
+    "temp": "temp", "temp_min": "temp", "temp_max": "temp", "feels_like": "temp",
+    "pressure": "pressure", "wind_speed": "wind_speed", "wind_gust": "wind_speed",
+}
+
+
+def convert_temperature_array(values, unit):
+    """Переводит массив температур (°C) в нужную единицу."""
+    converted = TEMPERATURE_CONVERSIONS[unit](np.asarray(values, dtype=float))
+    return np.round(converted, 1) if unit == "ICE" else converted
+
+def convert_pressure_array(values, unit):
+    """Переводит массив давлений (гПа) в нужную единицу."""
+    return np.round(np.asarray(values, dtype=float) * PRESSURE_FACTORS[unit], 1)
+
+def convert_wind_speed_array(values, unit):
+    """Переводит массив скоростей ветра (м/с) в нужную единицу."""
+    return np.round(np.asarray(values, dtype=float) * WIND_SPEED_FACTORS[unit], 1)
+
+def convert_all_units(values, kind):
+    """
+    Переводит массив сразу во все единицы своего типа:
+    kind = "temp" | "pressure" | "wind_speed" -> {единица: массив}.
+    """
+    if kind == "temp":
+        return {unit: convert_temperature_array(values, unit) for unit in TEMPERATURE_CONVERSIONS}
+    if kind == "pressure":
+        return {unit: convert_pressure_array(values, unit) for unit in PRESSURE_FACTORS}
+    if kind == "wind_speed":
+        return {unit: convert_wind_speed_array(values, unit) for unit in WIND_SPEED_FACTORS}
+    raise ValueError(f"Неизвестный тип единиц: {kind}")
+
 def convert_temperature(value, unit):
-    logging.debug(f"Converting {value} to {unit}")
-    if unit == "C":
-        return value
-    elif unit == "F":
-        return value * 9/5 + 32
-    elif unit == "K":
-        return value + 273.15
-    elif unit == "ICE":
-        return round(-value / 18, 1)
+    convert = TEMPERATURE_CONVERSIONS.get(unit)
+    if convert is None:
+        return None
+    return round(convert(value), 1) if unit == "ICE" else convert(value)
 
 def convert_pressure(value, unit):
-    logging.debug(f"Converting {value} to {unit}")
-    conversions = {"mmHg": 0.75006, "mbar": 1, "hPa": 1, "inHg": 0.02953}
-    return round(value * conversions[unit], 1)
+    return round(value * PRESSURE_FACTORS[unit], 1)
 
 def convert_wind_speed(value, unit):
-    logging.debug(f"Converting {value} to {unit}")
-    conversions = {"m/s": 1, "km/h": 3.6, "mph": 2.23694}
-    return round(value * conversions[unit], 1)
+    return round(value * WIND_SPEED_FACTORS[unit], 1)
 
 def get_wind_direction(degree, lang="ru"):
     degree %= 360
@@ -649,207 +878,211 @@ def is_valid_command(text):
 
 #ПОЛУЧЕНИЕ ПОГОДНЫХ ДАННЫХ
 def extract_weather_data(entry):
-    """Извлекает погодные данные из записи API"""
-    temp = entry["main"]["temp"]
-    feels_like = entry["main"].get("feels_like", temp)
-    temp_min = entry["main"].get("temp_min", temp)
-    temp_max = entry["main"].get("temp_max", temp)
-    feels_like = entry["main"].get("feels_like", None)
-    humidity = entry["main"].get("humidity", None)
-    visibility = entry.get("visibility", None)
-    pressure = entry["main"].get("pressure", None)
-    wind_speed = entry["wind"].get("speed", None)
-    wind_direction = entry["wind"].get("deg", None)
-    wind_gust = entry["wind"].get("gust", None)
-    clouds = entry["clouds"].get("all", None)
-    description = entry["weather"][0]["description"].capitalize()
-    precipitation = entry.get("pop", None)
-
-    weather_data = {
-        "temp": temp,
-        "feels_like": feels_like,
-        "temp_min": temp_min,
-        "temp_max": temp_max,
-        "feels_like": feels_like,
-        "humidity": humidity,
-        "visibility": visibility,
-        "pressure": pressure,
-        "wind_speed": wind_speed,
-        "wind_direction": wind_direction,
-        "wind_gust": wind_gust,
-        "clouds": clouds,
-        "description": description,
-        "precipitation": round(precipitation * 100) if precipitation is not None else None
-    }
-
+    """Погодные данные слота прогноза в виде для вывода (описание с заглавной буквы)"""
+    weather_data = replace(entry, description=entry.description.capitalize())
     logging.debug(f"Извлечённые погодные данные: {weather_data}")
     return weather_data
 
 
+#РАЗБИВКА 3-ЧАСОВОГО ПРОГНОЗА ПО ДНЯМ
+DAY_BUCKETS_CACHE_SIZE = 256
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_day_buckets_cache = OrderedDict()
+_day_buckets_lock = threading.Lock()
+
+
+def get_user_timezone(user):
+    """Часовой пояс пользователя (UTC, если не задан или некорректен)."""
+    try:
+        return ZoneInfo(user.timezone) if user.timezone else ZoneInfo("UTC")
+    except Exception:
+        return ZoneInfo("UTC")
+
+
+def _utc_offsets(timestamps, tz):
+    """Смещения часового пояса (сек) для массива UTC-timestamp'ов."""
+    first = datetime.fromtimestamp(int(timestamps[0]), tz).utcoffset().total_seconds()
+    last = datetime.fromtimestamp(int(timestamps[-1]), tz).utcoffset().total_seconds()
+    if first == last:
+        # Перехода на летнее/зимнее время внутри прогноза нет — смещение одно на всех
+        return np.full(len(timestamps), int(first), dtype=np.int64)
+    return np.fromiter(
+        (datetime.fromtimestamp(int(ts), tz).utcoffset().total_seconds() for ts in timestamps),
+        dtype=np.int64, count=len(timestamps)
+    )
+
+
+def aggregate_days_columnar(columns, tz):
+    """
+    Векторная агрегация колонок прогноза по локальным дням (min/max/mean/argmax через reduceat).
+    Возвращает OrderedDict: дата -> агрегаты и срез индексов исходных записей.
+    """
+    timestamps = columns["dt"]
+    if not len(timestamps):
+        return OrderedDict()
+
+    day_numbers = (timestamps + _utc_offsets(timestamps, tz)) // 86400
+    starts = np.flatnonzero(np.r_[True, day_numbers[1:] != day_numbers[:-1]])
+    ends = np.r_[starts[1:], len(timestamps)]
+    counts = ends - starts
+
+    temp_min = np.minimum.reduceat(columns["temp"], starts).tolist()
+    temp_max = np.maximum.reduceat(columns["temp"], starts).tolist()
+    temp_mean = (np.add.reduceat(columns["temp"], starts) / counts).tolist()
+    feels_mean = (np.add.reduceat(columns["feels_like"], starts) / counts).tolist()
+    humidity_mean = (np.add.reduceat(columns["humidity"], starts) / counts).tolist()
+    wind_max = np.maximum.reduceat(columns["wind_speed"], starts).tolist()
+    gust_max = np.maximum.reduceat(columns["wind_gust"], starts).tolist()
+    pop_max = np.maximum.reduceat(columns["pop"], starts).tolist()
+    # Момент максимальной вероятности осадков внутри дня
+    pop_peak = [
+        int(timestamps[start + np.argmax(columns["pop"][start:end])])
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ]
+
+    days = OrderedDict()
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        visibility = columns["visibility"][start]
+        days[date.fromordinal(int(day_numbers[start]) + EPOCH_ORDINAL)] = {
+            'start': start,
+            'end': end,
+            'temp_min': temp_min[i],
+            'temp_max': temp_max[i],
+            'temp': temp_mean[i],
+            'feels_like': feels_mean[i],
+            'humidity': humidity_mean[i],
+            'wind_speed': wind_max[i],
+            'wind_gust': gust_max[i],
+            'precipitation': int(pop_max[i] * 100),
+            'precipitation_peak_dt': pop_peak[i],
+            'descriptions': columns["descriptions"][start:end],
+            'pressure': int(columns["pressure"][start]),  # Берем первое доступное
+            'clouds': int(columns["clouds"][start]),
+            'visibility': 10000 if np.isnan(visibility) else int(visibility),
+            'wind_direction': int(columns["wind_deg"][start]),
+        }
+    return days
+
+
+def bucket_forecast_by_day(raw_data, tz):
+    """
+    Разбивает 3-часовой прогноз по локальным дням: payload раскладывается по колонкам
+    NumPy и агрегируется векторно. У каждого дня есть 'items' — исходные записи дня.
+    Результат кэшируется на пару (payload, часовой пояс).
+    """
+    cache_key = (id(raw_data), str(tz))
+    with _day_buckets_lock:
+        cached = _day_buckets_cache.get(cache_key)
+        # Храним ссылку на сам payload, чтобы id() не мог достаться другому списку
+        if cached is not None and cached[0] is raw_data:
+            _day_buckets_cache.move_to_end(cache_key)
+            return cached[1]
+
+    items = sorted(raw_data, key=attrgetter('dt'))
+    days = aggregate_days_columnar(parse_forecast_columns(items), tz)
+    for day in days.values():
+        day['items'] = items[day['start']:day['end']]
+
+    with _day_buckets_lock:
+        _day_buckets_cache[cache_key] = (raw_data, days)
+        while len(_day_buckets_cache) > DAY_BUCKETS_CACHE_SIZE:
+            _day_buckets_cache.popitem(last=False)
+    return days
+
+
+def summarize_day(day, date_label):
+    """Сводка по одному дню в формате, который ожидает format_forecast."""
+    return DaySummary(
+        date=date_label,
+        temp_min=day['temp_min'],
+        temp_max=day['temp_max'],
+        temp=day['temp'],
+        feels_like=day['feels_like'],
+        humidity=day['humidity'],
+        wind_speed=day['wind_speed'],
+        precipitation=day['precipitation'],
+        descriptions=list(day['descriptions']),
+        pressure=day['pressure'],
+        clouds=day['clouds'],
+        visibility=day['visibility'],
+        wind_direction=day['wind_direction'],
+        wind_gust=day['wind_gust']
+    )
+
+
 #ПОЛУЧЕНИЕ ПРОГНОЗА ПОГОДЫ
-def get_today_forecast(city, user):
+def get_today_forecast(city, user, raw_data=None):
     """
     Получает прогноз на СЕГОДНЯ, агрегируя 3-часовые интервалы.
+    raw_data — уже загруженный прогноз, чтобы не запрашивать его повторно.
     """
     lang = get_user_lang(user)
-    raw_data = fetch_today_forecast(city, lang)
+    if raw_data is None:
+        raw_data = fetch_today_forecast(city, lang, coords=get_user_coords(user))
     if not raw_data: 
         return None
         
-    tz = ZoneInfo(user.timezone) if user.timezone else ZoneInfo("UTC")
+    tz = get_user_timezone(user)
     now = datetime.now(tz)
-    today_str = now.strftime("%Y-%m-%d")
-    
-    # Фильтруем данные только за сегодня (по времени пользователя)
-    today_items = []
-    for item in raw_data:
-        # OpenWeatherMap дает dt (timestamp в UTC). Конвертируем в время юзера
-        dt_obj = datetime.fromtimestamp(item['dt'], tz)
-        if dt_obj.strftime("%Y-%m-%d") == today_str:
-            today_items.append(item)
-            
-    if not today_items:
+    day = bucket_forecast_by_day(raw_data, tz).get(now.date())
+    if not day:
         return None
-        
-    # Агрегация данных
-    temps = [item['main']['temp'] for item in today_items]
-    feels_like = [item['main']['feels_like'] for item in today_items]
-    humidities = [item['main']['humidity'] for item in today_items]
-    wind_speeds = [item['wind']['speed'] for item in today_items]
-    # pop = probability of precipitation (0..1)
-    pop = [item.get('pop', 0) for item in today_items]
-    
-    # Собираем все описания погоды
-    descriptions = [d['weather'][0]['description'] for d in today_items]
-    
-    return {
-        'date': now.strftime("%d.%m"), # Формат строго DD.MM для format_forecast
-        'temp_min': min(temps),
-        'temp_max': max(temps),
-        'temp': sum(temps) / len(temps),
-        'feels_like': sum(feels_like) / len(feels_like),
-        'humidity': sum(humidities) / len(humidities),
-        'wind_speed': max(wind_speeds),
-        'precipitation': int(max(pop) * 100),
-        'descriptions': descriptions,
-        'pressure': today_items[0]['main']['pressure'], # Берем первое доступное
-        'clouds': today_items[0]['clouds']['all'],
-        'visibility': today_items[0].get('visibility', 10000),
-        'wind_direction': today_items[0]['wind'].get('deg', 0),
-        'wind_gust': max([item['wind'].get('gust', 0) for item in today_items])
-    }
 
-def get_tomorrow_forecast(city, user):
+    return summarize_day(day, now.strftime("%d.%m"))  # Формат строго DD.MM для format_forecast
+
+def get_tomorrow_forecast(city, user, raw_data=None):
     """
     Получает прогноз на ЗАВТРА, агрегируя 3-часовые интервалы.
     """
     lang = get_user_lang(user)
-    raw_data = fetch_tomorrow_forecast(city, lang) # Обычно это тот же эндпоинт, что и today
+    if raw_data is None:
+        raw_data = fetch_tomorrow_forecast(city, lang, coords=get_user_coords(user)) # Обычно это тот же эндпоинт, что и today
     if not raw_data: 
         return None
 
-    tz = ZoneInfo(user.timezone) if user.timezone else ZoneInfo("UTC")
-    now = datetime.now(tz)
-    tomorrow = now + timedelta(days=1)
-    tomorrow_str = tomorrow.strftime("%Y-%m-%d")
-
-    # Фильтруем данные только за завтра
-    tomorrow_items = []
-    for item in raw_data:
-        dt_obj = datetime.fromtimestamp(item['dt'], tz)
-        if dt_obj.strftime("%Y-%m-%d") == tomorrow_str:
-            tomorrow_items.append(item)
-
-    if not tomorrow_items:
+    tz = get_user_timezone(user)
+    tomorrow = datetime.now(tz) + timedelta(days=1)
+    day = bucket_forecast_by_day(raw_data, tz).get(tomorrow.date())
+    if not day:
         return None
 
-    # Агрегация данных
-    temps = [item['main']['temp'] for item in tomorrow_items]
-    feels_like = [item['main']['feels_like'] for item in tomorrow_items]
-    humidities = [item['main']['humidity'] for item in tomorrow_items]
-    wind_speeds = [item['wind']['speed'] for item in tomorrow_items]
-    pop = [item.get('pop', 0) for item in tomorrow_items]
-    descriptions = [d['weather'][0]['description'] for d in tomorrow_items]
-
-    return {
-        'date': tomorrow.strftime("%d.%m"), # ВАЖНО: Формат DD.MM
-        'temp_min': min(temps),
-        'temp_max': max(temps),
-        'temp': sum(temps) / len(temps),
-        'feels_like': sum(feels_like) / len(feels_like),
-        'humidity': sum(humidities) / len(humidities),
-        'wind_speed': max(wind_speeds),
-        'precipitation': int(max(pop) * 100),
-        'descriptions': descriptions,
-        'pressure': tomorrow_items[0]['main']['pressure'],
-        'clouds': tomorrow_items[0]['clouds']['all'],
-        'visibility': tomorrow_items[0].get('visibility', 10000),
-        'wind_direction': tomorrow_items[0]['wind'].get('deg', 0),
-        'wind_gust': max([item['wind'].get('gust', 0) for item in tomorrow_items])
-    }
+    return summarize_day(day, tomorrow.strftime("%d.%m"))  # ВАЖНО: Формат DD.MM
 
-def get_weekly_forecast(city, user):
+def get_weekly_forecast(city, user, raw_data=None):
     """Прогноз погоды на неделю с учётом tracked_weather_params"""
     lang = get_user_lang(user)
-    raw_data = fetch_weekly_forecast(city, lang=lang)
+    if raw_data is None:
+        raw_data = fetch_weekly_forecast(city, lang=lang, coords=get_user_coords(user))
     if not raw_data:
         return None  
         
-    lang = get_user_lang(user)
-    daily_data = {}
-    
-    # Используем таймзону пользователя для определения "сегодня", если она есть
-    try:
-        user_tz = ZoneInfo(user.timezone) if user.timezone else timezone.utc
-    except:
-        user_tz = timezone.utc
-        
-    today = datetime.now(user_tz).date()
-    start_date = today + timedelta(days=1)
+    user_tz = get_user_timezone(user)
+    start_date = datetime.now(user_tz).date() + timedelta(days=1)
     
     months = get_translation_dict("months", lang)
     weekdays = get_translation_dict("weekdays", lang)
     tracked_params = decode_tracked_params(getattr(user, 'tracked_weather_params', 0))
 
-    for entry in raw_data:
-        timestamp = entry["dt"] 
-        date_obj = datetime.fromtimestamp(timestamp, tz=timezone.utc).astimezone(user_tz).date()
-
+    result = []
+    for date_obj, day in bucket_forecast_by_day(raw_data, user_tz).items():
         if date_obj < start_date or (date_obj - start_date).days >= 5:
             continue
-            
-        if "main" not in entry or "temp" not in entry["main"]:
-            logging.error(f"❌ Ошибка: в данных нет 'main' или 'temp'! {entry}")
-            continue
-            
-        weather_data = extract_weather_data(entry)
-        
-        if date_obj not in daily_data:
-            day_name = weekdays.get(date_obj.strftime("%A"), date_obj.strftime("%A"))
-            daily_data[date_obj] = {
-                "day_name": day_name,
-                "descriptions": [], 
-                **{
-                    key: value for key, value in weather_data.items() 
-                    if tracked_params.get(key, False) and value is not None
-                }
-            }
-        
-        current_temp = weather_data["temp"]
-        daily_data[date_obj]["temp_min"] = min(daily_data[date_obj].get("temp_min", float("inf")), current_temp)
-        daily_data[date_obj]["temp_max"] = max(daily_data[date_obj].get("temp_max", float("-inf")), current_temp)
-        
-        if "weather" in entry and entry["weather"]:
-            daily_data[date_obj]["descriptions"].append(entry["weather"][0]["description"])
-
-    return [
-        {
-            "date": f"{d.day} {months.get(d.month, '')}",
-            "day_name": data["day_name"],
-            **data
-        }
-        for d, data in sorted(daily_data.items())
-    ]
+
+        weather_data = extract_weather_data(day['items'][0])
+        day_name = weekdays.get(date_obj.strftime("%A"), date_obj.strftime("%A"))
+        result.append({
+            "date": f"{date_obj.day} {months.get(date_obj.month, '')}",
+            "day_name": day_name,
+            **{
+                key: value for key, value in weather_data.as_dict().items()
+                if tracked_params.get(key, False) and value is not None
+            },
+            "descriptions": list(day['descriptions']),
+            "temp_min": day['temp_min'],
+            "temp_max": day['temp_max'],
+        })
+
+    return result
 
 
 def get_forecast_emoji(description, lang="ru"):
@@ -909,10 +1142,7 @@ def group_bad_weather_periods(bad_weather_periods):
 def get_weather_summary_description(forecast_data, user):
     """Анализирует прогноз и выдает краткое, но честное резюме погоды."""
     lang = get_user_lang(user)
-    try:
-        tz = ZoneInfo(user.timezone or "UTC")
-    except Exception:
-        tz = ZoneInfo("UTC")
+    tz = get_user_timezone(user)
 
     now = datetime.now(tz)
     today = now.date()
@@ -922,15 +1152,14 @@ def get_weather_summary_description(forecast_data, user):
 
     # Собираем плохую погоду с фильтром по времени
     bad_weather_periods = []
-    for entry in forecast_data:
-        timestamp = datetime.fromtimestamp(entry["dt"], tz)
-        if timestamp.date() != today:
-            continue
+    today_bucket = bucket_forecast_by_day(forecast_data, tz).get(today) if forecast_data else None
+    for entry in (today_bucket['items'] if today_bucket else []):
+        timestamp = datetime.fromtimestamp(entry.dt, tz)
         if timestamp < now - timedelta(hours=1):
             continue
 
         # Приводим к формату для сравнения (Capitalize)
-        description = entry["weather"][0]["description"].capitalize()
+        description = entry.description.capitalize()
         
         # Проверяем, есть ли описание в списке "плохих"
         if description in bad_descriptions:
@@ -967,7 +1196,107 @@ def get_weather_summary_description(forecast_data, user):
 
     return get_text("weather_summary_clear", lang)
 
+#КЭШ РЕНДЕРА ПРОГНОЗОВ
+RENDER_CACHE_MAX_SIZE = 4096
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+render_cache_stats = {"hits": 0, "misses": 0}
+UNIT_COLUMNS_CACHE_MAX_SIZE = 1024
+_unit_columns_cache = OrderedDict()
+
+
+def weather_payload_id(weather_data):
+    """
+    Идентификатор содержимого прогноза: готовый payload_id, если его проставил источник,
+    иначе отпечаток самих значений.
+    """
+    payload_id = weather_data.get("payload_id")
+    if payload_id is not None:
+        return payload_id
+    if isinstance(weather_data, dict):
+        return hash(repr(sorted(weather_data.items())))
+    # Записи (CurrentReading/DaySummary) печатаются с полями в фиксированном порядке
+    return hash(repr(weather_data))
+
+
+def forecast_unit_columns(weather_data):
+    """
+    Значения прогноза сразу во всех единицах: {поле: {единица: значение}}.
+    Считаются векторно один раз на payload; рендеры для разных пользователей только берут готовые значения.
+    """
+    payload_id = weather_payload_id(weather_data)
+    with _render_cache_lock:
+        columns = _unit_columns_cache.get(payload_id)
+        if columns is not None:
+            _unit_columns_cache.move_to_end(payload_id)
+            return columns
+
+    columns = {}
+    for kind in ("temp", "pressure", "wind_speed"):
+        present = [name for name, field_kind in FORECAST_UNIT_FIELDS.items() if field_kind == kind and name in weather_data]
+        if not present:
+            continue
+        converted = convert_all_units([weather_data[name] for name in present], kind)
+        for i, name in enumerate(present):
+            columns[name] = {unit: float(values[i]) for unit, values in converted.items()}
+
+    with _render_cache_lock:
+        _unit_columns_cache[payload_id] = columns
+        while len(_unit_columns_cache) > UNIT_COLUMNS_CACHE_MAX_SIZE:
+            _unit_columns_cache.popitem(last=False)
+    return columns
+
+
+def user_render_key(user):
+    """Настройки пользователя, от которых зависит текст: язык, единицы и отслеживаемые параметры."""
+    tracked_params = decode_tracked_params(getattr(user, 'tracked_weather_params', 0))
+    tracked_mask = frozenset(key for key, enabled in tracked_params.items() if enabled)
+    return (get_user_lang(user), user.temp_unit, user.pressure_unit, user.wind_speed_unit, tracked_mask)
+
+
+def cached_render(kind, weather_data, user, extra, render):
+    """
+    Возвращает готовый текст из LRU-кэша или рендерит его через render().
+    Ключ: (вид сообщения, payload прогноза, настройки пользователя, extra).
+    """
+    key = (kind, weather_payload_id(weather_data), user_render_key(user), extra)
+    with _render_cache_lock:
+        text = _render_cache.get(key)
+        if text is not None:
+            _render_cache.move_to_end(key)
+            render_cache_stats["hits"] += 1
+            return text
+        render_cache_stats["misses"] += 1
+
+    text = render()
+
+    with _render_cache_lock:
+        _render_cache[key] = text
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_MAX_SIZE:
+            _render_cache.popitem(last=False)
+    return text
+
+
 def format_forecast(weather_data, user, title_text, summary_text=None, *, is_daily_forecast: bool = False):
+    """
+    Форматирует прогноз с кэшированием: пользователи с одинаковым городом и настройками
+    получают один и тот же отрендеренный текст.
+    """
+    if is_daily_forecast:
+        extra = (title_text, summary_text, True)
+    else:
+        # Дата/время в заголовке зависят от часового пояса и текущей минуты
+        tz_name = user.timezone or "UTC"
+        extra = (title_text, summary_text, False, tz_name, datetime.now(ZoneInfo(tz_name)).strftime("%Y%m%d%H%M"))
+
+    return cached_render(
+        "forecast", weather_data, user, extra,
+        lambda: render_forecast(weather_data, user, title_text, summary_text, is_daily_forecast=is_daily_forecast)
+    )
+
+
+def render_forecast(weather_data, user, title_text, summary_text=None, *, is_daily_forecast: bool = False):
     """
     Универсальная функция форматирования.
 
@@ -982,6 +1311,7 @@ def format_forecast(weather_data, user, title_text, summary_text=None, *, is_dai
 
     unit_trans = get_translation_dict("unit_translations", lang)
     labels = get_translation_dict("weather_data_labels", lang)
+    columns = forecast_unit_columns(weather_data)
 
     # ---- 1) Метрики ----
     metrics_lines = []
@@ -992,18 +1322,18 @@ def format_forecast(weather_data, user, title_text, summary_text=None, *, is_dai
 
         val_str = ""
         if "temp_min" in weather_data and "temp_max" in weather_data:
-            t_min = round(convert_temperature(weather_data['temp_min'], user.temp_unit))
-            t_max = round(convert_temperature(weather_data['temp_max'], user.temp_unit))
+            t_min = round(columns['temp_min'][user.temp_unit])
+            t_max = round(columns['temp_max'][user.temp_unit])
             val_str = f"{t_min}{unit}" if t_min == t_max else f"{t_min}{unit} ~ {t_max}{unit}"
         elif "temp" in weather_data:
-            val = round(convert_temperature(weather_data['temp'], user.temp_unit))
+            val = round(columns['temp'][user.temp_unit])
             val_str = f"{val}{unit}"
 
         if val_str:
             metrics_lines.append(f"▸ {label}: {val_str}")
 
     if tracked_params.get("feels_like", False) and "feels_like" in weather_data:
-        val = round(convert_temperature(weather_data['feels_like'], user.temp_unit))
+        val = round(columns['feels_like'][user.temp_unit])
         unit = unit_trans.get("temp", {}).get(user.temp_unit, "°C")
         label = labels.get("feels_like", "Ощущается как")
         metrics_lines.append(f"▸ {label}: {val}{unit}")
@@ -1017,19 +1347,19 @@ def format_forecast(weather_data, user, title_text, summary_text=None, *, is_dai
         metrics_lines.append(f"▸ {label}: {weather_data['precipitation']}%")
 
     if tracked_params.get("pressure", False) and "pressure" in weather_data:
-        val = round(convert_pressure(weather_data['pressure'], user.pressure_unit))
+        val = round(columns['pressure'][user.pressure_unit])
         unit = unit_trans.get("pressure", {}).get(user.pressure_unit, "mmHg")
         label = labels.get("pressure", "Давление")
         metrics_lines.append(f"▸ {label}: {val} {unit}")
 
     wind_unit = unit_trans.get("wind_speed", {}).get(user.wind_speed_unit, "m/s")
     if tracked_params.get("wind_speed", False) and "wind_speed" in weather_data:
-        val = round(convert_wind_speed(weather_data['wind_speed'], user.wind_speed_unit), 1)
+        val = round(columns['wind_speed'][user.wind_speed_unit], 1)
         label = labels.get("wind_speed", "Скорость ветра")
         metrics_lines.append(f"▸ {label}: {val} {wind_unit}")
 
     if tracked_params.get("wind_gust", False) and "wind_gust" in weather_data:
-        val = round(convert_wind_speed(weather_data['wind_gust'], user.wind_speed_unit), 1)
+        val = round(columns['wind_gust'][user.wind_speed_unit], 1)
         label = labels.get("wind_gust", "Порывы ветра")
         metrics_lines.append(f"▸ {label}: {val} {wind_unit}")
 
@@ -1118,82 +1448,26 @@ def format_forecast(weather_data, user, title_text, summary_text=None, *, is_dai
     return final_message
 
 
-def get_weekly_forecast_data(city, user):
+def get_weekly_forecast_data(city, user, raw_data=None):
     """
     Преобразует 3-часовой прогноз (список) в список сводок по дням.
-    Аналог get_today_forecast, но для всех дней сразу.
+    Использует ту же разбивку по дням, что и get_today_forecast.
     """
     lang = get_user_lang(user)
-    # Используем ту же функцию получения сырых данных
-    raw_data = fetch_today_forecast(city, lang) 
+    if raw_data is None:
+        raw_data = fetch_today_forecast(city, lang, coords=get_user_coords(user))
     
     if not raw_data:
         return []
 
-    # Словарь для группировки: "2023-10-25" -> [данные, данные...]
-    daily_groups = {}
-    
-    # Получаем таймзону пользователя, если есть, иначе UTC
-    tz = ZoneInfo(user.timezone) if user.timezone else timezone.utc
-    
-    for item in raw_data:
-        # Преобразуем timestamp в дату с учетом часового пояса
-        dt = datetime.fromtimestamp(item['dt'], tz)
-        date_key = dt.strftime('%Y-%m-%d')
-        
-        if date_key not in daily_groups:
-            daily_groups[date_key] = {
-                'temps': [],
-                'feels_like': [],
-                'descriptions': [],
-                'wind_speeds': [],
-                'humidities': [],
-                'pop': [], # Вероятность осадков
-                'dt_obj': dt
-            }
-        
-        daily_groups[date_key]['temps'].append(item['main']['temp'])
-        daily_groups[date_key]['feels_like'].append(item['main']['feels_like'])
-        daily_groups[date_key]['humidities'].append(item['main']['humidity'])
-        daily_groups[date_key]['wind_speeds'].append(item['wind']['speed'])
-        daily_groups[date_key]['pop'].append(item.get('pop', 0))
-        
-        if 'weather' in item and item['weather']:
-            daily_groups[date_key]['descriptions'].append(item['weather'][0]['description'])
+    weekdays_ru = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+    weekdays_en = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
     final_forecast = []
-    sorted_days = sorted(daily_groups.keys())
-    
-    for day in sorted_days:
-        data = daily_groups[day]
-        dt = data['dt_obj']
-        
-        # Определение дня недели
-        weekdays_ru = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-        weekdays_en = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        wd_idx = dt.weekday()
-        day_name = weekdays_ru[wd_idx] if lang == 'ru' else weekdays_en[wd_idx]
-
-        # Агрегация (как в твоем get_today_forecast)
-        day_info = {
-            'date': dt.strftime("%d.%m"),
-            'day_name': day_name,
-            'temp_min': min(data['temps']),
-            'temp_max': max(data['temps']),
-            'temp': sum(data['temps']) / len(data['temps']), # Средняя для совместимости
-            'feels_like': sum(data['feels_like']) / len(data['feels_like']),
-            'humidity': sum(data['humidities']) / len(data['humidities']),
-            'wind_speed': max(data['wind_speeds']), # Берем худший ветер
-            'precipitation': int(max(data['pop']) * 100),
-            'descriptions': data['descriptions'], # Передаем список, format_forecast сам выберет частое
-            
-            # Заглушки, чтобы не ломался format_forecast
-            'pressure': 1013, 
-            'wind_gust': 0,
-            'wind_direction': 0,
-            'clouds': 0,
-            'visibility': 10000 
-        }
+    for date_obj, day in bucket_forecast_by_day(raw_data, get_user_timezone(user)).items():
+        wd_idx = date_obj.weekday()
+        day_info = summarize_day(day, date_obj.strftime("%d.%m"))
+        day_info.day_name = weekdays_ru[wd_idx] if lang == 'ru' else weekdays_en[wd_idx]
         final_forecast.append(day_info)
         
     return final_forecast
\ No newline at end of file
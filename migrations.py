@@ -0,0 +1,180 @@
+# ДОВЕДЕНИЕ СХЕМЫ БД ДО АКТУАЛЬНЫХ МОДЕЛЕЙ.
+# create_all() создаёт только отсутствующие таблицы, а новые колонки и индексы в уже
+# существующих таблицах добавляются здесь.
+
+import logging
+import requests
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from models import Base, UnresolvedCity, User
+
+BACKFILL_RETRY = timedelta(days=30)  # Не найденный город снова геокодируется не раньше чем через столько
+
+
+def upgrade_schema(engine):
+    """Добавляет в существующие таблицы колонки, которые появились в моделях (только nullable)."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            existing_columns = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable:
+                    logging.warning(f"Колонка {table.name}.{column.name} NOT NULL — добавьте её вручную.")
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} NULL"))
+                logging.info(f"Добавлена колонка {table.name}.{column.name} ({column_type}).")
+
+    create_missing_indexes(engine, existing_tables)
+    create_missing_foreign_keys(engine, existing_tables)
+
+
+def create_missing_indexes(engine, existing_tables):
+    """
+    Создаёт индексы колонок с index=True / unique=True, которых нет в существующих таблицах
+    (колонки, добавленные upgrade_schema, приходят без них). Каждый индекс — отдельной
+    транзакцией: уникальный индекс не создастся при дублях, остальные это не затронет.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        indexed = {tuple(index["column_names"]) for index in inspector.get_indexes(table.name)}
+        indexed |= {tuple(constraint["column_names"]) for constraint in inspector.get_unique_constraints(table.name)}
+        indexed |= {tuple(inspector.get_pk_constraint(table.name)["constrained_columns"])}
+        for column in table.columns:
+            if not (column.index or column.unique) or (column.name,) in indexed:
+                continue
+
+            unique = bool(column.unique)
+            name = f"{'uq' if unique else 'ix'}_{table.name}_{column.name}"
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table.name} ({column.name})"
+                    ))
+            except Exception as e:
+                logging.warning(f"Не удалось создать индекс {name}: {e}")
+                continue
+            logging.info(f"Создан индекс {name}.")
+
+
+def create_missing_foreign_keys(engine, existing_tables):
+    """
+    Добавляет внешние ключи колонок моделей, которых нет в существующих таблицах. Перед этим
+    висячие ссылки (на удалённые/несуществующие строки) обнуляются — иначе ключ не создастся.
+    SQLite не умеет ADD CONSTRAINT: там ключ появится только у новых таблиц.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        constrained = {tuple(fk["constrained_columns"]) for fk in inspector.get_foreign_keys(table.name)}
+        for fk in table.foreign_keys:
+            column = fk.parent
+            if (column.name,) in constrained:
+                continue
+
+            target = fk.column
+            name = f"fk_{table.name}_{column.name}"
+            try:
+                with engine.begin() as conn:
+                    orphaned = conn.execute(text(
+                        f"UPDATE {table.name} SET {column.name} = NULL WHERE {column.name} IS NOT NULL "
+                        f"AND {column.name} NOT IN (SELECT {target.name} FROM {target.table.name})"
+                    )).rowcount
+                    conn.execute(text(
+                        f"ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({column.name}) "
+                        f"REFERENCES {target.table.name} ({target.name})"
+                    ))
+            except Exception as e:
+                logging.warning(f"Не удалось создать внешний ключ {name}: {e}")
+                continue
+            if orphaned:
+                logging.warning(f"{table.name}.{column.name}: обнулено висячих ссылок — {orphaned}.")
+            logging.info(f"Создан внешний ключ {name}.")
+
+
+def backfill_user_locations(engine):
+    """
+    Привязывает к каноническому местоположению (Location) пользователей с городом, но без location_id,
+    и заполняет их координаты и каноническое название города. Каждое написание города геокодируется один раз; нераспознанные
+    города остаются без местоположения и запрашиваются по названию, как раньше. Бэкфилл идёт при
+    каждом старте контейнера, поэтому города, которых OpenWeather не знает, записываются
+    в unresolved_cities и не тратят квоту при следующих деплоях (до BACKFILL_RETRY).
+    При сбое (сеть, 5xx, квота, предохранитель) бэкфилл останавливается, а оставшиеся
+    города ждут следующего старта.
+    """
+    from logic import resolve_location
+    from weather import api_priority, strict_api_errors, PRIORITY_GEOCODE
+
+    with Session(engine) as db, api_priority(PRIORITY_GEOCODE), strict_api_errors():
+        users = db.query(User).filter(User.preferred_city.isnot(None), User.location_id.is_(None)).all()
+        users_by_city = {}
+        for user in users:
+            users_by_city.setdefault(user.preferred_city.strip().lower(), []).append(user)
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        recently_missed = {
+            city for (city,) in db.query(UnresolvedCity.city).filter(UnresolvedCity.attempted_at > now - BACKFILL_RETRY)
+        }
+
+        filled = 0
+        skipped = 0
+        for key, city_users in users_by_city.items():
+            if key in recently_missed:
+                skipped += len(city_users)
+                continue
+            city = city_users[0].preferred_city
+            try:
+                location = resolve_location(db, city)
+            except requests.RequestException as e:
+                db.rollback()
+                logging.warning(f"OpenWeather недоступен ({e}) — бэкфилл продолжится при следующем старте.")
+                break
+            except Exception as e:
+                db.rollback()
+                logging.warning(f"Не удалось геокодировать {city}: {e}")
+                continue
+            if not location:
+                logging.warning(f"Город {city} не найден — местоположение не заполнено.")
+                db.merge(UnresolvedCity(city=key, attempted_at=now))
+                db.commit()
+                continue
+            db.query(UnresolvedCity).filter(UnresolvedCity.city == key).delete(synchronize_session=False)
+            for user in city_users:
+                user.location_id = location.id
+                user.preferred_city = location.name
+                user.latitude, user.longitude = location.latitude, location.longitude
+            db.commit()
+            filled += len(city_users)
+
+    logging.info(
+        f"Местоположение заполнено у {filled} из {len(users)} пользователей "
+        f"(пропущено {skipped}: город недавно не найден)."
+    )
+
+
+if __name__ == "__main__":
+    import os
+    from sqlalchemy import create_engine
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    upgrade_schema(engine)
+    backfill_user_locations(engine)
+    print("✅ Database schema is up to date")
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, Text, ForeignKey
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.mysql import JSON
@@ -17,6 +17,11 @@ class User(Base):
     unique_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(255), unique=True, nullable=True)
     preferred_city = Column(String(255), nullable=True)
+    # Координаты города: запросы к OpenWeather идут по lat/lon, а не по введённому названию
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    location_id = Column(Integer, ForeignKey("locations.id"), nullable=True, index=True)
+    next_forecast_at = Column(DateTime, nullable=True, index=True)  # UTC следующей утренней рассылки
     
     notifications_settings = Column(
         JSON,
@@ -57,11 +62,33 @@ class User(Base):
     language = Column(String(5), default="ru") 
 
 
+class Location(Base):
+    """Каноническое местоположение: одна запись на реальный город, как бы его ни написали."""
+    __tablename__ = 'locations'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    owm_city_id = Column(BigInteger, unique=True, nullable=True)  # id города в OpenWeather
+    coord_key = Column(String(32), unique=True, nullable=False)  # "lat,lon" с округлением weather.COORD_PRECISION
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    name = Column(String(255), nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+
+class UnresolvedCity(Base):
+    """Название города, которое бэкфилл местоположений не нашёл в OpenWeather: повторно не геокодируется до срока."""
+    __tablename__ = 'unresolved_cities'
+
+    city = Column(String(255), primary_key=True)  # strip().lower(), как ключ группировки в бэкфилле
+    attempted_at = Column(DateTime, nullable=False)  # UTC
+
+
 class CheckedCities(Base):
     __tablename__ = 'checked_cities'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     city_name = Column(String(100), unique=True, nullable=False) 
+    location_id = Column(Integer, ForeignKey("locations.id"), unique=True, nullable=True)
     
     last_temperature = Column(Float, nullable=True)
     last_feels_like = Column(Float, nullable=True)  
@@ -89,6 +116,21 @@ class CheckedCities(Base):
 
     last_checked = Column(DateTime, server_default=func.now())
     previous_notify_time = Column(DateTime(timezone=True), nullable=True)
+    # Адаптивный опрос (polling.py): скользящая оценка изменчивости погоды и время следующего опроса (UTC)
+    change_score = Column(Float, nullable=True)
+    next_check_at = Column(DateTime, nullable=True)
+
+
+class TimerLease(Base):
+    """
+    Аренда для координации экземпляров таймера: "shard:<n>" — шард, "member:<id>" — признак
+    живого экземпляра. Владелец owner держит аренду, пока не истёк expires_at.
+    """
+    __tablename__ = 'timer_leases'
+
+    name = Column(String(160), primary_key=True)
+    owner = Column(String(128), nullable=True)
+    expires_at = Column(DateTime, nullable=True)  # UTC
 
 
 class LocalVars(Base):
@@ -101,4 +143,19 @@ class LocalVars(Base):
     last_format_settings_menu = Column(JSON, nullable=True)
     last_bot_message = Column(JSON, nullable=True)
     last_daily_forecast = Column(JSON, nullable=True)
-    last_weather_update = Column(JSON, nullable=True)
\ No newline at end of file
+    last_daily_forecast_hash = Column(String(64), nullable=True)
+    last_weather_update = Column(JSON, nullable=True)
+
+class BroadcastJournal(Base):
+    """
+    Журнал рассылок: статус отправки пользователю user_id в слоте slot задачи job
+    (для утреннего прогноза слот — его next_forecast_at). По нему перезапущенный таймер
+    продолжает рассылку с места остановки, не отправляя сообщения повторно.
+    """
+    __tablename__ = 'broadcast_journal'
+
+    job = Column(String(32), primary_key=True)
+    slot = Column(DateTime, primary_key=True)  # UTC
+    user_id = Column(BigInteger, primary_key=True)
+    status = Column(String(16), nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)  # UTC
\ No newline at end of file
@@ -0,0 +1,104 @@
+# АДАПТИВНАЯ ЧАСТОТА ОПРОСА ГОРОДОВ.
+# Интервал опроса каждого города зависит от того, как быстро там меняется погода
+# (change_score — скользящее среднее изменений за час по дельтам CheckedCities) и сколько
+# у него подписчиков: волатильные и популярные города опрашиваются чаще, стабильные
+# с одним подписчиком — как и раньше, раз в 30 минут. Реже города опрашиваются, только если
+# суммарная потребность превышает бюджет запросов: тогда все интервалы пропорционально растягиваются.
+
+import math
+import os
+from datetime import timedelta
+
+BASE_POLL_INTERVAL = 1800  # секунд: один подписчик, стабильная погода (прежний период проверки)
+MIN_POLL_INTERVAL = 600
+MAX_POLL_INTERVAL = 3 * 3600  # Предел растяжения под бюджет
+CITY_POLL_BUDGET = int(os.getenv("CITY_POLL_BUDGET", "1500"))  # Запросов /weather в час на экземпляр
+
+CHANGE_SCORE_WEIGHT = 0.3  # Вес нового замера в скользящем среднем
+# Изменение параметра, которое считается одной «единицей» волатильности
+CHANGE_SCALES = {
+    "temperature": 2.0,
+    "pressure": 3.0,
+    "wind_speed": 3.0,
+    "humidity": 10.0,
+    "clouds": 30.0,
+}
+DESCRIPTION_CHANGE = 1.0
+
+
+def change_rate(city_data, current_data, now):
+    """Изменение погоды с прошлого опроса в единицах волатильности за час."""
+    units = 0.0
+    for param, scale in CHANGE_SCALES.items():
+        previous = getattr(city_data, param)
+        current = current_data.temp if param == "temperature" else getattr(current_data, param)
+        if previous is not None and current is not None:
+            units += abs(current - previous) / scale
+    if city_data.description and current_data.description and city_data.description != current_data.description:
+        units += DESCRIPTION_CHANGE
+
+    hours = 1.0
+    if city_data.last_checked:
+        hours = (now - city_data.last_checked).total_seconds() / 3600
+    return units / min(max(hours, 0.25), 6.0)
+
+
+def record_reading(city_data, current_data, now):
+    """
+    Обновляет change_score и время опроса по новому замеру и запоминает параметры,
+    с которыми будет сравниваться следующий. now — naive UTC.
+    """
+    rate = change_rate(city_data, current_data, now)
+    score = city_data.change_score
+    city_data.change_score = rate if score is None else CHANGE_SCORE_WEIGHT * rate + (1 - CHANGE_SCORE_WEIGHT) * score
+    city_data.last_checked = now
+    city_data.pressure = current_data.pressure
+    city_data.wind_speed = current_data.wind_speed
+    city_data.humidity = current_data.humidity
+    city_data.clouds = current_data.clouds
+
+
+def base_interval(change_score, subscribers):
+    """Интервал опроса без учёта бюджета, секунды."""
+    volatility = 1 + (change_score or 0.0)
+    audience = 1 + math.log10(max(subscribers, 1))
+    return min(max(BASE_POLL_INTERVAL / (volatility * audience), MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+
+def budget_stretch(intervals, budget=CITY_POLL_BUDGET):
+    """Во сколько раз растянуть интервалы, чтобы запросов в час было не больше бюджета."""
+    demand = sum(3600 / interval for interval in intervals)
+    return max(1.0, demand / budget) if budget > 0 else 1.0
+
+
+def poll_interval(change_score, subscribers, stretch=1.0):
+    """Интервал до следующего опроса с учётом растяжения под бюджет, секунды."""
+    return min(base_interval(change_score, subscribers) * stretch, MAX_POLL_INTERVAL)
+
+
+def plan_polls(states, now, tick, budget=CITY_POLL_BUDGET):
+    """
+    states — {ключ: (change_score, подписчики, next_check_at или None)}.
+    Возвращает (ключи к опросу сейчас по убыванию приоритета, растяжение интервалов под бюджет).
+    За один тик опрашивается не больше доли бюджета, приходящейся на тик; остальные
+    просроченные города ждут следующего тика.
+    """
+    stretch = budget_stretch(
+        [base_interval(score, subscribers) for score, subscribers, _ in states.values()], budget
+    )
+
+    def priority(key):
+        score, subscribers, next_check_at = states[key]
+        interval = poll_interval(score, subscribers, stretch)
+        overdue = (now - next_check_at).total_seconds() if next_check_at else interval
+        return subscribers * (1 + (score or 0.0)) * (1 + overdue / interval)
+
+    due = [key for key, (_, _, next_check_at) in states.items() if next_check_at is None or next_check_at <= now]
+    due.sort(key=priority, reverse=True)
+    if budget > 0:
+        due = due[:max(1, int(budget * tick / 3600))]
+    return due, stretch
+
+
+def next_check_time(now, interval):
+    return now + timedelta(seconds=interval)
@@ -0,0 +1,258 @@
+# ПУЛ ПРОЦЕССОВ ДЛЯ ОТРИСОВКИ РАССЫЛОК.
+# Формирование текстов (перевод единиц, сводка, HTML) — чистый CPU и упирается в GIL, поэтому
+# при больших рассылках оно выносится в отдельные процессы. Рабочим передаются только компактные
+# данные (настройки пользователя и записи прогноза), ORM-объекты и Telegram остаются в таймере.
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+import threading
+from threading import Lock
+
+from logic import (
+    decode_tracked_params, format_forecast, get_text, get_today_forecast, get_translation_dict,
+    get_user_lang, get_weather_summary_description
+)
+
+#ПЕРЕМЕННЫЕ
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0"))  # 0 — отрисовка в процессе таймера
+RENDER_POOL_MIN_BATCH = 200  # Меньшие рассылки дешевле отрисовать на месте, чем гонять через пул
+RENDER_CHUNK_SIZE = 100  # Пользователей в одном задании пула
+timer_logger = logging.getLogger("timer_logger")  # Настроен в weather_timer.py
+
+render_pool = None  # Запускается start_render_pool()
+render_pool_lock = Lock()
+
+
+@dataclass(slots=True)
+class RenderPrefs:
+    """Настройки пользователя, нужные для отрисовки (вместо ORM-объекта User)."""
+    user_id: int
+    language: str
+    timezone: str
+    temp_unit: str
+    pressure_unit: str
+    wind_speed_unit: str
+    tracked_weather_params: int
+    preferred_city: str
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            user.user_id, user.language, user.timezone, user.temp_unit, user.pressure_unit,
+            user.wind_speed_unit, user.tracked_weather_params, user.preferred_city
+        )
+
+
+def split_chunks(head, prefs_list, size=RENDER_CHUNK_SIZE):
+    """Делит пользователей одной группы на задания: [(*head, [RenderPrefs])]."""
+    return [(*head, prefs_list[i:i + size]) for i in range(0, len(prefs_list), size)]
+
+
+#УТРЕННИЙ ПРОГНОЗ
+def render_daily_chunk(chunk):
+    """
+    chunk = (forecast_list, [RenderPrefs]) — пользователи одного города и языка.
+    Возвращает [(user_id, текст или None)].
+    """
+    forecast_list, prefs_list = chunk
+    results = []
+    for prefs in prefs_list:
+        raw_forecast = get_today_forecast(prefs.preferred_city, prefs, raw_data=forecast_list)
+        if not raw_forecast:
+            results.append((prefs.user_id, None))
+            continue
+        lang = get_user_lang(prefs)
+        text = format_forecast(
+            raw_forecast,
+            prefs,
+            get_text("daily_forecast_title", lang),
+            summary_text=get_weather_summary_description(forecast_list, prefs),
+            is_daily_forecast=True
+        )
+        results.append((prefs.user_id, text))
+    return results
+
+
+#УВЕДОМЛЕНИЯ ОБ ИЗМЕНЕНИИ ПОГОДЫ
+# Параметры уведомления, зависящие от единиц измерения пользователя
+UNIT_PARAMS = {
+    "temperature": "temp",
+    "feels_like": "temp",
+    "pressure": "pressure",
+    "wind_speed": "wind_speed",
+    "wind_gust": "wind_speed",
+}
+
+# Параметры, которые могут попасть в уведомление (колонки last_* в CheckedCities)
+ALERT_PARAMS = (
+    "temperature", "feels_like", "humidity", "precipitation", "pressure",
+    "wind_speed", "wind_gust", "clouds", "visibility"
+)
+
+ICON_UP = "⇑"
+ICON_DOWN = "⇓"
+ICON_SAME = "▸"
+
+
+def render_weather_update(prefs, city, current_data, last_values, unit_table):
+    """
+    Текст уведомления об изменении погоды для одного пользователя.
+    last_values — {param: прошлое значение, "description": прошлое описание};
+    unit_table — результат build_unit_table. None, если пользователь ничего не отслеживает.
+    """
+    tracked_params = decode_tracked_params(prefs.tracked_weather_params)
+    if not any(tracked_params.values()):
+        return None
+
+    lang = get_user_lang(prefs)
+    unit_trans = get_translation_dict("unit_translations", lang)
+    labels = get_translation_dict("weather_data_labels", lang)
+
+    # 1. ЗАГОЛОВОК
+    localized_city_name = current_data.city_name or city
+    header_text = f"🌨 <b>Внимание!</b>\n"
+    header_info = f"<b>Погода в г.{localized_city_name} изменилась!</b>\n"
+
+    # ОПИСАНИЕ ИЗМЕНЕНИЙ
+    last_desc = last_values.get("description")
+    curr_desc = current_data.description
+
+    if last_desc and curr_desc and str(last_desc).lower() != str(curr_desc).lower():
+        desc_line = f"▸ {str(last_desc).capitalize()} ➝ {str(curr_desc).capitalize()}"
+    else:
+        desc_line = f"▸ {str(curr_desc).capitalize()}"
+
+    header_info += f"{desc_line}\n"
+    header_info += "─────────────────────"
+
+    header_html = f"<blockquote>{header_text}</blockquote>"
+
+    # 2. ПАРАМЕТРЫ
+    params_text = ""
+    param_config = {
+        # Для параметров с единицами значения берутся из unit_table
+        "temperature": (labels.get("temperature", "Температура"), "", None),
+        "feels_like": (labels.get("feels_like", "Ощущается как"), "", None),
+        "humidity": (labels.get("humidity", "Влажность"), "%", lambda x: int(x)),
+        "precipitation": (labels.get("precipitation", "Осадки"), "%", lambda x: int(x)),
+        "pressure": (labels.get("pressure", "Давление"), "", None),
+        "wind_speed": (labels.get("wind_speed", "Ветер"), "", None),
+        "wind_gust": (labels.get("wind_gust", "Порывы"), "", None),
+        "clouds": (labels.get("clouds", "Облачность"), "%", lambda x: int(x)),
+        "visibility": (labels.get("visibility", "Видимость"), "м", lambda x: int(x)),
+    }
+
+    has_params = False
+
+    for param, (label, default_unit, transformer) in param_config.items():
+        if not tracked_params.get(param, False): continue
+
+        if param in ["temperature", "feels_like"]: user_unit = prefs.temp_unit
+        elif param == "pressure": user_unit = prefs.pressure_unit
+        elif param in ["wind_speed", "wind_gust"]: user_unit = prefs.wind_speed_unit
+        else: user_unit = None
+        unit = unit_trans[UNIT_PARAMS[param]].get(user_unit, '') if user_unit else default_unit
+
+        current_val = current_data.temp if param == "temperature" else getattr(current_data, param, None)
+        last_val = last_values.get(param)
+
+        if current_val is None: continue
+
+        try:
+            if transformer is None:
+                new_v, old_v = unit_table[param][user_unit]
+            else:
+                new_v = transformer(current_val)
+                old_v = transformer(last_val) if last_val is not None else None
+
+            arrow = ICON_SAME
+            val_str = f"{new_v} {unit}"
+
+            if old_v is not None and old_v != new_v:
+                if isinstance(new_v, (int, float)) and isinstance(old_v, (int, float)):
+                    if new_v > old_v: arrow = ICON_UP
+                    elif new_v < old_v: arrow = ICON_DOWN
+                val_str = f"{old_v} ➝ {new_v} {unit}"
+
+            params_text += f"{arrow} {label}: {val_str}\n"
+            has_params = True
+        except Exception: pass
+
+    full_message = f"{header_html}{header_info}"
+    if has_params:
+        full_message += f"\n<blockquote expandable>{params_text}</blockquote>"
+    return full_message
+
+
+def render_alert_chunk(chunk):
+    """chunk = (city, current_data, last_values, unit_table, [RenderPrefs]) -> [(user_id, текст или None)]."""
+    city, current_data, last_values, unit_table, prefs_list = chunk
+    return [
+        (prefs.user_id, render_weather_update(prefs, city, current_data, last_values, unit_table))
+        for prefs in prefs_list
+    ]
+
+
+#ПУЛ
+def start_render_pool():
+    """
+    Запускает процессы пула через fork — рабочие наследуют уже загруженные модули (spawn/forkserver
+    заново импортировали бы weather_timer как __main__, а с ним и bot). Поэтому вызывается, пока
+    в процессе нет других потоков: weather_timer запускает пул до импорта bot, чей TeleBot
+    при создании стартует свои рабочие потоки.
+    """
+    global render_pool
+    if RENDER_WORKERS <= 0:
+        return None
+    with render_pool_lock:
+        if render_pool is None:
+            render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("fork")
+            )
+            # С fork пул создаёт все процессы при первом задании — делаем это сейчас, до появления потоков
+            if threading.active_count() > 1:
+                timer_logger.warning("Пул отрисовки создаётся при работающих потоках — возможны зависания рабочих процессов.")
+            render_pool.submit(int).result()
+        return render_pool
+
+
+def shutdown_render_pool():
+    global render_pool
+    with render_pool_lock:
+        if render_pool is not None:
+            render_pool.shutdown(wait=True, cancel_futures=True)
+            render_pool = None
+
+
+def render_chunks(render, chunks):
+    """
+    Отрисовывает чанки функцией render и отдаёт готовые [(user_id, текст)] по мере готовности,
+    чтобы отправка начиналась, не дожидаясь всей рассылки. Если пул не запущен, рассылка
+    маленькая или пул сломался — отрисовка идёт на месте.
+    """
+    pool = render_pool
+    total = sum(len(chunk[-1]) for chunk in chunks)
+    if pool is None or total < RENDER_POOL_MIN_BATCH or len(chunks) < 2:
+        for chunk in chunks:
+            yield render(chunk)
+        return
+
+    try:
+        futures = {pool.submit(render, chunk): chunk for chunk in chunks}
+    except Exception as e:
+        timer_logger.error(f"Пул отрисовки недоступен, отрисовываем на месте: {e}")
+        for chunk in chunks:
+            yield render(chunk)
+        return
+
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            timer_logger.error(f"Ошибка отрисовки в пуле, отрисовываем на месте: {e}")
+            result = render(futures[future])
+        yield result
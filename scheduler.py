@@ -0,0 +1,183 @@
+# ПЛАНИРОВЩИК ЗАДАЧ ТАЙМЕРА.
+# Каждая задача планируется независимо через кучу (heapq) по времени следующего запуска и
+# выполняется в своём потоке, так что медленная фаза не сдвигает остальные.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+# Верхние границы корзин гистограммы длительности запуска, секунды
+DURATION_BUCKETS = (0.5, 1, 5, 15, 30, 60, 120, 300, 600, float("inf"))
+
+
+def every(seconds, offset=0):
+    """
+    Расписание «каждые N секунд», выровненное по границам интервала в UTC
+    (every(1800) — в :00 и :30), со сдвигом offset.
+    """
+    def next_run(now):
+        return (now - offset) // seconds * seconds + seconds + offset
+    return next_run
+
+
+@dataclass
+class JobStats:
+    """Счётчики и гистограмма длительностей одной задачи."""
+    runs: int = 0
+    failures: int = 0
+    skipped_overrun: int = 0
+    skipped_deadline: int = 0
+    skipped_guard: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    histogram: list = field(default_factory=lambda: [0] * len(DURATION_BUCKETS))
+
+    def record(self, seconds, failed):
+        self.runs += 1
+        self.failures += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect_left(DURATION_BUCKETS, seconds)] += 1
+
+    def summary(self):
+        average = self.total_seconds / self.runs if self.runs else 0.0
+        buckets = ", ".join(
+            f"≤{bound:g}s: {count}" for bound, count in zip(DURATION_BUCKETS, self.histogram) if count
+        )
+        return (
+            f"запусков {self.runs} (ошибок {self.failures}), пропущено: наложение {self.skipped_overrun}, "
+            f"дедлайн {self.skipped_deadline}, не владелец {self.skipped_guard}; среднее {average:.1f}s, макс {self.max_seconds:.1f}s [{buckets}]"
+        )
+
+
+@dataclass
+class Job:
+    """
+    Задача планировщика.
+    schedule(now) -> время следующего запуска (timestamp);
+    deadline — сколько секунд запуск может опоздать, прежде чем будет пропущен (None — без ограничения);
+    priority — при одинаковом времени раньше запускается задача с меньшим значением;
+    guard() -> bool — запуск пропускается, если вернул False (например, аренда задачи у другого экземпляра);
+    schedule_after_run — следующий срок считается после завершения запуска, а не при его старте
+    (расписание зависит от результата запуска, как у очереди рассылки).
+    """
+    name: str
+    func: object
+    schedule: object
+    priority: int = 0
+    deadline: float = None
+    skip_if_running: bool = True
+    guard: object = None
+    schedule_after_run: bool = False
+    running: bool = False
+    stats: JobStats = field(default_factory=JobStats)
+
+
+class Scheduler:
+    """Планировщик на куче: (время запуска, приоритет, порядковый номер, задача)."""
+
+    def __init__(self, max_workers=4, logger=None):
+        self.jobs = {}
+        self.logger = logger or logging.getLogger(__name__)
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._wakeup = threading.Event()  # Задача с schedule_after_run добавила срок — пересчитать ожидание
+
+    def add_job(self, name, func, schedule, priority=0, deadline=None, skip_if_running=True, run_immediately=False,
+                guard=None, schedule_after_run=False):
+        job = Job(name, func, schedule, priority, deadline, skip_if_running, guard, schedule_after_run)
+        with self._lock:
+            self.jobs[name] = job
+            due = time.time() if run_immediately else schedule(time.time())
+            self._push(due, job)
+        return job
+
+    def _push(self, due, job):
+        heapq.heappush(self._heap, (due, job.priority, next(self._counter), job))
+
+    def _reschedule(self, job, due):
+        """Следующий запуск строго в будущем, даже если тик сильно опоздал."""
+        now = time.time()
+        self._push(max(job.schedule(max(due, now)), now + 1), job)
+
+    def _schedule_next(self, job):
+        """Срок следующего запуска задачи с schedule_after_run (расписание считается вне блокировки)."""
+        now = time.time()
+        try:
+            due = max(job.schedule(now), now + 1)
+        except Exception as e:
+            self.logger.error(f"❌ Не удалось рассчитать следующий запуск {job.name}: {e}")
+            due = now + 60
+        with self._lock:
+            self._push(due, job)
+        self._wakeup.set()
+
+    def _dispatch(self, due, job):
+        """Запускает задачу в пуле; False, если запуск пропущен."""
+        lateness = time.time() - due
+        if job.deadline is not None and lateness > job.deadline:
+            job.stats.skipped_deadline += 1
+            self.logger.warning(f"⏱ {job.name}: запуск опоздал на {lateness:.0f}s (дедлайн {job.deadline}s) — пропущен.")
+            return False
+        if job.guard is not None and not job.guard():
+            job.stats.skipped_guard += 1
+            self.logger.debug(f"⏱ {job.name}: задачу выполняет другой экземпляр — пропущен.")
+            return False
+        if job.running and job.skip_if_running:
+            job.stats.skipped_overrun += 1
+            self.logger.warning(f"⏱ {job.name}: предыдущий запуск ещё идёт — пропущен.")
+            return False
+
+        job.running = True
+        self._executor.submit(self._run, job)
+        return True
+
+    def _run(self, job):
+        started = time.monotonic()
+        failed = False
+        try:
+            job.func()
+        except Exception as e:
+            failed = True
+            self.logger.error(f"❌ Задача {job.name} завершилась ошибкой: {e}", exc_info=True)
+        finally:
+            seconds = time.monotonic() - started
+            with self._lock:
+                job.running = False
+                job.stats.record(seconds, failed)
+            self.logger.info(f"⏱ {job.name}: {seconds:.1f}s")
+            if job.schedule_after_run:
+                self._schedule_next(job)
+
+    def run_forever(self, stop_event):
+        """Основной цикл: спит до ближайшего срока, запускает задачи, у которых он наступил."""
+        while not stop_event.is_set():
+            with self._lock:
+                due_jobs = []
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, _, job = heapq.heappop(self._heap)
+                    due_jobs.append((due, job))
+                    if not job.schedule_after_run:
+                        self._reschedule(job, due)
+
+            for due, job in due_jobs:
+                if not self._dispatch(due, job) and job.schedule_after_run:
+                    self._schedule_next(job)
+
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else time.time() + 60
+            self._wakeup.wait(max(0.0, min(next_due - time.time(), 60)))
+            self._wakeup.clear()
+        self._executor.shutdown(wait=True)
+
+    def stats_summary(self):
+        with self._lock:
+            return {name: job.stats.summary() for name, job in self.jobs.items()}
@@ -0,0 +1,265 @@
+# КООРДИНАЦИЯ ЭКЗЕМПЛЯРОВ ТАЙМЕРА ЧЕРЕЗ АРЕНДЫ (таблица timer_leases).
+# Без шардирования (TIMER_SHARDS=1) каждую задачу выполняет только владелец аренды "job:<имя>",
+# поэтому резервные экземпляры ничего не дублируют и подхватывают задачу, когда аренда истекает.
+# С шардированием города и пользователи раскладываются по TIMER_SHARDS виртуальным шардам через
+# консистентное хеш-кольцо, а шарды делятся между экземплярами: каждый держит примерно равную
+# долю, поэтому добавление экземпляра почти линейно разгружает остальных, а один ключ
+# в каждый момент обрабатывает только один владелец.
+# Аренды продлевает отдельный поток-heartbeat, чтобы долгая задача не мешала их продлению.
+
+import bisect
+import hashlib
+import logging
+import math
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from models import TimerLease
+
+TIMER_SHARDS = int(os.getenv("TIMER_SHARDS", "1"))
+SHARDING_ENABLED = TIMER_SHARDS > 1
+INSTANCE_ID = os.getenv("TIMER_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = timedelta(seconds=30)  # Через столько после падения владельца его работу подхватывают другие
+HEARTBEAT_INTERVAL = 10  # секунд; должно быть заметно меньше LEASE_TTL
+# Аренда считается своей, только если до её конца осталось больше этого запаса —
+# так прежний владелец перестаёт работать раньше, чем её сможет забрать другой экземпляр
+LEASE_SAFETY_MARGIN = timedelta(seconds=10)
+RING_VNODES = 64
+timer_logger = logging.getLogger("timer_logger")  # Аренды есть только у таймера — пишем в его лог
+
+_owned_shards = {}  # шард -> expires_at (UTC) собственной аренды
+_held_jobs = {}  # имя задачи -> expires_at (UTC) собственной аренды
+_owned_lock = threading.Lock()
+
+
+def stable_hash(value):
+    """Хеш, одинаковый во всех процессах (встроенный hash() рандомизирован)."""
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def build_ring(shard_count, vnodes=RING_VNODES):
+    """Консистентное хеш-кольцо: отсортированные (хеш, шард) для vnodes точек каждого шарда."""
+    return sorted(
+        (stable_hash(f"shard-{shard}#{vnode}"), shard)
+        for shard in range(shard_count)
+        for vnode in range(vnodes)
+    )
+
+
+_ring = build_ring(TIMER_SHARDS)
+_ring_hashes = [point for point, _ in _ring]
+
+
+def shard_for(key):
+    """Шард ключа: ближайшая по часовой стрелке точка кольца."""
+    index = bisect.bisect(_ring_hashes, stable_hash(key)) % len(_ring)
+    return _ring[index][1]
+
+
+def city_key(location_id=None, city=None):
+    """Ключ шардирования города: каноническое местоположение или нормализованное название."""
+    if location_id is not None:
+        return f"location:{location_id}"
+    return f"city:{(city or '').strip().lower()}"
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+def owns(key):
+    """True, если ключ относится к шарду, аренда которого у этого экземпляра ещё действительна."""
+    if not SHARDING_ENABLED:
+        return True
+    shard = shard_for(key)
+    with _owned_lock:
+        expires_at = _owned_shards.get(shard)
+    return lease_is_valid(expires_at)
+
+
+def owned_shards():
+    with _owned_lock:
+        return sorted(_owned_shards)
+
+
+def shard_lease_name(shard):
+    return f"shard:{shard}"
+
+
+def member_lease_name(instance_id=INSTANCE_ID):
+    return f"member:{instance_id}"
+
+
+def job_lease_name(job):
+    return f"job:{job}"
+
+
+def lease_is_valid(expires_at):
+    return expires_at is not None and expires_at - LEASE_SAFETY_MARGIN > datetime.now(timezone.utc)
+
+
+def ensure_lease_rows(db, names):
+    """Создаёт недостающие строки аренды (идемпотентно, параллельные экземпляры не мешают)."""
+    existing = {name for (name,) in db.query(TimerLease.name).filter(TimerLease.name.in_(names))}
+    for name in names:
+        if name in existing:
+            continue
+        db.add(TimerLease(name=name))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+
+
+def try_acquire(db, name, expires_at, now):
+    """Условный захват/продление аренды: успешен, если она свободна, истекла или уже наша."""
+    result = db.execute(
+        update(TimerLease)
+        .where(TimerLease.name == name)
+        .where(
+            (TimerLease.owner == INSTANCE_ID)
+            | TimerLease.expires_at.is_(None)
+            | (TimerLease.expires_at <= now)
+        )
+        .values(owner=INSTANCE_ID, expires_at=expires_at)
+    )
+    return result.rowcount == 1
+
+
+def renew_leases(session_factory):
+    """
+    Отмечает экземпляр живым, продлевает свои аренды шардов и добирает/отдаёт шарды
+    до справедливой доли: ceil(TIMER_SHARDS / живые экземпляры). Захват — условный UPDATE,
+    поэтому два экземпляра не могут одновременно получить один шард.
+    """
+    if not SHARDING_ENABLED:
+        return
+
+    naive_now = datetime.now(timezone.utc).replace(tzinfo=None)
+    expires_at = naive_now + LEASE_TTL
+    shard_names = {shard_lease_name(shard): shard for shard in range(TIMER_SHARDS)}
+
+    with session_factory() as db:
+        ensure_lease_rows(db, list(shard_names) + [member_lease_name()])
+        try_acquire(db, member_lease_name(), expires_at, naive_now)
+        db.commit()
+
+        leases = db.query(TimerLease).filter(
+            TimerLease.name.in_(shard_names) | TimerLease.name.like("member:%")
+        ).all()
+        live = [lease for lease in leases if lease.owner and lease.expires_at and lease.expires_at > naive_now]
+        live_members = {lease.owner for lease in live if lease.name.startswith("member:")}
+        fair_share = math.ceil(TIMER_SHARDS / max(len(live_members), 1))
+
+        mine = sorted(shard_names[lease.name] for lease in live if lease.name in shard_names and lease.owner == INSTANCE_ID)
+        taken = {lease.name for lease in live if lease.name in shard_names}
+        # Порядок захвата свободных шардов свой у каждого экземпляра — меньше конфликтов
+        free = sorted(
+            (shard for name, shard in shard_names.items() if name not in taken),
+            key=lambda shard: stable_hash(f"{INSTANCE_ID}:{shard}")
+        )
+
+        keep, release = mine[:fair_share], mine[fair_share:]
+        acquired = []
+        for shard in keep + free:
+            if len(acquired) >= fair_share:
+                break
+            if try_acquire(db, shard_lease_name(shard), expires_at, naive_now):
+                acquired.append(shard)
+
+        if release:
+            # Шарды сразу перестают считаться своими (owns() проверяется перед каждой отправкой),
+            # но аренда в БД не снимается, а просто больше не продлевается: новый владелец получит
+            # шард только после её истечения, когда задачи этого экземпляра уже не трогают его ключи
+            with _owned_lock:
+                for shard in release:
+                    _owned_shards.pop(shard, None)
+        db.commit()
+
+    with _owned_lock:
+        before = set(_owned_shards)
+        _owned_shards.clear()
+        _owned_shards.update({shard: expires_at.replace(tzinfo=timezone.utc) for shard in acquired})
+
+    if set(acquired) != before:
+        timer_logger.info(
+            f"Шарды экземпляра {INSTANCE_ID}: {sorted(acquired)} "
+            f"(доля {fair_share} из {TIMER_SHARDS}, экземпляров {len(live_members)})"
+        )
+
+
+def renew_job_leases(session_factory, jobs):
+    """Захватывает или продлевает аренды задач: "job:<имя>" держит один экземпляр."""
+    naive_now = datetime.now(timezone.utc).replace(tzinfo=None)
+    expires_at = naive_now + LEASE_TTL
+    names = {job_lease_name(job): job for job in jobs}
+
+    with session_factory() as db:
+        ensure_lease_rows(db, list(names))
+        held = {job: try_acquire(db, name, expires_at, naive_now) for name, job in names.items()}
+        db.commit()
+
+    with _owned_lock:
+        gained = [job for job, ok in held.items() if ok and job not in _held_jobs]
+        lost = [job for job, ok in held.items() if not ok and job in _held_jobs]
+        for job, ok in held.items():
+            if ok:
+                _held_jobs[job] = expires_at.replace(tzinfo=timezone.utc)
+            else:
+                _held_jobs.pop(job, None)
+
+    if gained:
+        timer_logger.info(f"Экземпляр {INSTANCE_ID} стал владельцем задач: {gained}")
+    if lost:
+        timer_logger.warning(f"Экземпляр {INSTANCE_ID} потерял аренду задач: {lost}")
+
+
+def holds_job(job):
+    """True, если задачу в этом экземпляре можно запускать (при шардировании — всегда)."""
+    if SHARDING_ENABLED:
+        return True
+    with _owned_lock:
+        expires_at = _held_jobs.get(job)
+    return lease_is_valid(expires_at)
+
+
+def held_jobs():
+    with _owned_lock:
+        return sorted(job for job, expires_at in _held_jobs.items() if lease_is_valid(expires_at))
+
+
+def heartbeat_once(session_factory, jobs):
+    """Одно продление: шарды при шардировании, иначе аренды задач."""
+    try:
+        if SHARDING_ENABLED:
+            renew_leases(session_factory)
+        else:
+            renew_job_leases(session_factory, jobs)
+    except Exception as e:
+        timer_logger.error(f"Не удалось продлить аренды экземпляра {INSTANCE_ID}: {e}")
+
+
+def start_heartbeat(session_factory, jobs, stop_event):
+    """Фоновый поток, продлевающий аренды каждые HEARTBEAT_INTERVAL секунд до остановки."""
+    def loop():
+        while not stop_event.wait(HEARTBEAT_INTERVAL):
+            heartbeat_once(session_factory, jobs)
+
+    thread = threading.Thread(target=loop, name="lease-heartbeat", daemon=True)
+    thread.start()
+    return thread
+
+
+def release_leases(session_factory):
+    """Отдаёт все свои аренды при остановке, чтобы шарды и задачи сразу подхватили остальные."""
+    with _owned_lock:
+        _owned_shards.clear()
+        _held_jobs.clear()
+    with session_factory() as db:
+        db.execute(update(TimerLease).where(TimerLease.owner == INSTANCE_ID).values(owner=None, expires_at=None))
+        db.commit()
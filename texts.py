@@ -55,6 +55,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Отправить координаты',
         'error_no_city': '⚠ Для начала укажите свой город.',
         'error_weather_fetch': '⚠ Не удалось получить данные о погоде.',
+        'weather_service_unavailable': '⏳ Погодный сервис временно недоступен. Попробуйте чуть позже.',
         'weather_current_header': 'Сейчас в г.{city}:',
         'weather_footer': '⛄️ Одевайтесь теплее!',
         'changecity_current': '▸ Ваш текущий город — {city}. \n\nВведите название нового города для обновления.',
@@ -301,6 +302,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Send Coordinates',
         'error_no_city': '⚠ Please set your city first.',
         'error_weather_fetch': '⚠ Could not retrieve weather data.',
+        'weather_service_unavailable': '⏳ The weather service is temporarily unavailable. Please try again a bit later.',
         'weather_current_header': 'Current weather in {city}:',
         'weather_footer': '⛄️ Dress warmly!',
         'changecity_current': '▸ Your current city is {city}. \n\nEnter the new city name to update.',
@@ -507,6 +509,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Координаттарды жіберу',
         'error_no_city': '⚠ Алдымен қалаңызды көрсетіңіз.',
         'error_weather_fetch': '⚠ Ауа райы деректерін алу мүмкін болмады.',
+        'weather_service_unavailable': '⏳ Ауа райы қызметі уақытша қолжетімсіз. Сәл кейінірек қайталап көріңіз.',
         'weather_current_header': '{city} қаласындағы ауа райы:',
         'weather_footer': '⛄️ Жылы киініңіз!',
         'changecity_current': '▸ Сіздің қазіргі қалаңыз — {city}. \n\nЖаңарту үшін жаңа қала атын енгізіңіз.',
@@ -754,6 +757,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Koordinaten senden',
         'error_no_city': '⚠ Bitte geben Sie zuerst eine Stadt an.',
         'error_weather_fetch': '⚠ Wetterdaten konnten nicht abgerufen werden.',
+        'weather_service_unavailable': '⏳ Der Wetterdienst ist vorübergehend nicht erreichbar. Bitte versuchen Sie es etwas später erneut.',
         'weather_current_header': 'Aktuelles Wetter in {city}:',
         'weather_footer': '⛄️ Ziehen Sie sich warm an!',
         'changecity_current': '▸ Ihre aktuelle Stadt ist {city}. \n\nGeben Sie den neuen Stadtnamen ein.',
@@ -1008,6 +1012,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Envoyer coordonnées',
         'error_no_city': "⚠ Veuillez d'abord définir votre ville.",
         'error_weather_fetch': '⚠ Impossible de récupérer les données météo.',
+        'weather_service_unavailable': '⏳ Le service météo est temporairement indisponible. Veuillez réessayer un peu plus tard.',
         'weather_current_header': 'Météo actuelle à {city} :',
         'weather_footer': '⛄️ Habillez-vous chaudement !',
         'changecity_current': '▸ Votre ville actuelle est {city}. \n\nEntrez le nouveau nom de la ville.',
@@ -1254,6 +1259,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 Invia Coordinate',
         'error_no_city': '⚠ Per favore imposta prima la tua città.',
         'error_weather_fetch': '⚠ Impossibile recuperare i dati meteo.',
+        'weather_service_unavailable': '⏳ Il servizio meteo è temporaneamente non disponibile. Riprova tra poco.',
         'weather_current_header': 'Meteo attuale a {city}:',
         'weather_footer': '⛄️ Copriti bene!',
         'changecity_current': '▸ La tua città attuale è {city}. \n\nInserisci il nuovo nome della città.',
@@ -1506,6 +1512,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 发送坐标',
         'error_no_city': '⚠ 请先设置您的城市。',
         'error_weather_fetch': '⚠ 无法获取天气数据。',
+        'weather_service_unavailable': '⏳ 天气服务暂时不可用，请稍后再试。',
         'weather_current_header': '{city} 当前天气：',
         'weather_footer': '⛄️ 注意保暖！',
         'changecity_current': '▸ 您当前的城市是 {city}。\n\n请输入新的城市名称进行更新。',
@@ -1741,6 +1748,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 좌표 보내기',
         'error_no_city': '⚠ 먼저 도시를 설정해 주세요.',
         'error_weather_fetch': '⚠ 날씨 데이터를 가져올 수 없습니다.',
+        'weather_service_unavailable': '⏳ 날씨 서비스를 일시적으로 사용할 수 없습니다. 잠시 후 다시 시도해 주세요.',
         'weather_current_header': '{city} 현재 날씨:',
         'weather_footer': '⛄️ 따뜻하게 입으세요!',
         'changecity_current': '▸ 현재 도시는 {city}입니다. \n\n새로운 도시 이름을 입력하세요.',
@@ -1976,6 +1984,7 @@ TEXTS = {'ru': {'unknown_command': '😔 Я вас не понял. Исполь
         'button_geo': '📍 座標を送信',
         'error_no_city': '⚠ まず都市を設定してください。',
         'error_weather_fetch': '⚠ 気象データを取得できませんでした。',
+        'weather_service_unavailable': '⏳ 天気サービスは一時的に利用できません。しばらくしてからもう一度お試しください。',
         'weather_current_header': '{city}の現在の天気：',
         'weather_footer': '⛄️ 暖かくしてお過ごしください！',
         'changecity_current': '▸ 現在の都市は{city}です。\n\n新しい都市名を入力して更新してください。',
@@ -1,25 +1,676 @@
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict, fields
 from dotenv import load_dotenv
 from timezonefinder import TimezoneFinder
 from datetime import datetime, timedelta
+import numpy as np
 import requests
+import logging
+import sqlite3
+import threading
+import json
+import time
+import contextvars
+import zlib
 import os
 import re
 from texts import get_api_lang_code
 
 load_dotenv()
 
+# Модуль общий для бота и таймера: обработчики логгера подключает процесс (bot.py / weather_timer.py)
+weather_logger = logging.getLogger("weather")
+
+
+#РАЗБОР JSON
+# Быстрые парсеры необязательны: orjson → msgspec → стандартный json
+try:
+    import orjson
+    decode_json = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+        decode_json = msgspec.json.Decoder().decode
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        decode_json = json.loads
+        JSON_BACKEND = "json"
+
+
+#ЗАПИСИ ПОГОДНЫХ ДАННЫХ
+class RecordMapping:
+    """
+    Доступ к полям записи и как к атрибутам, и как к ключам словаря —
+    для форматтеров, которые принимают и записи, и обычные dict.
+    Поле со значением None считается отсутствующим.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def keys(self):
+        return [f.name for f in fields(self)]
+
+    def as_dict(self):
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class CurrentReading(RecordMapping):
+    """Текущая погода в городе (/weather)."""
+    city_name: str
+    temp: float
+    feels_like: float
+    description: str
+    humidity: int
+    wind_speed: float
+    wind_direction: int
+    wind_gust: float
+    clouds: int
+    pressure: int
+    visibility: int
+    lat: float
+    lon: float
+    precipitation: float = None
+    city_id: int = None  # id города в OpenWeather
+
+
+@dataclass(slots=True)
+class ForecastSlot(RecordMapping):
+    """
+    Один 3-часовой слот прогноза (/forecast). Из ответа берутся только нужные боту поля,
+    остальное (sys, dt_txt, city.population и т.п.) отбрасывается сразу при разборе.
+    """
+    dt: int
+    temp: float
+    feels_like: float
+    temp_min: float
+    temp_max: float
+    humidity: int
+    visibility: int
+    pressure: int
+    wind_speed: float
+    wind_direction: int
+    wind_gust: float
+    clouds: int
+    description: str
+    precipitation: int
+    pop: float = 0.0
+    weather_id: int = 0
+    weather_main: str = ""
+    rain: float = 0.0
+    snow: float = 0.0
+
+
+@dataclass(slots=True)
+class DaySummary(RecordMapping):
+    """Сводка прогноза за локальный день."""
+    date: str
+    temp_min: float
+    temp_max: float
+    temp: float
+    feels_like: float
+    humidity: float
+    wind_speed: float
+    precipitation: int
+    descriptions: list
+    pressure: int
+    clouds: int
+    visibility: int
+    wind_direction: int
+    wind_gust: float
+    day_name: str = None
+
+
+#КЭШ ОТВЕТОВ OPENWEATHER НА ДИСКЕ
+# Сырые ответы API хранятся сжатыми в SQLite, чтобы после перезапуска бота или таймера
+# свежие данные отдавались сразу, а в API уходили только запросы по устаревшим записям.
+API_URLS = {
+    "weather": "https://api.openweathermap.org/data/2.5/weather",
+    "forecast": "https://api.openweathermap.org/data/2.5/forecast",
+    "geo_reverse": "https://api.openweathermap.org/geo/1.0/reverse",
+}
+RESPONSE_CACHE_TTL = {
+    "weather": 10 * 60,
+    "forecast": 30 * 60,
+    "geo_reverse": 30 * 24 * 3600,
+}
+# Сколько после TTL запись ещё можно отдать интерактивному запросу, обновляя её в фоне
+RESPONSE_CACHE_STALE_TTL = {
+    "weather": 60 * 60,
+    "forecast": 3 * 3600,
+    "geo_reverse": 90 * 24 * 3600,
+}
+COORD_PRECISION = 2  # Знаков после запятой в ключе города (~1 км): одинаковые города делят кэш
+RESPONSE_CACHE_PATH = os.getenv("WEATHER_CACHE_PATH", "weather_cache.sqlite3")
+RESPONSE_CACHE_MAX_AGE = 7 * 24 * 3600  # Записи старше этого удаляются при открытии кэша
+API_TIMEOUT = 10
+
+_response_cache_conn = None
+_response_cache_lock = threading.Lock()
+_background_refreshes = set()
+_background_refreshes_lock = threading.Lock()
+_inflight_requests = {}
+_inflight_lock = threading.Lock()
+single_flight_stats = {}  # эндпоинт -> {"requests": HTTP-запросов, "coalesced": присоединившихся к чужому}
+
+
+def get_response_cache():
+    """Открывает (один раз на процесс) SQLite-кэш ответов. None, если файл недоступен."""
+    global _response_cache_conn
+    if _response_cache_conn is None:
+        try:
+            conn = sqlite3.connect(RESPONSE_CACHE_PATH, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "cache_key TEXT PRIMARY KEY, fetched_at REAL NOT NULL, body BLOB NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS api_calls (called_at REAL NOT NULL, priority TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS api_calls_called_at ON api_calls (called_at)")
+            conn.execute(
+                "DELETE FROM responses WHERE fetched_at < ? AND cache_key NOT LIKE 'geo_reverse|%'",
+                (time.time() - RESPONSE_CACHE_MAX_AGE,)
+            )
+            conn.commit()
+            _response_cache_conn = conn
+        except sqlite3.Error as e:
+            weather_logger.warning(f"⚠ Кэш ответов недоступен ({RESPONSE_CACHE_PATH}): {e}")
+            return None
+    return _response_cache_conn
+
+
+def response_cache_key(endpoint, params):
+    """Ключ кэша: эндпоинт + параметры запроса (без appid), город без учёта регистра."""
+    parts = [endpoint]
+    for name in sorted(params):
+        value = params[name]
+        if name == "q":
+            value = str(value).strip().lower()
+        parts.append(f"{name}={value}")
+    return "|".join(parts)
+
+
+def read_cached_response(cache_key):
+    """Возвращает (тело ответа, время загрузки) из кэша или (None, None)."""
+    with _response_cache_lock:
+        conn = get_response_cache()
+        if conn is None:
+            return None, None
+        try:
+            row = conn.execute(
+                "SELECT body, fetched_at FROM responses WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            weather_logger.warning(f"⚠ Ошибка чтения кэша ответов: {e}")
+            return None, None
+    if row is None:
+        return None, None
+    return zlib.decompress(row[0]), row[1]
+
+
+def store_cached_response(cache_key, body, fetched_at=None):
+    """Сохраняет сжатое тело ответа в кэш."""
+    with _response_cache_lock:
+        conn = get_response_cache()
+        if conn is None:
+            return
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (cache_key, fetched_at, body) VALUES (?, ?, ?)",
+                (cache_key, fetched_at or time.time(), zlib.compress(body, 6))
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            weather_logger.warning(f"⚠ Ошибка записи в кэш ответов: {e}")
+
+
+#КВОТА ЗАПРОСОВ К OPENWEATHER
+# Бот и таймер тратят один ключ API, поэтому вызовы учитываются в общем SQLite-файле кэша:
+# в скользящем окне QUOTA_WINDOW секунд — не больше QUOTA_LIMIT вызовов. Класс приоритета
+# может занять окно только до своей доли QUOTA_SHARE, оставляя запас старшим классам;
+# при нехватке вызов ждёт (backpressure) не дольше QUOTA_MAX_WAIT своего класса, затем
+# получает QuotaExceeded и, как при любой сетевой ошибке, устаревшие данные из кэша.
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_ALERT = "alert"
+PRIORITY_BROADCAST = "broadcast"
+PRIORITY_GEOCODE = "geocode"
+
+QUOTA_WINDOW = 60
+QUOTA_LIMIT = int(os.getenv("OPENWEATHER_CALLS_PER_MINUTE", "60"))
+QUOTA_SHARE = {
+    PRIORITY_INTERACTIVE: 1.0,
+    PRIORITY_ALERT: 0.85,
+    PRIORITY_BROADCAST: 0.6,
+    PRIORITY_GEOCODE: 0.4,
+}
+QUOTA_MAX_WAIT = {  # секунд
+    PRIORITY_INTERACTIVE: 2,
+    PRIORITY_ALERT: 30,
+    PRIORITY_BROADCAST: 120,
+    PRIORITY_GEOCODE: 10,
+}
+
+# Класс запросов текущего потока; по умолчанию — интерактивные запросы бота
+_api_priority = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+_strict_api_errors = contextvars.ContextVar("strict_api_errors", default=False)
+quota_stats = {}  # класс -> {"granted": выдано, "waited": из них после ожидания, "rejected": отказано}
+_quota_stats_lock = threading.Lock()
+
+
+class QuotaExceeded(requests.RequestException):
+    """Квота OpenWeather для класса запроса исчерпана и не освободилась за время ожидания."""
+
+
+@contextmanager
+def api_priority(priority):
+    """Все запросы к OpenWeather внутри блока учитываются в квоте как priority."""
+    token = _api_priority.set(priority)
+    try:
+        yield
+    finally:
+        _api_priority.reset(token)
+
+
+@contextmanager
+def strict_api_errors():
+    """
+    Внутри блока сбои запросов к OpenWeather (сеть, 5xx/429, квота, предохранитель) пробрасываются
+    из fetch_api_response, а не заменяются кэшем или None: так None остаётся только ответом
+    «не найдено», и пакетные задачи (бэкфилл местоположений) отличают его от временного сбоя.
+    """
+    token = _strict_api_errors.set(True)
+    try:
+        yield
+    finally:
+        _strict_api_errors.reset(token)
+
+
+def current_api_priority(endpoint):
+    """Класс запроса: обратное геокодирование — всегда geocode, остальное — по контексту потока."""
+    return PRIORITY_GEOCODE if endpoint == "geo_reverse" else _api_priority.get()
+
+
+def try_acquire_quota(priority, now):
+    """
+    Одна попытка занять место в окне. Возвращает 0, если место занято (или учёт недоступен),
+    иначе — сколько секунд ждать, пока из окна выйдет достаточно старых вызовов.
+    """
+    limit = max(1, int(QUOTA_LIMIT * QUOTA_SHARE[priority]))
+    with _response_cache_lock:
+        conn = get_response_cache()
+        if conn is None:
+            return 0
+        try:
+            # IMMEDIATE — проверка и запись атомарны и для другого процесса
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM api_calls WHERE called_at <= ?", (now - QUOTA_WINDOW,))
+            used = conn.execute("SELECT COUNT(*) FROM api_calls").fetchone()[0]
+            if used < limit:
+                conn.execute("INSERT INTO api_calls (called_at, priority) VALUES (?, ?)", (now, priority))
+                conn.commit()
+                return 0
+            freed_at = conn.execute(
+                "SELECT called_at FROM api_calls ORDER BY called_at LIMIT 1 OFFSET ?", (used - limit,)
+            ).fetchone()[0]
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            weather_logger.warning(f"⚠ Учёт квоты OpenWeather недоступен: {e}")
+            return 0
+    return max(freed_at + QUOTA_WINDOW - now, 0.05)
+
+
+def acquire_quota(priority):
+    """Занимает место в квоте, при нехватке ждёт; не дождавшись за QUOTA_MAX_WAIT — QuotaExceeded."""
+    deadline = time.monotonic() + QUOTA_MAX_WAIT[priority]
+    waited = False
+    while True:
+        delay = try_acquire_quota(priority, time.time())
+        if delay == 0:
+            break
+        if time.monotonic() + delay > deadline:
+            with _quota_stats_lock:
+                quota_stats.setdefault(priority, {"granted": 0, "waited": 0, "rejected": 0})["rejected"] += 1
+            raise QuotaExceeded(f"квота OpenWeather для класса {priority} исчерпана")
+        waited = True
+        time.sleep(delay)
+
+    with _quota_stats_lock:
+        stats = quota_stats.setdefault(priority, {"granted": 0, "waited": 0, "rejected": 0})
+        stats["granted"] += 1
+        stats["waited"] += waited
+
+
+def get_quota_stats():
+    """Снимок счётчиков квоты по классам."""
+    with _quota_stats_lock:
+        return {priority: dict(stats) for priority, stats in quota_stats.items()}
+
+
+#ПРЕДОХРАНИТЕЛЬ (CIRCUIT BREAKER)
+# Когда OpenWeather деградирует, каждый обработчик и каждый город таймера ждали бы таймаута.
+# Предохранитель эндпоинта считает ошибки и медленные ответы за BREAKER_WINDOW секунд и при
+# превышении порогов размыкается: запросы сразу получают CircuitOpen, а вызывающие — данные
+# из кэша или сообщение о недоступности. Через BREAKER_OPEN_SECONDS пропускается по одной
+# пробе (half-open); BREAKER_PROBES успешных подряд замыкают его снова. Состояние — в памяти процесса.
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+BREAKER_WINDOW = 60
+BREAKER_MIN_CALLS = 5  # Меньше вызовов в окне — пороги не проверяются
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_SECONDS = 5.0
+BREAKER_SLOW_RATE = 0.5
+BREAKER_OPEN_SECONDS = 30
+BREAKER_PROBES = 2
+
+
+class CircuitOpen(requests.RequestException):
+    """Эндпоинт OpenWeather временно отключён предохранителем."""
+
+
+@dataclass
+class CircuitBreaker:
+    """Предохранитель одного эндпоинта."""
+    endpoint: str
+    state: str = BREAKER_CLOSED
+    opened_at: float = 0.0
+    outcomes: deque = field(default_factory=deque)  # (время, ошибка, медленный ответ)
+    probe_token: int = 0  # Токен выполняющейся пробы half-open (0 — пробы нет)
+    last_token: int = 0
+    probe_successes: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def rejects_requests(self):
+        """True, если запрос сейчас получил бы отказ (состояние не меняется)."""
+        with self.lock:
+            if self.state == BREAKER_OPEN:
+                return time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS
+            return self.state == BREAKER_HALF_OPEN and self.probe_token != 0
+
+    def allow_request(self):
+        """
+        Резервирует запрос: None — отказ; 0 — обычный запрос (предохранитель замкнут);
+        иначе токен пробы half-open (одна за раз), который передаётся в record().
+        """
+        with self.lock:
+            if self.state == BREAKER_CLOSED:
+                return 0
+            if self.state == BREAKER_OPEN:
+                if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                    return None
+                self.state = BREAKER_HALF_OPEN
+                self.probe_successes = 0
+                weather_logger.info(f"⚡ OpenWeather ({self.endpoint}): предохранитель в half-open, пробные запросы.")
+            if self.probe_token:
+                return None
+            self.last_token += 1
+            self.probe_token = self.last_token
+            return self.probe_token
+
+    def record(self, token, ok, seconds):
+        """
+        Учитывает результат запроса с токеном из allow_request(): ok — ответ получен и это не 5xx/429.
+        В half-open считается только текущая проба: запросы, начатые до размыкания, на неё не влияют.
+        """
+        now = time.monotonic()
+        slow = seconds >= BREAKER_SLOW_SECONDS
+        with self.lock:
+            if self.state == BREAKER_HALF_OPEN:
+                if not token or token != self.probe_token:
+                    return
+                self.probe_token = 0
+                if ok and not slow:
+                    self.probe_successes += 1
+                    if self.probe_successes >= BREAKER_PROBES:
+                        self.state = BREAKER_CLOSED
+                        self.outcomes.clear()
+                        weather_logger.info(f"⚡ OpenWeather ({self.endpoint}): предохранитель замкнут.")
+                else:
+                    self._trip(now, "пробный запрос не прошёл")
+                return
+            if self.state == BREAKER_OPEN or token:
+                return  # Запрос начался до размыкания (или проба, уже не текущая)
+
+            self.outcomes.append((now, not ok, slow))
+            while self.outcomes and self.outcomes[0][0] < now - BREAKER_WINDOW:
+                self.outcomes.popleft()
+            total = len(self.outcomes)
+            if total < BREAKER_MIN_CALLS:
+                return
+            errors = sum(failed for _, failed, _ in self.outcomes)
+            slow_calls = sum(is_slow for _, _, is_slow in self.outcomes)
+            if errors / total >= BREAKER_ERROR_RATE or slow_calls / total >= BREAKER_SLOW_RATE:
+                self._trip(now, f"ошибок {errors}/{total}, медленных {slow_calls}/{total}")
+
+    def _trip(self, now, reason):
+        self.state = BREAKER_OPEN
+        self.opened_at = now
+        self.outcomes.clear()
+        self.probe_token = 0
+        weather_logger.warning(f"⚡ OpenWeather ({self.endpoint}): предохранитель разомкнут на {BREAKER_OPEN_SECONDS}s ({reason}).")
+
+
+circuit_breakers = {endpoint: CircuitBreaker(endpoint) for endpoint in API_URLS}
+
+
+def is_service_unavailable(endpoint="weather"):
+    """True, если запросы к эндпоинту сейчас отклоняются предохранителем."""
+    return circuit_breakers[endpoint].rejects_requests()
+
+
+def get_circuit_states():
+    """Снимок состояний предохранителей по эндпоинтам."""
+    return {endpoint: breaker.state for endpoint, breaker in circuit_breakers.items()}
+
+
+def request_api_response(endpoint, params, cache_key, priority=PRIORITY_INTERACTIVE):
+    """
+    HTTP-запрос к OpenWeather через предохранитель эндпоинта и в пределах квоты класса priority;
+    успешный ответ сохраняется в кэш. Возвращает тело ответа или None для ответа с ошибкой
+    (404 — город не найден и прочие 4xx); сбои сервиса (5xx, 429 — HTTPError), сетевые ошибки,
+    CircuitOpen и QuotaExceeded пробрасываются.
+    """
+    breaker = circuit_breakers[endpoint]
+    # Пока предохранитель разомкнут, квоту не тратим и не ждём
+    if breaker.rejects_requests():
+        raise CircuitOpen(f"OpenWeather ({endpoint}) временно отключён предохранителем")
+    acquire_quota(priority)
+    # Пробу half-open занимаем только перед самим запросом: ожидание квоты рассылкой
+    # не должно держать пробу и отказывать интерактивным вызовам
+    token = breaker.allow_request()
+    if token is None:
+        raise CircuitOpen(f"OpenWeather ({endpoint}) временно отключён предохранителем")
+
+    started = time.monotonic()
+    try:
+        response = requests.get(
+            API_URLS[endpoint],
+            params={**params, "appid": os.getenv("WEATHER_API_KEY")},
+            timeout=API_TIMEOUT
+        )
+    except requests.RequestException:
+        breaker.record(token, False, time.monotonic() - started)
+        raise
+    # 404 (город не найден) и прочие 4xx — ответ сервиса, а не его деградация
+    breaker.record(token, response.status_code < 500 and response.status_code != 429, time.monotonic() - started)
+
+    if response.status_code >= 500 or response.status_code == 429:
+        raise requests.HTTPError(f"OpenWeather ({endpoint}) вернул {response.status_code}", response=response)
+    if response.status_code != 200:
+        weather_logger.debug(f"OpenWeather ({endpoint}) вернул {response.status_code} для {params}")
+        return None
+
+    store_cached_response(cache_key, response.content)
+    return response.content
+
+
+@dataclass
+class InFlightRequest:
+    """Выполняющийся HTTP-запрос, результат которого ждут все присоединившиеся вызовы."""
+    done: threading.Event = field(default_factory=threading.Event)
+    body: bytes = None
+    error: Exception = None
+    waiters: int = 0
+
+
+def single_flight_request(endpoint, params, cache_key, priority=PRIORITY_INTERACTIVE):
+    """
+    request_api_response с объединением одновременных одинаковых запросов (эндпоинт, город, язык):
+    первый вызов делает HTTP-запрос (в квоте своего класса), остальные ждут его и получают
+    тот же результат (или ошибку). Присоединившийся ждёт не дольше, чем допускает его собственный
+    класс: интерактивный вызов за рассылкой, ждущей квоту, получит QuotaExceeded через свои
+    QUOTA_MAX_WAIT, а не через её.
+    """
+    with _inflight_lock:
+        stats = single_flight_stats.setdefault(endpoint, {"requests": 0, "coalesced": 0})
+        flight = _inflight_requests.get(cache_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _inflight_requests[cache_key] = InFlightRequest()
+            stats["requests"] += 1
+        else:
+            flight.waiters += 1
+            stats["coalesced"] += 1
+
+    if not is_leader:
+        if not flight.done.wait(QUOTA_MAX_WAIT[priority] + API_TIMEOUT):
+            raise QuotaExceeded(f"OpenWeather ({endpoint}): общий запрос не завершился за время ожидания класса {priority}")
+        if flight.error is not None:
+            raise flight.error
+        return flight.body
+
+    try:
+        flight.body = request_api_response(endpoint, params, cache_key, priority)
+        return flight.body
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight_requests[cache_key]
+        flight.done.set()
+        if flight.waiters:
+            weather_logger.debug(f"single-flight {cache_key}: к запросу присоединились {flight.waiters} вызовов")
+
+
+def get_single_flight_stats():
+    """Снимок счётчиков single-flight по эндпоинтам."""
+    with _inflight_lock:
+        return {endpoint: dict(stats) for endpoint, stats in single_flight_stats.items()}
+
+
+def refresh_in_background(endpoint, params, cache_key, priority=PRIORITY_INTERACTIVE):
+    """
+    Обновляет запись кэша в фоновом потоке; одновременно по ключу идёт не больше одного обновления.
+    Класс квоты передаётся явно — у нового потока свой контекст.
+    """
+    with _background_refreshes_lock:
+        if cache_key in _background_refreshes:
+            return
+        _background_refreshes.add(cache_key)
+
+    def worker():
+        try:
+            single_flight_request(endpoint, params, cache_key, priority)
+        except requests.RequestException as e:
+            weather_logger.warning(f"⚠ Фоновое обновление {cache_key} не удалось: {e}")
+        finally:
+            with _background_refreshes_lock:
+                _background_refreshes.discard(cache_key)
+
+    threading.Thread(target=worker, name=f"refresh:{cache_key}", daemon=True).start()
+
+
+def fetch_api_response(endpoint, params, allow_stale=False):
+    """
+    Единая точка запросов к OpenWeather: тело ответа (bytes) из кэша, если запись моложе TTL
+    эндпоинта, иначе из API с сохранением в кэш.
+    allow_stale=True (интерактивные запросы): запись старше TTL, но моложе RESPONSE_CACHE_STALE_TTL,
+    отдаётся сразу, а обновление уходит в фон — блокирует только холодный промах.
+    Если API недоступен, разомкнут предохранитель или квота класса запроса исчерпана, отдаёт
+    устаревшую запись из кэша, но не старше RESPONSE_CACHE_STALE_TTL — иначе None.
+    Ответы с ошибкой не кэшируются — для них возвращается None.
+    """
+    cache_key = response_cache_key(endpoint, params)
+    priority = current_api_priority(endpoint)
+    body, fetched_at = read_cached_response(cache_key)
+    if body is not None:
+        age = time.time() - fetched_at
+        if age < RESPONSE_CACHE_TTL[endpoint]:
+            return body
+        if allow_stale and age < RESPONSE_CACHE_STALE_TTL[endpoint]:
+            refresh_in_background(endpoint, params, cache_key, priority)
+            return body
+
+    # Запасной вариант при ошибке: рассылка не должна строиться по данным многодневной давности
+    if body is not None and time.time() - fetched_at >= RESPONSE_CACHE_STALE_TTL[endpoint]:
+        body = None
+
+    try:
+        return single_flight_request(endpoint, params, cache_key, priority)
+    except CircuitOpen:
+        if _strict_api_errors.get():
+            raise
+        return body  # Без предупреждения в лог: размыкание уже залогировано
+    except requests.RequestException as e:
+        if _strict_api_errors.get():
+            raise
+        weather_logger.warning(f"⚠ Запрос к OpenWeather ({endpoint}) не удался: {e}")
+        return body
+
+
+def canonical_coords(lat, lon):
+    """Координаты, округлённые до COORD_PRECISION, — по ним совпадают одинаковые города."""
+    return round(lat, COORD_PRECISION), round(lon, COORD_PRECISION)
+
+
+def coord_key(lat, lon):
+    """Строковый канонический ключ местоположения: "55.75,37.62"."""
+    lat, lon = canonical_coords(lat, lon)
+    return f"{lat:.{COORD_PRECISION}f},{lon:.{COORD_PRECISION}f}"
+
+
+def location_params(city, coords=None):
+    """
+    Параметры местоположения для запроса: округлённые lat/lon, если координаты известны
+    (канонический ключ города), иначе введённое название.
+    """
+    if coords:
+        lat, lon = canonical_coords(*coords)
+        return {"lat": lat, "lon": lon}
+    return {"q": city}
+
+
 def is_latin(text):
     """Проверяет, состоит ли текст только из латиницы."""
     return bool(re.match(r'^[a-zA-Z\s\-]+$', text))
 
-def get_weather(city, lang="ru"):
-    WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+def get_weather(city, lang="ru", allow_stale=False, coords=None):
     api_lang = get_api_lang_code(lang)
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric&lang={api_lang}"
-    
-    response = requests.get(url)
-    response_data = response.json()
-    
+    payload = fetch_api_response(
+        "weather", {**location_params(city, coords), "units": "metric", "lang": api_lang},
+        allow_stale=allow_stale
+    )
+    if payload is None:
+        return None
+
+    response_data = decode_json(payload)
     if response_data.get("cod") != 200:
         return None
 
@@ -28,59 +679,129 @@ def get_weather(city, lang="ru"):
     lat = response_data["coord"]["lat"]
     lon = response_data["coord"]["lon"]
 
+    # По координатам API называет ближайший населённый пункт/район — показываем город пользователя
+    if coords and city:
+        city_name = city
     # Если мы просим 'ru', а нам вернули латиницу (Almaty), пробуем получить локальное имя.
-    if api_lang == "ru" and is_latin(city_name):
-        localized_name = resolve_city_from_coords(lat, lon, lang)
+    elif api_lang == "ru" and is_latin(city_name):
+        localized_name = resolve_city_from_coords(lat, lon, lang, allow_stale=allow_stale)
         if localized_name:
             city_name = localized_name
 
-    return {
-        "city_name": city_name, 
-        "temp": response_data["main"]["temp"],
-        "feels_like": response_data["main"]["feels_like"],
-        "description": response_data["weather"][0]["description"],
-        "humidity": response_data["main"]["humidity"],
-        "wind_speed": response_data["wind"]["speed"],
-        "wind_direction": response_data["wind"].get("deg", 0),  
-        "wind_gust": response_data["wind"].get("gust", 0), 
-        "clouds": response_data["clouds"].get("all", 0),
-        "pressure": round(response_data["main"]["pressure"]),
-        "visibility": response_data.get("visibility", 0),
-        "coordinates": {
-            "lat": lat,
-            "lon": lon
-        }  
-    }
+    return CurrentReading(
+        city_name=city_name,
+        temp=response_data["main"]["temp"],
+        feels_like=response_data["main"]["feels_like"],
+        description=response_data["weather"][0]["description"],
+        humidity=response_data["main"]["humidity"],
+        wind_speed=response_data["wind"]["speed"],
+        wind_direction=response_data["wind"].get("deg", 0),
+        wind_gust=response_data["wind"].get("gust", 0),
+        clouds=response_data["clouds"].get("all", 0),
+        pressure=round(response_data["main"]["pressure"]),
+        visibility=response_data.get("visibility", 0),
+        lat=lat,
+        lon=lon,
+        city_id=response_data.get("id") or None
+    )
 
-def fetch_weekly_forecast(city, lang="ru"):
-    WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+def fetch_forecast(city, lang="ru", allow_stale=False, coords=None):
+    """3-часовой прогноз на 5 дней (/forecast) в виде списка ForecastSlot."""
     api_lang = get_api_lang_code(lang)
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang={api_lang}"
+    payload = fetch_api_response(
+        "forecast", {**location_params(city, coords), "units": "metric", "lang": api_lang},
+        allow_stale=allow_stale
+    )
+    if payload is None:
+        return None
+    return parse_forecast_payload(payload)
+
+def fetch_weekly_forecast(city, lang="ru", allow_stale=False, coords=None):
+    return fetch_forecast(city, lang, allow_stale, coords)
+
+def parse_forecast_slot(item):
+    """Собирает ForecastSlot из одной записи /forecast, не сохраняя остальное дерево."""
+    main = item["main"]
+    wind = item.get("wind") or {}
+    weather = (item.get("weather") or [{}])[0]
+    temp = main["temp"]
+    pop = item.get("pop")
 
-    response = requests.get(url)
-    response_data = response.json()
+    return ForecastSlot(
+        dt=item["dt"],
+        temp=temp,
+        feels_like=main.get("feels_like", temp),
+        temp_min=main.get("temp_min", temp),
+        temp_max=main.get("temp_max", temp),
+        humidity=main.get("humidity"),
+        visibility=item.get("visibility"),
+        pressure=main.get("pressure"),
+        wind_speed=wind.get("speed"),
+        wind_direction=wind.get("deg"),
+        wind_gust=wind.get("gust"),
+        clouds=(item.get("clouds") or {}).get("all"),
+        description=weather.get("description", ""),
+        precipitation=round(pop * 100) if pop is not None else None,
+        pop=pop or 0.0,
+        weather_id=weather.get("id", 0),
+        weather_main=weather.get("main", ""),
+        rain=(item.get("rain") or {}).get("3h", 0.0),
+        snow=(item.get("snow") or {}).get("3h", 0.0)
+    )
 
+def parse_forecast_payload(payload):
+    """
+    Разбирает тело ответа /forecast (bytes/str) в список ForecastSlot.
+    Возвращает None, если API ответил ошибкой.
+    """
+    response_data = decode_json(payload)
     if response_data.get("cod") != "200":
         return None
+    return [parse_forecast_slot(item) for item in response_data["list"]]
 
-    return response_data["list"]
+def parse_forecast_columns(forecast_list):
+    """
+    Раскладывает список ForecastSlot по колонкам NumPy,
+    чтобы агрегировать их векторно, а не обходить записи в циклах.
+    Отсутствующие значения заменяются на default колонки.
+    """
+    count = len(forecast_list)
 
-def resolve_city_from_coords(lat, lon, lang="ru"):
+    def column(name, default=np.nan, dtype=float):
+        values = (getattr(slot, name) for slot in forecast_list)
+        return np.fromiter((default if v is None else v for v in values), dtype=dtype, count=count)
+
+    return {
+        "dt": column("dt", 0, np.int64),
+        "temp": column("temp"),
+        "feels_like": np.fromiter(
+            (slot.temp if slot.feels_like is None else slot.feels_like for slot in forecast_list),
+            dtype=float, count=count
+        ),
+        "humidity": column("humidity"),
+        "pressure": column("pressure"),
+        "wind_speed": column("wind_speed", 0),
+        "wind_deg": column("wind_direction", 0),
+        "wind_gust": column("wind_gust", 0),
+        "clouds": column("clouds"),
+        "pop": column("pop", 0),
+        "visibility": column("visibility"),
+        "weather_id": column("weather_id", 0, np.int32),
+        "descriptions": [slot.description for slot in forecast_list],
+    }
+
+def resolve_city_from_coords(lat, lon, lang="ru", allow_stale=False):
     """Получает точное локализованное название города по координатам."""
     try:
-        WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
         api_lang = get_api_lang_code(lang)
-        url = "https://api.openweathermap.org/geo/1.0/reverse"
-        params = {
-            "lat": lat,
-            "lon": lon,
-            "limit": 1,
-            "appid": WEATHER_API_KEY
-        }
-        response = requests.get(url, params=params)
-        data = response.json()
+        payload = fetch_api_response(
+            "geo_reverse", {"lat": lat, "lon": lon, "limit": 1}, allow_stale=allow_stale
+        )
+        if payload is None:
+            return None
+        data = decode_json(payload)
         
-        if response.status_code == 200 and data:
+        if data:
             location = data[0]
             # Пытаемся найти имя в local_names для нужного языка
             if "local_names" in location and api_lang in location["local_names"]:
@@ -91,37 +812,18 @@ def resolve_city_from_coords(lat, lon, lang="ru"):
     except Exception:
         return None
     
-def fetch_today_forecast(city, lang="ru"):
-    WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-    api_lang = get_api_lang_code(lang)
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang={api_lang}"
-
-    response = requests.get(url)
-    response_data = response.json()
+def fetch_today_forecast(city, lang="ru", allow_stale=False, coords=None):
+    return fetch_forecast(city, lang, allow_stale, coords)
 
-    if response_data.get("cod") != "200":
-        return None
-
-    return response_data["list"] 
-
-def fetch_tomorrow_forecast(city, lang="ru"):
-    WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-    api_lang = get_api_lang_code(lang)
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang={api_lang}"
-    
-    response = requests.get(url)
-    response_data = response.json()
-
-    if response_data.get("cod") != "200":
-        return None
+def fetch_tomorrow_forecast(city, lang="ru", allow_stale=False, coords=None):
+    return fetch_forecast(city, lang, allow_stale, coords)
 
-    return response_data["list"] 
 
 def get_city_timezone(city):
-    weather_data = get_weather(city, lang="ru")
-    if not weather_data or "coordinates" not in weather_data:
+    with api_priority(PRIORITY_GEOCODE):
+        weather_data = get_weather(city, lang="ru")
+    if not weather_data:
         return None  
 
-    coordinates = weather_data["coordinates"]
     tf = TimezoneFinder()
-    return tf.timezone_at(lat=coordinates['lat'], lng=coordinates['lon'])
\ No newline at end of file
+    return tf.timezone_at(lat=weather_data.lat, lng=weather_data.lon)
\ No newline at end of file
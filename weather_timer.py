@@ -10,25 +10,51 @@ from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from functools import wraps
 from models import CheckedCities, User, Base
+from migrations import upgrade_schema
 from logic import (
-    safe_execute, convert_pressure, convert_temperature, convert_wind_speed, 
+    safe_execute, convert_all_units, forecast_unit_columns, 
     decode_tracked_params, get_weather_summary_description, 
     get_user_lang, get_text, get_translation_dict,
-    get_all_users, decode_notification_settings, get_wind_direction, 
-    get_today_forecast
+    iter_users, iter_user_batches, save_daily_schedule, decode_notification_settings, get_wind_direction, 
+    get_today_forecast, cached_render, is_daily_forecast_unchanged, remember_daily_forecast,
+    is_message_not_modified_error, get_user_coords, schedule_daily_forecast
+)
+from weather import (
+    get_weather, fetch_today_forecast, get_single_flight_stats, get_quota_stats, api_priority, CurrentReading,
+    PRIORITY_ALERT, PRIORITY_BROADCAST, is_service_unavailable, get_circuit_states
 )
-from weather import get_weather, fetch_today_forecast
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
 from sqlalchemy.pool import QueuePool    
-from threading import Event
+from threading import Event, Lock
 from logging.handlers import RotatingFileHandler
+from render_pool import (
+    ALERT_PARAMS, RENDER_WORKERS, RenderPrefs, UNIT_PARAMS, render_alert_chunk, render_chunks, render_daily_chunk, shutdown_render_pool, split_chunks,
+    start_render_pool
+)
+# Пул отрисовки форкается до импорта bot: TeleBot при создании запускает свои потоки, а fork
+# процесса с живыми потоками (и, возможно, занятыми ими блокировками) может повесить рабочие процессы
+if __name__ == '__main__':
+    render_executor = start_render_pool()
 from bot import get_data_field, update_data_field, send_main_menu, send_settings_menu, format_forecast # format_forecast оставим для совместимости, но использовать будем новую
 from zoneinfo import ZoneInfo
 from collections import Counter # Нужно для новой функции
+from scheduler import Scheduler, every
+from polling import plan_polls, poll_interval, record_reading, next_check_time
+from broadcast_journal import (
+    SENT, FAILED, JOURNAL_FLUSH_SIZE, sent_in_slot, record_statuses, compact_slot, compact_expired
+)
+from sharding import (
+    owns, city_key, user_key, release_leases, owned_shards, holds_job, held_jobs,
+    heartbeat_once, start_heartbeat, SHARDING_ENABLED
+)
 
 #ПЕРЕМЕННЫЕ
-old_start_time = None
+DAILY_FORECAST_MAX_DELAY = timedelta(hours=3)  # Опоздавший больше утренний прогноз переносится на завтра
+DAILY_QUEUE_POLL = 300  # Не реже чем раз в 5 минут перечитываем начало очереди рассылки
+DAILY_JOURNAL_JOB = "daily_forecast"  # Имя задачи в журнале рассылок
+CITY_POLL_TICK = 300  # Как часто проверяется, у каких городов истёк интервал опроса (polling.py)
+MENU_REFRESH_QUIET = 60  # Меню переотправляется, когда в чат столько секунд ничего не отправлялось
 last_start_time = None
 test_weather_data = None
 last_log_time = time.time()
@@ -46,6 +72,7 @@ engine = create_engine(DATABASE_URL, poolclass=QueuePool, pool_recycle=280, pool
 SessionLocal = sessionmaker(bind=engine)
 
 Base.metadata.create_all(engine)
+upgrade_schema(engine)
 
 #ШИФРОВАНИЕ
 load_dotenv()
@@ -53,6 +80,10 @@ load_dotenv()
 #СЛОВАРИ
 stop_event = Event()
 changed_cities_cache = {}
+pending_menu_refresh = {}  # chat_id -> время (monotonic) последнего сообщения, после которого нужно меню
+pending_menu_lock = Lock()
+daily_dispatch_cutoff = None  # naive UTC: до какого next_forecast_at очередь разобрал последний запуск рассылки
+pinned_forecast_lock = Lock()  # Рассылка и обновление закреплённого прогноза не идут одновременно
 
 #ЛОГИРОВАНИЕ
 LOG_DIR = "logs"
@@ -86,6 +117,14 @@ timer_logger.addHandler(file_handler)
 timer_logger.addHandler(console_handler)
 timer_logger.addHandler(error_handler)
 
+# Квота, кэш и предохранители weather.py — в лог таймера (bot.py при импорте подключил свои обработчики)
+weather_logger = logging.getLogger("weather")
+weather_logger.setLevel(logging.DEBUG)
+weather_logger.propagate = False
+weather_logger.handlers.clear()
+for handler in (file_handler, console_handler, error_handler):
+    weather_logger.addHandler(handler)
+
 timer_logger.debug("🔍 DEBUG-логгер для таймера инициализирован.")
 timer_logger.info("✅ Логирование для таймера настроено!")
 
@@ -106,7 +145,7 @@ def precip_expected_next_3h(forecast_list, user) -> bool:
     # OpenWeather /forecast даёт шаг 3 часа; обычно достаточно проверить 1 ближайший слот
     for item in forecast_list:
         try:
-            dt_obj = datetime.fromtimestamp(item.get("dt", 0), tz)
+            dt_obj = datetime.fromtimestamp(item.dt, tz)
         except Exception:
             continue
 
@@ -116,20 +155,15 @@ def precip_expected_next_3h(forecast_list, user) -> bool:
             break
 
         # 1) Явные поля дождя/снега
-        if item.get("rain") or item.get("snow"):
+        if item.rain or item.snow:
             return True
 
         # 2) POP (probability of precipitation) если есть
-        pop = item.get("pop")
-        try:
-            if pop is not None and float(pop) >= 0.2:  # 20% как “ожидается”
-                return True
-        except Exception:
-            pass
+        if item.pop >= 0.2:  # 20% как “ожидается”
+            return True
 
         # 3) Иногда осадки можно поймать по weather.main
-        w = (item.get("weather") or [{}])[0]
-        main = str(w.get("main", "")).lower()
+        main = item.weather_main.lower()
         if main in ("rain", "snow", "thunderstorm", "drizzle"):
             return True
 
@@ -189,6 +223,22 @@ def should_show_daily_summary(day_data, user, lang: str) -> bool:
 
 
 def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecast_list=None):
+    """
+    Форматирование для ежедневной рассылки через общий кэш рендера:
+    одинаковые прогноз и настройки дают один рендер на всю рассылку.
+    """
+    has_precip_3h = precip_expected_next_3h(forecast_list, user) if forecast_list else False
+    tz_name = user.timezone or "UTC"
+    local_date = datetime.now(ZoneInfo(tz_name)).date()
+
+    return cached_render(
+        "timer_forecast", day_data, user,
+        (title_text, daily_summary, has_precip_3h, tz_name, local_date),
+        lambda: render_forecast_for_timer(day_data, user, title_text, daily_summary, has_precip_3h)
+    )
+
+
+def render_forecast_for_timer(day_data, user, title_text, daily_summary, has_precip_3h=False):
     """
     Специальная функция форматирования для ежедневной рассылки.
     Порядок: Title -> Date/Desc -> Разделитель -> Metrics -> Summary (внизу)
@@ -198,6 +248,7 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
     
     unit_trans = get_translation_dict("unit_translations", lang)
     labels = get_translation_dict("weather_data_labels", lang) 
+    columns = forecast_unit_columns(day_data)
     
     header_html = f"<blockquote><b>{title_text}</b></blockquote>"
     
@@ -246,8 +297,6 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
     except Exception:
         pass
 
-    has_precip_3h = precip_expected_next_3h(forecast_list, user) if forecast_list else False
-
     info_text = date_line
     if desc:
         if not should_show_daily_summary(day_data, user, lang) and not has_precip_3h:
@@ -258,8 +307,8 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
     metrics_lines = []
     
     if tracked_params.get("temperature", False) and "temp_min" in day_data:
-        t_min = round(convert_temperature(day_data['temp_min'], user.temp_unit))
-        t_max = round(convert_temperature(day_data['temp_max'], user.temp_unit))
+        t_min = round(columns['temp_min'][user.temp_unit])
+        t_max = round(columns['temp_max'][user.temp_unit])
         unit = unit_trans.get("temp", {}).get(user.temp_unit, "°C")
         label = labels.get("temperature", "Температура")
         
@@ -270,7 +319,7 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
         metrics_lines.append(f"▸ {label}: {val_str}")
 
     if tracked_params.get("feels_like", False) and "feels_like" in day_data:
-        val = round(convert_temperature(day_data['feels_like'], user.temp_unit))
+        val = round(columns['feels_like'][user.temp_unit])
         unit = unit_trans.get("temp", {}).get(user.temp_unit, "°C")
         label = labels.get("feels_like", "Ощущается")
         metrics_lines.append(f"▸ {label}: {val}{unit}")
@@ -285,19 +334,19 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
         metrics_lines.append(f"▸ {label}: {val}%")
 
     if tracked_params.get("pressure", False) and "pressure" in day_data:
-        val = round(convert_pressure(day_data['pressure'], user.pressure_unit))
+        val = round(columns['pressure'][user.pressure_unit])
         unit = unit_trans.get("pressure", {}).get(user.pressure_unit, "mmHg")
         label = labels.get("pressure", "Давление")
         metrics_lines.append(f"▸ {label}: {val} {unit}")
 
     wind_unit = unit_trans.get("wind_speed", {}).get(user.wind_speed_unit, "m/s")
     if tracked_params.get("wind_speed", False) and "wind_speed" in day_data:
-        val = round(convert_wind_speed(day_data['wind_speed'], user.wind_speed_unit), 1)
+        val = round(columns['wind_speed'][user.wind_speed_unit], 1)
         label = labels.get("wind_speed", "Ветер")
         metrics_lines.append(f"▸ {label}: {val} {wind_unit}")
 
     if tracked_params.get("wind_gust", False) and "wind_gust" in day_data:
-        val = round(convert_wind_speed(day_data['wind_gust'], user.wind_speed_unit), 1)
+        val = round(columns['wind_gust'][user.wind_speed_unit], 1)
         label = labels.get("wind_gust", "Порывы")
         metrics_lines.append(f"▸ {label}: {val} {wind_unit}")
         
@@ -328,8 +377,76 @@ def format_forecast_for_timer(day_data, user, title_text, daily_summary, forecas
     return final_message
 
 #ПОЛУЧЕНИЕ ДАННЫХ ИЗ API
+# Поля CurrentReading, которые сравниваются с last_* колонками CheckedCities
+READING_FIELDS = (
+    "temp", "feels_like", "humidity", "wind_speed", "wind_direction", "wind_gust",
+    "pressure", "visibility", "clouds", "precipitation", "description"
+)
+
+def get_checked_city(db, city, location_id=None):
+    """
+    Запись CheckedCities для местоположения (или, без него, для названия города).
+    Старая запись по названию без location_id переходит к местоположению.
+    """
+    if location_id is None:
+        return db.query(CheckedCities).filter_by(city_name=city).first()
+
+    city_data = db.query(CheckedCities).filter_by(location_id=location_id).first()
+    if city_data is None:
+        city_data = db.query(CheckedCities).filter_by(city_name=city, location_id=None).first()
+        if city_data is not None:
+            city_data.location_id = location_id
+    return city_data
+
+def poll_key(user):
+    """Ключ опроса погоды: каноническое местоположение или, если его нет, название города."""
+    if user.location_id is not None:
+        return ("location", user.location_id)
+    return ("city", user.preferred_city)
+
+def load_checked_cities(db, keys):
+    """Записи CheckedCities для ключей опроса (не больше двух запросов): {ключ: запись}."""
+    location_ids = [value for kind, value in keys if kind == "location"]
+    city_names = [value for kind, value in keys if kind == "city"]
+    rows = {}
+    if location_ids:
+        for row in db.query(CheckedCities).filter(CheckedCities.location_id.in_(location_ids)):
+            rows[("location", row.location_id)] = row
+    if city_names:
+        query = db.query(CheckedCities).filter(
+            CheckedCities.city_name.in_(city_names), CheckedCities.location_id.is_(None)
+        )
+        for row in query:
+            rows[("city", row.city_name)] = row
+    return rows
+
+def plan_city_polls(locations_to_check, subscribers, now):
+    """Какие местоположения опросить в этом тике и растяжение интервалов под бюджет (см. polling.plan_polls)."""
+    with SessionLocal() as db:
+        rows = load_checked_cities(db, locations_to_check)
+        states = {
+            key: (
+                rows[key].change_score if key in rows else None,
+                subscribers[key],
+                rows[key].next_check_at if key in rows else None
+            )
+            for key in locations_to_check
+        }
+    if TEST:
+        return list(locations_to_check), 1.0
+    return plan_polls(states, now, CITY_POLL_TICK)
+
+def save_city_poll_schedule(keys, subscribers, stretch, now):
+    """Назначает опрошенным местоположениям следующий опрос по только что обновлённому change_score."""
+    if not keys:
+        return
+    with SessionLocal() as db:
+        for key, row in load_checked_cities(db, keys).items():
+            row.next_check_at = next_check_time(now, poll_interval(row.change_score, subscribers[key], stretch))
+        db.commit()
+
 @safe_execute
-def check_weather_changes(city, current_data):
+def check_weather_changes(city, current_data, location_id=None):
     """Сравнивает полученные данные с предыдущими значениями и определяет, нужно ли уведомлять пользователя."""
     db = SessionLocal()
     try:
@@ -337,25 +454,30 @@ def check_weather_changes(city, current_data):
 
         # ГЕНЕРАЦИЯ ФЕЙКОВЫХ ДАННЫХ В ТЕСТОВОМ РЕЖИМЕ
         if TEST:
-            current_data = {
-                "city_name": city,
-                "temp": round(random.uniform(-10, 40), 1),
-                "feels_like": round(random.uniform(-10, 40), 1),
-                "humidity": random.randint(10, 100),
-                "wind_speed": round(random.uniform(0, 10), 1),
-                "wind_direction": random.randint(0, 360),
-                "wind_gust": round(random.uniform(0, 10), 1),
-                "pressure": random.randint(950, 1050),
-                "visibility": random.randint(1000, 10000),
-                "clouds": random.randint(0, 100),
-                "precipitation": round(random.uniform(0, 100), 1),
-                "description": random.choice([
+            current_data = CurrentReading(
+                city_name=city,
+                temp=round(random.uniform(-10, 40), 1),
+                feels_like=round(random.uniform(-10, 40), 1),
+                humidity=random.randint(10, 100),
+                wind_speed=round(random.uniform(0, 10), 1),
+                wind_direction=random.randint(0, 360),
+                wind_gust=round(random.uniform(0, 10), 1),
+                pressure=random.randint(950, 1050),
+                visibility=random.randint(1000, 10000),
+                clouds=random.randint(0, 100),
+                precipitation=round(random.uniform(0, 100), 1),
+                description=random.choice([
                     "Гроза с небольшим дождём", "Гроза с дождём", "Снег", "Ясно", "Пасмурно"
-                ])
-            }
+                ]),
+                lat=0.0,
+                lon=0.0
+            )
 
         # Фильтруем пользователей
-        users_query = db.query(User).filter(User.preferred_city == city)
+        if location_id is not None:
+            users_query = db.query(User).filter(User.location_id == location_id)
+        else:
+            users_query = db.query(User).filter(User.preferred_city == city, User.location_id.is_(None))
         if TEST:
             users_query = users_query.filter(User.user_id == ADMIN_ID)
         users = users_query.all()
@@ -368,35 +490,40 @@ def check_weather_changes(city, current_data):
         if not users_with_notifications:
             return True
 
-        city_data = db.query(CheckedCities).filter_by(city_name=city).first()
-        precip_current = current_data.get("precipitation", 0.0)
+        city_data = get_checked_city(db, city, location_id)
+        precip_current = current_data.precipitation if current_data.precipitation is not None else 0.0
 
         if not city_data:
             # Создание записи (оставлено без изменений логики)
+            # city_name уникален: у разных местоположений с одинаковым названием он получает id
+            city_name = city
+            if location_id is not None and db.query(CheckedCities).filter_by(city_name=city).first():
+                city_name = f"{city} #{location_id}"
             new_entry = CheckedCities(
-                city_name=city,
-                temperature=current_data["temp"],
-                feels_like=current_data["feels_like"],
-                humidity=current_data["humidity"],
-                wind_speed=current_data["wind_speed"],
-                wind_direction=current_data["wind_direction"],
-                wind_gust=current_data["wind_gust"],
-                pressure=current_data["pressure"],
-                visibility=current_data["visibility"],
-                clouds=current_data["clouds"],
+                city_name=city_name,
+                location_id=location_id,
+                temperature=current_data.temp,
+                feels_like=current_data.feels_like,
+                humidity=current_data.humidity,
+                wind_speed=current_data.wind_speed,
+                wind_direction=current_data.wind_direction,
+                wind_gust=current_data.wind_gust,
+                pressure=current_data.pressure,
+                visibility=current_data.visibility,
+                clouds=current_data.clouds,
                 precipitation=precip_current,
-                description=current_data["description"],
-                last_temperature=current_data["temp"],
-                last_feels_like=current_data["feels_like"],
-                last_humidity=current_data["humidity"],
-                last_wind_speed=current_data["wind_speed"],
-                last_wind_direction=current_data["wind_direction"],
-                last_wind_gust=current_data["wind_gust"],
-                last_pressure=current_data["pressure"],
-                last_visibility=current_data["visibility"],
-                last_clouds=current_data["clouds"],
+                description=current_data.description,
+                last_temperature=current_data.temp,
+                last_feels_like=current_data.feels_like,
+                last_humidity=current_data.humidity,
+                last_wind_speed=current_data.wind_speed,
+                last_wind_direction=current_data.wind_direction,
+                last_wind_gust=current_data.wind_gust,
+                last_pressure=current_data.pressure,
+                last_visibility=current_data.visibility,
+                last_clouds=current_data.clouds,
                 last_precipitation=precip_current,
-                last_description=current_data["description"]
+                last_description=current_data.description
             )
             db.add(new_entry)
             db.commit()
@@ -408,37 +535,42 @@ def check_weather_changes(city, current_data):
         important_descriptions = get_threshold("description")
 
         # Проверки по полям (сокращено для краткости, логика та же)
-        if city_data.last_temperature != current_data["temp"]: changed_params["temperature"] = (city_data.last_temperature, current_data["temp"])
+        if city_data.last_temperature != current_data.temp: changed_params["temperature"] = (city_data.last_temperature, current_data.temp)
         # ... (остальные проверки) ...
-        if city_data.last_description != current_data["description"]:
-            changed_params["description"] = (city_data.last_description, current_data["description"])
-            if isinstance(current_data["description"], str):
-                if current_data["description"].lower() in [desc.lower() for desc in important_descriptions]:
+        if city_data.last_description != current_data.description:
+            changed_params["description"] = (city_data.last_description, current_data.description)
+            if isinstance(current_data.description, str):
+                if current_data.description.lower() in [desc.lower() for desc in important_descriptions]:
                     description_changed_critically = True
 
         if description_changed_critically or TEST:
             full_changed_params = {}
-            for key in current_data:
+            for key in READING_FIELDS:
+                last_field = f"last_{key}" if key != "temp" else "last_temperature"
+                current_value = getattr(current_data, key)
                 if TEST:
-                    full_changed_params[key] = (getattr(city_data, f"last_{key}" if key != "temp" else "last_temperature", 0), current_data[key])
+                    full_changed_params[key] = (getattr(city_data, last_field, 0), current_value)
                     continue
-                last_field = f"last_{key}" if key != "temp" else "last_temperature"
-                current_value = current_data["temp"] if key == "temp" else current_data.get(key)
                 db_value = getattr(city_data, last_field, None)
                 if db_value != current_value:
                     full_changed_params[key] = (db_value, current_value)
 
-            changed_cities_cache[city] = {
+            changed_cities_cache[("location", location_id) if location_id is not None else ("city", city)] = {
+                "city": city,
+                "checked_city_id": city_data.id,
                 "current_data": current_data,
                 "changed_params": full_changed_params
             }
 
+        # Изменчивость погоды для адаптивного опроса — до того, как текущие значения перезапишутся
+        record_reading(city_data, current_data, datetime.now(timezone.utc).replace(tzinfo=None))
+
         # Обновление БД
         city_data.last_temperature = city_data.temperature
         # ... (обновление остальных полей) ...
-        city_data.temperature = current_data["temp"]
+        city_data.temperature = current_data.temp
         # ...
-        city_data.description = current_data["description"]
+        city_data.description = current_data.description
         db.commit()
         return True
 
@@ -459,120 +591,89 @@ def get_threshold(param):
     }
     return thresholds.get(param, [])
 
-def send_weather_update(users, city, changes, current_data):
-    """Отправляет уведомления пользователям о погоде в новом дизайне."""
-    db = SessionLocal()
-    city_data = db.query(CheckedCities).filter_by(city_name=city).first()
-    
-    if not city_data:
-        db.close()
-        return
+def build_unit_table(current_data, city_data):
+    """
+    Переводит текущие и прошлые значения города сразу во все единицы (векторно),
+    чтобы в цикле по пользователям оставался только поиск: {param: {unit: (новое, старое)}}.
+    """
+    table = {}
+    for param, kind in UNIT_PARAMS.items():
+        current_val = getattr(current_data, "temp" if param == "temperature" else param)
+        if current_val is None:
+            continue
+        last_val = getattr(city_data, f"last_{param}", None)
+        pair = [current_val, float("nan") if last_val is None else last_val]
 
-    for user in users:
-        tracked_params = decode_tracked_params(user.tracked_weather_params)
-        if not any(tracked_params.values()): continue
+        table[param] = {
+            unit: (round(float(values[0])), None if last_val is None else round(float(values[1])))
+            for unit, values in convert_all_units(pair, kind).items()
+        }
+    return table
 
-        chat_id = user.user_id
-        lang = get_user_lang(user)
-        unit_trans = get_translation_dict("unit_translations", lang)
-        labels = get_translation_dict("weather_data_labels", lang)
-
-        # Удаляем старое меню
-        last_menu_id = get_data_field("last_menu_message", chat_id)
-        if last_menu_id:
-            try: bot.delete_message(chat_id, last_menu_id)
-            except: pass
-            update_data_field("last_menu_message", chat_id, None)
-
-        if "temp" in current_data: current_data["temperature"] = current_data["temp"]
-
-        # 1. ЗАГОЛОВОК
-        localized_city_name = current_data.get("city_name", city)
-        header_text = f"🌨 <b>Внимание!</b>\n"
-        header_info = f"<b>Погода в г.{localized_city_name} изменилась!</b>\n"
-
-        # ОПИСАНИЕ ИЗМЕНЕНИЙ
-        last_desc = city_data.last_description
-        curr_desc = current_data.get("description")
-        
-        if last_desc and curr_desc and str(last_desc).lower() != str(curr_desc).lower():
-            desc_line = f"▸ {str(last_desc).capitalize()} ➝ {str(curr_desc).capitalize()}"
+def send_weather_update(users, city, changes, current_data, checked_city_id=None):
+    """
+    Отправляет уведомления пользователям о погоде в новом дизайне.
+    Тексты отрисовываются чанками (при больших рассылках — в пуле процессов),
+    отправка идёт здесь же по мере готовности чанков.
+    """
+    with SessionLocal() as db:
+        if checked_city_id is not None:
+            city_data = db.get(CheckedCities, checked_city_id)
         else:
-            desc_line = f"▸ {str(curr_desc).capitalize()}"
-            
-        header_info += f"{desc_line}\n"
-        header_info += "─────────────────────"
-
-        header_html = f"<blockquote>{header_text}</blockquote>"
-
-        # 2. ПАРАМЕТРЫ
-        params_text = ""
-        param_config = {
-            "temperature": (labels.get("temperature", "Температура"), "", lambda x: round(convert_temperature(x, user.temp_unit))),
-            "feels_like": (labels.get("feels_like", "Ощущается как"), "", lambda x: round(convert_temperature(x, user.temp_unit))),
-            "humidity": (labels.get("humidity", "Влажность"), "%", lambda x: int(x)),
-            "precipitation": (labels.get("precipitation", "Осадки"), "%", lambda x: int(x)),
-            "pressure": (labels.get("pressure", "Давление"), "", lambda x: round(convert_pressure(x, user.pressure_unit))),
-            "wind_speed": (labels.get("wind_speed", "Ветер"), "", lambda x: round(convert_wind_speed(x, user.wind_speed_unit))),
-            "wind_gust": (labels.get("wind_gust", "Порывы"), "", lambda x: round(convert_wind_speed(x, user.wind_speed_unit))),
-            "clouds": (labels.get("clouds", "Облачность"), "%", lambda x: int(x)),
-            "visibility": (labels.get("visibility", "Видимость"), "м", lambda x: int(x)),
+            city_data = db.query(CheckedCities).filter_by(city_name=city).first()
+        if not city_data:
+            return
+
+        unit_table = build_unit_table(current_data, city_data)
+        last_values = {
+            param: getattr(city_data, f"last_{param}", None)
+            for param in ALERT_PARAMS + ("description",)
         }
 
-        ICON_UP = "⇑"
-        ICON_DOWN = "⇓"
-        ICON_SAME = "▸"
+    prefs_list = [RenderPrefs.from_user(user) for user in users]
+    chunks = split_chunks((city, current_data, last_values, unit_table), prefs_list)
 
-        has_params = False
-        
-        for param, (label, default_unit, transformer) in param_config.items():
-            if not tracked_params.get(param, False): continue
-            
-            if param in ["temperature", "feels_like"]: unit = unit_trans['temp'].get(user.temp_unit, '')
-            elif param == "pressure": unit = unit_trans['pressure'].get(user.pressure_unit, '')
-            elif param in ["wind_speed", "wind_gust"]: unit = unit_trans['wind_speed'].get(user.wind_speed_unit, '')
-            else: unit = default_unit
-
-            current_val = current_data.get(param)
-            last_val = getattr(city_data, f"last_{param}", None)
-            
-            if current_val is None: continue
+    for rendered in render_chunks(render_alert_chunk, chunks):
+        for chat_id, full_message in rendered:
+            if full_message is None: continue
+            delete_previous_weather_notification(chat_id)
 
             try:
-                new_v = transformer(current_val)
-                old_v = transformer(last_val) if last_val is not None else None
-                
-                arrow = ICON_SAME
-                val_str = f"{new_v} {unit}"
-                
-                if old_v is not None and old_v != new_v:
-                    if isinstance(new_v, (int, float)) and isinstance(old_v, (int, float)):
-                        if new_v > old_v: arrow = ICON_UP
-                        elif new_v < old_v: arrow = ICON_DOWN
-                    val_str = f"{old_v} ➝ {new_v} {unit}"
-                
-                params_text += f"{arrow} {label}: {val_str}\n"
-                has_params = True
-            except Exception: pass
-
-        full_message = f"{header_html}{header_info}"
-        if has_params:
-            full_message += f"\n<blockquote expandable>{params_text}</blockquote>"
-        
-        delete_previous_weather_notification(chat_id)
-        
-        try:
-            sent_msg = bot.send_message(chat_id, full_message, parse_mode="HTML")
-            update_data_field("last_weather_update", chat_id, sent_msg.message_id)
-        except Exception as e:
-            timer_logger.error(f"❌ Error sending to {chat_id}: {e}")
+                sent_msg = bot.send_message(chat_id, full_message, parse_mode="HTML")
+                update_data_field("last_weather_update", chat_id, sent_msg.message_id)
+            except Exception as e:
+                timer_logger.error(f"❌ Error sending to {chat_id}: {e}")
 
-        if get_data_field("last_settings_command", chat_id):
-            send_settings_menu(chat_id)
-        else:
-            send_main_menu(chat_id)
+            request_menu_refresh(chat_id)
 
-    db.close()
+def request_menu_refresh(chat_id):
+    """Помечает, что после отправленного сообщения пользователю нужно переотправить меню."""
+    with pending_menu_lock:
+        pending_menu_refresh[chat_id] = time.monotonic()
+
+def flush_menu_refreshes(quiet=MENU_REFRESH_QUIET):
+    """
+    Переотправляет меню чатам, в которые quiet секунд ничего не отправлялось. Задачи таймера идут
+    параллельно, поэтому уведомление и утренний прогноз в одном чате дают одну переотправку меню.
+    """
+    now = time.monotonic()
+    with pending_menu_lock:
+        chat_ids = [chat_id for chat_id, requested_at in pending_menu_refresh.items() if now - requested_at >= quiet]
+        for chat_id in chat_ids:
+            del pending_menu_refresh[chat_id]
+    if not chat_ids:
+        return
+    timer_logger.info(f"▸ Переотправка меню после рассылки: {len(chat_ids)} чатов.")
+
+    for chat_id in chat_ids:
+        try:
+            # send_*_menu сами удаляют предыдущее меню-сообщение
+            if get_data_field("last_settings_command", chat_id):
+                send_settings_menu(chat_id)
+            else:
+                send_main_menu(chat_id)
+        except Exception as e:
+            timer_logger.warning(f"Menu refresh failed for {chat_id}: {e}")
 
 def delete_previous_weather_notification(chat_id):
     last_weather_msg_id = get_data_field("last_weather_update", chat_id)
@@ -582,45 +683,88 @@ def delete_previous_weather_notification(chat_id):
             update_data_field("last_weather_update", chat_id, None)
         except Exception: pass
 
+def lease_lost(job):
+    """
+    Аренда задачи потеряна посреди запуска: её уже может выполнять другой экземпляр.
+    Долгие задачи проверяют это в своих циклах и останавливаются (при шардировании — см. owns()).
+    """
+    return not TEST and not holds_job(job)
+
 @safe_execute
 def check_all_cities():
-    db = SessionLocal()
-    if TEST:
-        users = db.query(User).filter(User.user_id == ADMIN_ID).all()
-    else:
-        users = db.query(User).all()
+    # Пользователи читаются потоково (iter_users) — дважды: для опроса и для рассылки
+    criteria = (User.user_id == ADMIN_ID,) if TEST else (User.preferred_city.isnot(None),)
 
-    cities_to_check = set()
-    for user in users:
+    # Опрашиваем каждое местоположение один раз, сколько бы написаний города у подписчиков ни было
+    locations_to_check = {}  # ключ опроса -> (название города, координаты)
+    subscribers = Counter()  # ключ опроса -> число подписчиков
+    for user in iter_users(*criteria):
         if user.preferred_city:
             settings = decode_notification_settings(user.notifications_settings)
             if settings.get("weather_threshold_notifications", False):
-                cities_to_check.add(user.preferred_city)
+                # Город опрашивает только экземпляр, которому принадлежит его шард
+                if not owns(city_key(user.location_id, user.preferred_city)):
+                    continue
+                key = poll_key(user)
+                subscribers[key] += 1
+                if locations_to_check.get(key, (None, None))[1] is None:
+                    locations_to_check[key] = (user.preferred_city, get_user_coords(user))
 
-    checked_cities = set()
+    # Опрашиваются только местоположения, чей интервал истёк, в пределах бюджета запросов
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    due_locations, stretch = plan_city_polls(locations_to_check, subscribers, now)
+
+    checked_locations = set()
     for _ in range(3):
-        remaining = cities_to_check - checked_cities
-        if not remaining: break
-        for city in remaining:
-            weather_data = get_weather(city, lang="ru") 
-            if weather_data and check_weather_changes(city, weather_data):
-                checked_cities.add(city)
+        remaining = [key for key in due_locations if key not in checked_locations]
+        if not remaining or is_service_unavailable("weather") or lease_lost("city_refresh"): break
+        for key in remaining:
+            # Предохранитель разомкнут — остальные города ждут следующего тика со своим next_check_at
+            if is_service_unavailable("weather"):
+                timer_logger.warning("OpenWeather недоступен (предохранитель разомкнут) — опрос городов прерван.")
+                break
+            # Опрос останавливается, но уже найденные изменения рассылаются: они записаны в БД,
+            # и новый владелец задачи их не увидит
+            if lease_lost("city_refresh"):
+                timer_logger.warning("⏱ city_refresh: аренда задачи потеряна — опрос городов прерван.")
+                break
+            city, coords = locations_to_check[key]
+            location_id = key[1] if key[0] == "location" else None
+            weather_data = get_weather(city, lang="ru", coords=coords)
+            if weather_data and check_weather_changes(city, weather_data, location_id):
+                checked_locations.add(key)
+
+    save_city_poll_schedule(checked_locations, subscribers, stretch, now)
+    timer_logger.info(
+        f"▸ Проверено местоположений: {len(checked_locations)} из {len(due_locations)} к опросу "
+        f"(всего {len(locations_to_check)})."
+    )
+
+    # Подписчики каждого изменившегося города собираются в одну рассылку
+    recipients = {}  # ключ опроса -> [RenderPrefs]
+    if changed_cities_cache:
+        for user in iter_users(*criteria):
+            if not user.preferred_city: continue
+            key = poll_key(user)
+            if key not in changed_cities_cache: continue
 
-    for user in users:
-        city = user.preferred_city
-        if not city or city not in changed_cities_cache: continue
-            
-        settings = decode_notification_settings(user.notifications_settings)
-        if not settings.get("weather_threshold_notifications", False): continue
+            settings = decode_notification_settings(user.notifications_settings)
+            if not settings.get("weather_threshold_notifications", False): continue
+            recipients.setdefault(key, []).append(RenderPrefs.from_user(user))
 
-        city_data = db.query(CheckedCities).filter_by(city_name=city).first()
+    db = SessionLocal()
+    for key, city_users in recipients.items():
+        city_changes = changed_cities_cache[key]
+        city_data = db.get(CheckedCities, city_changes["checked_city_id"])
         if not TEST and city_data and city_data.previous_notify_time:
              previous = city_data.previous_notify_time
              if previous.tzinfo is None: previous = previous.replace(tzinfo=timezone.utc)
              if (datetime.now(timezone.utc) - previous) < timedelta(hours=3): continue
 
-        city_changes = changed_cities_cache[city]
-        send_weather_update([user], city, city_changes["changed_params"], city_changes["current_data"])
+        send_weather_update(
+            city_users, city_changes["city"], city_changes["changed_params"], city_changes["current_data"],
+            checked_city_id=city_changes["checked_city_id"]
+        )
 
         if city_data:
             city_data.previous_notify_time = datetime.now(timezone.utc)
@@ -629,130 +773,246 @@ def check_all_cities():
     db.close()
     changed_cities_cache.clear()
 
-@safe_execute
-def should_run_check():
-    global old_start_time
-    now = datetime.now(timezone.utc)
-    current_minute = now.minute
-    current_half_hour = now.replace(minute=0 if current_minute < 30 else 30, second=0, microsecond=0)
-    next_half_hour = current_half_hour + timedelta(minutes=30)
-    remaining_time = (next_half_hour - now).total_seconds()
-    test_interval = 1800 
-    
-    if old_start_time is None:
-        old_start_time = current_half_hour.timestamp()
-        return True, 0
-    if time.time() - old_start_time < test_interval:
-        return False, min(test_interval, remaining_time)
-    
-    old_start_time = current_half_hour.timestamp()
-    return True, 0
+def publish_daily_forecast(user_id, forecast_message):
+    """
+    Отправляет (или обновляет закреплённый) готовый утренний прогноз одному пользователю.
+    Возвращает True, если пользователь видит этот прогноз.
+    """
+    last_forecast_id = get_data_field("last_daily_forecast", user_id)
 
-def send_daily_forecast(test_time=None):
-    all_users = get_all_users()
-    if TEST:
-        users = [u for u in all_users if u.user_id == ADMIN_ID]
-    else:
-        users = all_users
+    # 1) Пытаемся обновить существующий закреп
+    if last_forecast_id:
+        if is_daily_forecast_unchanged(user_id, forecast_message):
+            timer_logger.debug(f"Daily forecast for {user_id} is unchanged, edit skipped.")
+            return True
+        try:
+            bot.edit_message_text(
+                text=forecast_message,
+                chat_id=user_id,
+                message_id=last_forecast_id,
+                parse_mode="HTML"
+            )
+            remember_daily_forecast(user_id, forecast_message)
+            # Не закрепляем заново — меньше системных сообщений
+            return True
+        except Exception as e:
+            if is_message_not_modified_error(e):
+                remember_daily_forecast(user_id, forecast_message)
+                return True
+            timer_logger.warning(f"Daily edit failed for {user_id}: {e}")
 
-    for user in users:
-        settings = decode_notification_settings(user.notifications_settings)
-        if not settings.get("forecast_notifications", False):
-            continue
+    # 2) Если сообщения нет / edit не удался — создаём новое и закрепляем
+    try:
+        sent_message = bot.send_message(user_id, forecast_message, parse_mode="HTML")
+        remember_daily_forecast(user_id, forecast_message, sent_message.message_id)
 
-        lang = get_user_lang(user)
-        user_tz = ZoneInfo(user.timezone or "Asia/Almaty")
-        user_time = test_time.astimezone(user_tz) if test_time else datetime.now(user_tz)
+        try:
+            bot.pin_chat_message(
+                chat_id=user_id,
+                message_id=sent_message.message_id,
+                disable_notification=True
+            )
+        except Exception as pin_error:
+            timer_logger.warning(f"Pin failed for {user_id}: {pin_error}")
 
-        # Запуск в 06:00–06:29 по локальному времени пользователя (или всегда в TEST)
-        if not (TEST or (user_time.hour == 6 and user_time.minute < 30)):
-            continue
+        # Меню переотправляется одно на чат, когда рассылки в него затихнут (flush_menu_refreshes)
+        request_menu_refresh(user_id)
+        return True
 
-        raw_forecast = get_today_forecast(user.preferred_city, user)
-        if not raw_forecast:
+    except Exception as e:
+        timer_logger.error(f"Error sending daily forecast to {user_id}: {e}")
+        return False
+
+
+def build_daily_chunks(users):
+    """
+    Группирует пользователей по местоположению и языку, запрашивает прогноз один раз на группу
+    и делит группы на задания для отрисовки: [(forecast_list, [RenderPrefs])].
+    """
+    groups = {}
+    for user in users:
+        groups.setdefault((poll_key(user), get_user_lang(user)), []).append(user)
+
+    chunks = []
+    for (_, lang), group_users in groups.items():
+        first = group_users[0]
+        try:
+            forecast_list = fetch_today_forecast(first.preferred_city, lang=lang, coords=get_user_coords(first))
+        except Exception as e:
+            timer_logger.error(f"Daily forecast fetch for {first.preferred_city} failed: {e}")
+            continue
+        if not forecast_list:
             continue
+        chunks.extend(split_chunks((forecast_list,), [RenderPrefs.from_user(user) for user in group_users]))
+    return chunks
 
-        title = get_text("daily_forecast_title", lang)
-        daily_summary = get_weather_summary_description(
-            fetch_today_forecast(user.preferred_city, lang=lang),
-            user
-        )
 
-        forecast_message = format_forecast(
-            raw_forecast,
-            user,
-            title,
-            summary_text=daily_summary,
-            is_daily_forecast=True
-        )
+def send_daily_forecast(test_time=None):
+    """
+    Утренняя рассылка по очереди next_forecast_at: обрабатываются только пользователи,
+    чьё время уже наступило, после отправки им назначается следующее утро.
+    Пользователи читаются пачками (iter_user_batches), тексты отрисовываются чанками по городам,
+    отправка идёт по мере готовности чанков. Статусы пишутся в журнал рассылок, поэтому после
+    перезапуска уже получившие прогноз в этом слоте пропускаются.
+    """
+    global daily_dispatch_cutoff
+    now = test_time or datetime.now(timezone.utc)
+    cutoff = now.astimezone(timezone.utc).replace(tzinfo=None)
+    if TEST:
+        criteria = (User.user_id == ADMIN_ID,)
+    else:
+        criteria = (User.next_forecast_at <= cutoff,)
+    if test_time is None:
+        daily_dispatch_cutoff = cutoff
+
+    processed = 0
+    resumed = 0
+    deferred = 0
+    with SessionLocal() as db:
+        for users in iter_user_batches(*criteria):
+            if lease_lost("daily_dispatch"):
+                timer_logger.warning("⏱ daily_dispatch: аренда задачи потеряна — рассылка остановлена.")
+                break
+            if not TEST:
+                users = [user for user in users if owns(user_key(user.user_id))]
+
+            # Слот пользователя — его next_forecast_at; в тестовом режиме журнал не ведётся
+            slots = {} if TEST else {user.user_id: user.next_forecast_at for user in users}
+            already_sent = sent_in_slot(db, DAILY_JOURNAL_JOB, slots)
+            resumed += len(already_sent)
+
+            on_time = []
+            for user in users:
+                if user.user_id in already_sent:
+                    continue
+                fire_at = user.next_forecast_at.replace(tzinfo=timezone.utc) if user.next_forecast_at else now
+                delay = now - fire_at
+                if TEST or delay <= DAILY_FORECAST_MAX_DELAY:
+                    on_time.append(user)
+                else:
+                    timer_logger.warning(f"Daily forecast for {user.user_id} is {delay} late, skipped until tomorrow.")
+
+            users_by_id = {user.user_id: user for user in users}
+            for rendered in render_chunks(render_daily_chunk, build_daily_chunks(on_time)):
+                published = []
+                statuses = []
+                for user_id, forecast_message in rendered:
+                    if forecast_message is None: continue
+                    # Шард или аренда задачи могли перейти к другому экземпляру, пока пачка отрисовывалась
+                    # и отправлялась: такого пользователя не отправляем и не переназначаем — это сделает новый владелец
+                    if not TEST and (lease_lost("daily_dispatch") or not owns(user_key(user_id))):
+                        users_by_id.pop(user_id, None)
+                        continue
+                    try:
+                        sent = publish_daily_forecast(user_id, forecast_message)
+                    except Exception as e:
+                        sent = False
+                        timer_logger.error(f"Daily forecast for {user_id} failed: {e}")
+                    published.append(users_by_id.pop(user_id))
+                    if slots:
+                        statuses.append((user_id, slots[user_id], SENT if sent else FAILED))
+                    if len(statuses) >= JOURNAL_FLUSH_SIZE:
+                        record_statuses(db, DAILY_JOURNAL_JOB, statuses)
+                        db.commit()
+                        statuses = []
+                record_statuses(db, DAILY_JOURNAL_JOB, statuses)
+
+                # Следующий слот назначается в одной транзакции с очисткой журнала
+                for user in published:
+                    schedule_daily_forecast(user, now)
+                save_daily_schedule(db, published)
+                compact_slot(db, DAILY_JOURNAL_JOB, [user.user_id for user in published])
+                db.commit()
+
+            # Если прогноз не получен из-за разомкнутого предохранителя, вовремя пришедшие пользователи
+            # остаются в очереди и получат его, когда сервис восстановится (пока не опоздают)
+            if not TEST and on_time and is_service_unavailable("forecast"):
+                waiting = [user.user_id for user in on_time if user.user_id in users_by_id]
+                for user_id in waiting:
+                    del users_by_id[user_id]
+                deferred += len(waiting)
+
+            # Остальным (опоздавшим, без прогноза, уже получившим до перезапуска) — следующее утро
+            rest = [] if lease_lost("daily_dispatch") else [
+                user for user in users_by_id.values() if TEST or owns(user_key(user.user_id))
+            ]
+            for user in rest:
+                schedule_daily_forecast(user, now)
+            save_daily_schedule(db, rest)
+            compact_slot(db, DAILY_JOURNAL_JOB, [user.user_id for user in rest])
+            db.commit()
+            processed += len(users)
 
-        last_forecast_id = get_data_field("last_daily_forecast", user.user_id)
+        if compact_expired(db, now):
+            db.commit()
 
-        # 1) Пытаемся обновить существующий закреп
-        if last_forecast_id:
-            try:
-                bot.edit_message_text(
-                    text=forecast_message,
-                    chat_id=user.user_id,
-                    message_id=last_forecast_id,
-                    parse_mode="HTML"
-                )
-                # Не закрепляем заново — меньше системных сообщений
-                continue
-            except Exception as e:
-                timer_logger.warning(f"Daily edit failed for {user.user_id}: {e}")
+    if resumed:
+        timer_logger.info(f"▸ Утренний прогноз: {resumed} пользователей уже получили его до перезапуска — пропущены.")
+    if deferred:
+        timer_logger.warning(f"▸ Утренний прогноз: {deferred} пользователей ждут восстановления OpenWeather.")
+    if processed:
+        timer_logger.info(f"▸ Утренний прогноз: обработано {processed} пользователей.")
 
-        # 2) Если сообщения нет / edit не удался — создаём новое и закрепляем
-        try:
-            sent_message = bot.send_message(user.user_id, forecast_message, parse_mode="HTML")
-            update_data_field("last_daily_forecast", user.user_id, sent_message.message_id)
 
-            try:
-                bot.pin_chat_message(
-                    chat_id=user.user_id,
-                    message_id=sent_message.message_id,
-                    disable_notification=True
-                )
-            except Exception as pin_error:
-                timer_logger.warning(f"Pin failed for {user.user_id}: {pin_error}")
-
-            # Меню — по желанию (как у вас было)
-            last_menu_id = get_data_field("last_menu_message", user.user_id)
-            if last_menu_id:
-                try:
-                    bot.delete_message(chat_id=user.user_id, message_id=last_menu_id)
-                except Exception:
-                    pass
+def schedule_missing_daily_forecasts():
+    """Назначает next_forecast_at пользователям, у которых его ещё нет (новая колонка, старые записи)."""
+    with SessionLocal() as db:
+        users = db.query(User).filter(User.next_forecast_at.is_(None), User.preferred_city.isnot(None)).all()
+        for user in users:
+            schedule_daily_forecast(user)
+        db.commit()
+        scheduled = sum(1 for user in users if user.next_forecast_at)
+    timer_logger.info(f"▸ Утренний прогноз назначен {scheduled} пользователям без расписания.")
 
-            send_main_menu(user.user_id)
 
-        except Exception as e:
-            timer_logger.error(f"Error sending daily forecast to {user.user_id}: {e}")
+def next_daily_dispatch(now):
+    """
+    Время следующего запуска рассылки; считается после завершения запуска (schedule_after_run).
+    Это ближайший next_forecast_at позже границы, до которой очередь разобрал прошлый запуск, но не позже
+    чем через DAILY_QUEUE_POLL — настройки меняются в процессе бота, и очередь могла сдвинуться раньше.
+    Слоты, наступившие, пока шёл долгий запуск, дают немедленный новый запуск; оставшиеся до границы
+    (чужой шард, ожидание восстановления OpenWeather) перечитываются через DAILY_QUEUE_POLL.
+    Резервный экземпляр без аренды задачи очередь не читает.
+    """
+    if not holds_job("daily_dispatch"):
+        return now + DAILY_QUEUE_POLL
+    naive_now = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None)
+    after = min(daily_dispatch_cutoff or naive_now, naive_now)
+    try:
+        with SessionLocal() as db:
+            next_fire = db.query(func.min(User.next_forecast_at)).filter(User.next_forecast_at > after).scalar()
+    except Exception as e:
+        timer_logger.error(f"Daily queue lookup failed: {e}")
+        return now + 60
+    if next_fire is None:
+        return now + DAILY_QUEUE_POLL
+    return min(next_fire.replace(tzinfo=timezone.utc).timestamp(), now + DAILY_QUEUE_POLL)
 
 
 def update_daily_forecasts():
-    all_users = get_all_users()
-    if TEST:
-        users = [u for u in all_users if u.user_id == ADMIN_ID]
-    else:
-        users = all_users
+    criteria = (User.user_id == ADMIN_ID,) if TEST else (User.preferred_city.isnot(None),)
+    for user in iter_users(*criteria):
+        if lease_lost("pinned_refresh"):
+            timer_logger.warning("⏱ pinned_refresh: аренда задачи потеряна — обновление остановлено.")
+            break
+        if not TEST and not owns(user_key(user.user_id)):
+            continue
+        if not decode_notification_settings(user.notifications_settings).get("forecast_notifications", False):
+            continue
 
-    for user in users:
         last_forecast_id = get_data_field("last_daily_forecast", user.user_id)
         if not last_forecast_id:
             continue
 
         lang = get_user_lang(user)
 
-        raw_forecast = get_today_forecast(user.preferred_city, user)
+        forecast_list = fetch_today_forecast(user.preferred_city, lang=lang, coords=get_user_coords(user))
+        raw_forecast = get_today_forecast(user.preferred_city, user, raw_data=forecast_list)
         if not raw_forecast:
             continue
 
         title = get_text("daily_forecast_title", lang)
-        daily_summary = get_weather_summary_description(
-            fetch_today_forecast(user.preferred_city, lang=lang),
-            user
-        )
+        daily_summary = get_weather_summary_description(forecast_list, user)
 
         forecast_message = format_forecast(
             raw_forecast,
@@ -762,6 +1022,10 @@ def update_daily_forecasts():
             is_daily_forecast=True
         )
 
+        # Текст не изменился — не тратим запрос к Telegram
+        if is_daily_forecast_unchanged(user.user_id, forecast_message):
+            continue
+
         try:
             bot.edit_message_text(
                 text=forecast_message,
@@ -769,13 +1033,18 @@ def update_daily_forecasts():
                 message_id=last_forecast_id,
                 parse_mode="HTML"
             )
+            remember_daily_forecast(user.user_id, forecast_message)
         except Exception as e:
+            if is_message_not_modified_error(e):
+                remember_daily_forecast(user.user_id, forecast_message)
+                continue
+
             # ✅ ВАЖНО: если сообщение удалили при очистке чата — восстанавливаем
             timer_logger.warning(f"Daily update edit failed for {user.user_id}: {e}")
 
             try:
                 sent_message = bot.send_message(user.user_id, forecast_message, parse_mode="HTML")
-                update_data_field("last_daily_forecast", user.user_id, sent_message.message_id)
+                remember_daily_forecast(user.user_id, forecast_message, sent_message.message_id)
 
                 try:
                     bot.pin_chat_message(
@@ -790,11 +1059,69 @@ def update_daily_forecasts():
                 timer_logger.error(f"Daily recreate failed for {user.user_id}: {send_error}")
 
 
+#ПЛАНИРОВЩИК
+def run_city_refresh():
+    with api_priority(PRIORITY_ALERT):
+        check_all_cities()
+
+def run_daily_dispatch():
+    with pinned_forecast_lock, api_priority(PRIORITY_BROADCAST):
+        send_daily_forecast()
+
+def run_pinned_refresh():
+    with pinned_forecast_lock, api_priority(PRIORITY_BROADCAST):
+        update_daily_forecasts()
+
+def log_timer_stats():
+    timer_logger.info(f"▸ Запросы к OpenWeather (single-flight): {get_single_flight_stats()}")
+    timer_logger.info(f"▸ Квота OpenWeather таймера по классам: {get_quota_stats()}")
+    timer_logger.info(f"▸ Предохранители OpenWeather: {get_circuit_states()}")
+    if SHARDING_ENABLED:
+        timer_logger.info(f"▸ Шарды экземпляра: {owned_shards()}")
+    else:
+        timer_logger.info(f"▸ Задачи экземпляра: {held_jobs()}")
+    for name, summary in scheduler.stats_summary().items():
+        timer_logger.info(f"▸ {name}: {summary}")
+
+# Задачи, которые в каждый момент выполняет только один экземпляр таймера
+COORDINATED_JOBS = ("daily_dispatch", "city_refresh", "pinned_refresh")
+
+def build_scheduler():
+    """
+    Независимые задачи таймера. Опоздавший больше чем на deadline запуск пропускается,
+    а новый запуск задачи, пока идёт предыдущий, не начинается.
+    """
+    jobs = Scheduler(max_workers=4, logger=timer_logger)
+    # Просыпается к ближайшему next_forecast_at; опоздания обрабатывает сама рассылка
+    jobs.add_job(
+        "daily_dispatch", run_daily_dispatch, next_daily_dispatch, priority=0, run_immediately=True,
+        guard=lambda: holds_job("daily_dispatch"), schedule_after_run=True
+    )
+    jobs.add_job(
+        "city_refresh", run_city_refresh, every(CITY_POLL_TICK), priority=1, deadline=CITY_POLL_TICK,
+        run_immediately=True, guard=lambda: holds_job("city_refresh")
+    )
+    # Сдвиг на 15 минут, чтобы не конкурировать с рассылкой за закреплённые сообщения
+    jobs.add_job(
+        "pinned_refresh", run_pinned_refresh, every(1800, offset=900), priority=2, deadline=900,
+        guard=lambda: holds_job("pinned_refresh")
+    )
+    # Меню — по состоянию этого процесса, поэтому без аренды
+    jobs.add_job("menu_refresh", flush_menu_refreshes, every(MENU_REFRESH_QUIET // 2), priority=3)
+    jobs.add_job("stats", log_timer_stats, every(3600), priority=3)
+    return jobs
+
 if __name__ == '__main__':
-    while True:
-        run_check, wait_time = should_run_check()
-        if run_check:
-            check_all_cities()
-            send_daily_forecast()
-            update_daily_forecasts()
-        time.sleep(wait_time)
\ No newline at end of file
+    if render_executor is not None:
+        timer_logger.info(f"Пул отрисовки запущен: {RENDER_WORKERS} процессов.")
+    # Аренды берутся до первого запуска задач, иначе первый тик не увидит ни одного своего ключа
+    heartbeat_once(SessionLocal, COORDINATED_JOBS)
+    start_heartbeat(SessionLocal, COORDINATED_JOBS, stop_event)
+    schedule_missing_daily_forecasts()
+    scheduler = build_scheduler()
+    try:
+        scheduler.run_forever(stop_event)
+    finally:
+        flush_menu_refreshes(quiet=0)
+        release_leases(SessionLocal)
+        shutdown_render_pool()
\ No newline at end of file